@@ -0,0 +1,155 @@
+"""
+Masked-feature ablations: how much does each trust facet add?
+
+run_ablation fits and evaluates one model per mask configuration of a
+DataSet in a process pool. The feature matrix is shared read-only with
+the workers: a memory-mapped DataSet (DataSet.load) is opened by every
+worker from its file, any other array is copied once into shared
+memory. Each worker then only copies the visible columns of its own
+configuration.
+
+    groups = facet_groups(ds.labels)
+    results = run_ablation(ds, target_col, leave_one_out(groups))
+    print(format_results(results))
+"""
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import mmap
+
+import numpy as np
+
+from data_set import DataSet
+from tools import parallel_pairs
+import regression
+
+# Set in each worker by _init_worker.
+_data = None
+_blocks = None
+
+FACETS = ['truster_mauro', 'trustee_mauro', 'social', 'benevolence', 'integrity',
+          'competence']
+
+
+def _facet(label):
+    """The facet of a YelpTrustIndicators.vector_labels column"""
+    if label in ('social_jac', 'are_friends'):
+        return 'social'
+    for facet in ('benevolence', 'integrity', 'competence'):
+        if facet in label:
+            return facet
+    for role in ('truster', 'trustee'):
+        if label.startswith(f'{role}_'):
+            return f'{role}_mauro'
+    return None
+
+
+def facet_groups(labels):
+    """Column indexes of every facet with columns in labels, by facet name"""
+    groups = OrderedDict()
+    for facet in FACETS:
+        cols = [i for i, label in enumerate(labels) if _facet(label) == facet]
+        if cols:
+            groups[facet] = cols
+    return groups
+
+
+def leave_one_out(groups):
+    """Mask configurations: nothing hidden, then each group hidden on its own"""
+    configs = OrderedDict([('all', [])])
+    for name, cols in groups.items():
+        configs[f'without_{name}'] = list(cols)
+    return configs
+
+
+def only_one(groups):
+    """Mask configurations keeping a single group visible at a time"""
+    all_cols = [c for cols in groups.values() for c in cols]
+    return OrderedDict((f'only_{name}', [c for c in all_cols if c not in cols])
+                       for name, cols in groups.items())
+
+
+def _data_spec(data, shared):
+    # Only a whole mapping (as DataSet.load opens it) can be reopened from
+    # its file: a slice of a memmap keeps the offset and filename of its
+    # parent, so it goes through shared memory like any other array.
+    if (isinstance(data, np.memmap) and data.filename and isinstance(data.base, mmap.mmap)
+            and data.flags.c_contiguous):
+        return ('memmap', data.filename, data.offset, data.shape, data.dtype.str)
+    shared.add('data', data)
+    return ('shared', shared.specs['data'])
+
+
+def _open_data(spec):
+    """The feature matrix of a _data_spec, and the shared blocks to keep open"""
+    if spec[0] == 'memmap':
+        _, filename, offset, shape, dtype = spec
+        return np.memmap(filename, dtype=np.dtype(dtype), mode='r', offset=offset,
+                         shape=shape), []
+    arrays, blocks = parallel_pairs.attach({'data': spec[1]})
+    return arrays['data'], blocks
+
+
+def _init_worker(data_spec):
+    global _data, _blocks
+    _data, _blocks = _open_data(data_spec)
+
+
+def _fit_config(config, labels, target_col, test_fraction, seed, streaming):
+    name, mask_cols = config
+    split = DataSet(_data, labels).split(target_col, mask_cols)
+    if streaming:
+        clf = regression.learn_logit_streaming(split.chunks, seed=seed)
+        confusion, fp, fn = regression.evaluate_streaming(clf, split.chunks())
+    else:
+        X, Y = split.features(), np.asarray(split.Y)
+        train = test = np.arange(len(X))
+        if test_fraction:
+            order = np.random.default_rng(seed).permutation(len(X))
+            num_test = int(len(X) * test_fraction)
+            test, train = order[:num_test], order[num_test:]
+        clf = regression.learn_logit(X[train], Y[train])
+        confusion, fp, fn = regression.evaluate(clf, X[test], Y[test])
+    return {
+        'name': name,
+        'hidden': [label for label in split.labels if label.startswith('H_')],
+        'fp': float(fp),
+        'fn': float(fn),
+        'confusion': np.asarray(confusion).tolist(),
+    }
+
+
+def run_ablation(dataset, target_col, configs, workers=None, test_fraction=0.0, seed=0,
+                 streaming=False):
+    """Fit and evaluate a model for every mask configuration of dataset.
+
+    :param dataset: A DataSet, e.g. DataSet(X, yti.vector_labels()) or DataSet.load(dir).
+    :param target_col: The column to predict. It is hidden in every configuration.
+    :param configs: A dict of name -> columns to hide, e.g. from leave_one_out,
+                    or a list of column lists.
+    :param workers: Processes in the pool. Defaults to all cores.
+    :param test_fraction: Rows held out for evaluation. 0 evaluates on the
+                          training rows, like regression.evaluate is used today.
+    :param seed: Seed of the held out rows and of streaming fits.
+    :param streaming: Fit with regression.learn_logit_streaming, reading the
+                      data in chunks, instead of learn_logit.
+    :return: A list with one result dict per configuration, in order.
+    """
+    if not isinstance(configs, dict):
+        configs = OrderedDict((str(i), cols) for i, cols in enumerate(configs))
+    fit = partial(_fit_config, labels=list(dataset.labels), target_col=target_col,
+                  test_fraction=test_fraction, seed=seed, streaming=streaming)
+    with parallel_pairs.SharedArrays() as shared:
+        data_spec = _data_spec(dataset.data, shared)
+        with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                 initargs=(data_spec,)) as pool:
+            return list(pool.map(fit, configs.items()))
+
+
+def format_results(results):
+    """The results of run_ablation as a text table"""
+    lines = [f"{'config':28s} {'fp':>8s} {'fn':>8s}  confusion"]
+    for result in results:
+        lines.append(f"{result['name']:28s} {result['fp']:8.4f} {result['fn']:8.4f}  "
+                     f"{result['confusion']}")
+    return '\n'.join(lines)
@@ -0,0 +1,304 @@
+"""
+Repeatable benchmarks of the hot paths on synthetic data.
+
+Run from src with e.g.
+
+    python -m benchmarks.run --users 5000 --pair-users 1000
+
+Each benchmark times its function repeats times on the same synthetic
+data (see synthetic.generate) and keeps the fastest run. Peak memory
+comes from one more run under tracemalloc, so it only counts memory
+allocated in this process through Python and numpy. Results are
+appended to a json lines file together with the git commit, and every
+benchmark is compared with the last stored result at the same scale.
+"""
+from os import path, makedirs
+from collections import defaultdict
+import argparse
+import copy
+import json
+import subprocess
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks import synthetic
+from yelp_interface import data_interface
+from yelp_interface.data_interface import YelpData
+from yelp_interface.mauro_trust import MauroTrust
+from yelp_interface.fang_trust import FangTrust
+from yelp_interface.trust_indicators import YelpTrustIndicators
+from yelp_interface.candidate_pairs import CoRatingIndex
+from tools.review_similarity import review_pcc, review_cos
+from small_experiments.friend_pcc_corr import gen_vectors
+import settings
+
+BENCHMARK_DIR = getattr(settings, 'BENCHMARK_DIR', path.join(settings.DATA_DIR, 'benchmarks'))
+RESULTS_FILE = 'results.jsonl'
+NUM_USERS = 5000
+PAIR_USERS = 1000
+# Co-rated pairs timed by the review_pcc/review_cos benchmarks.
+SIMILARITY_PAIRS = 20_000
+REPEATS = 3
+
+
+class Context:
+    """The synthetic data set shared by the benchmarks of one run."""
+
+    def __init__(self, data_dir, num_users, pair_users, workers):
+        self.data_dir = data_dir
+        self.num_users = num_users
+        self.pair_users = min(pair_users, num_users)
+        self.workers = workers
+        self._raw = None
+        self._yelp_data = None
+
+    def read_data(self):
+        # read_data finds its files through settings.DATA_DIR.
+        data_dir = settings.DATA_DIR
+        settings.DATA_DIR = self.data_dir
+        try:
+            return data_interface.read_data((0, self.num_users), read_sample=False,
+                                            use_cache=False, parallel=False,
+                                            hydration_budget=None)
+        finally:
+            settings.DATA_DIR = data_dir
+
+    def raw(self):
+        """(users, reviews, tips, businesses) dicts as read_data passes them to YelpData"""
+        if self._raw is None:
+            users, reviews, tips, businesses = {}, defaultdict(list), defaultdict(list), {}
+            for user in _read_lines(path.join(self.data_dir, 'user.json')):
+                users[user['user_id']] = user
+            for review in _read_lines(path.join(self.data_dir, 'review.json')):
+                review['text'] = ''
+                reviews[review['user_id']].append(review)
+            for tip in _read_lines(path.join(self.data_dir, 'tip.json')):
+                tip['text'] = ''
+                tips[tip['user_id']].append(tip)
+            for business in _read_lines(path.join(self.data_dir, 'business.json')):
+                businesses[business['business_id']] = business
+            self._raw = (users, reviews, tips, businesses)
+        return self._raw
+
+    def yelp_data(self):
+        """A YelpData of the data set with every user hydrated"""
+        if self._yelp_data is None:
+            self._yelp_data = self.read_data()
+            for _ in self._yelp_data.users():
+                pass
+        return self._yelp_data
+
+    def corated_pairs(self):
+        yd = self.yelp_data()
+        index = CoRatingIndex(yd.reviews_by_item, yd.num_users)
+        trustees, trusters, _ = index.corated_pairs(0, yd.num_users)
+        return trustees[:SIMILARITY_PAIRS], trusters[:SIMILARITY_PAIRS]
+
+
+def _read_lines(file_path):
+    with open(file_path, 'r') as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _num_pairs(n):
+    return n * (n - 1) // 2
+
+
+def bench_read_data(ctx):
+    return ctx.read_data, (), ctx.num_users, 'users'
+
+
+def bench_yelp_data(ctx):
+    raw = copy.deepcopy(ctx.raw())
+    return YelpData, raw, len(raw[0]), 'users'
+
+
+def bench_mauro_trust(ctx):
+    yd = ctx.yelp_data()
+    return lambda: MauroTrust(yd.users()), (), yd.num_users, 'users'
+
+
+def bench_fang_trust(ctx):
+    yd = ctx.yelp_data()
+    return (lambda: FangTrust(yd.rating_stats(), yd.reviews).user_indicators(yd.user_idxs()),
+            (), yd.num_users, 'users')
+
+
+def _similarity_bench(ctx, similarity):
+    yd = ctx.yelp_data()
+    users = [yd.get_user_at(i) for i in range(yd.num_users)]
+    trustees, trusters = ctx.corated_pairs()
+
+    def run():
+        return [similarity(users[i1]['reviews'], users[i2]['reviews'])
+                for i1, i2 in zip(trustees.tolist(), trusters.tolist())]
+    return run, (), len(trustees), 'pairs'
+
+
+def bench_review_pcc(ctx):
+    return _similarity_bench(ctx, review_pcc)
+
+
+def bench_review_cos(ctx):
+    return _similarity_bench(ctx, review_cos)
+
+
+def bench_to_dataset(ctx):
+    yd = ctx.yelp_data()
+    # A new YelpTrustIndicators, so the indicators are computed inside the timing.
+    run = lambda: YelpTrustIndicators(yd).to_dataset(0, ctx.pair_users, workers=ctx.workers)
+    return run, (), _num_pairs(ctx.pair_users), 'pairs'
+
+
+def bench_gen_vectors(ctx):
+    yd = ctx.yelp_data()
+    users = {yd.user_ids.lookup(i): yd.get_user_at(i) for i in range(ctx.pair_users)}
+    run = lambda: gen_vectors(users, yd.reviews_by_item, PARALLEL=True,
+                              workers=ctx.workers)
+    return run, (), _num_pairs(ctx.pair_users), 'pairs'
+
+
+BENCHMARKS = {
+    'read_data': bench_read_data,
+    'yelp_data': bench_yelp_data,
+    'mauro_trust': bench_mauro_trust,
+    'fang_trust': bench_fang_trust,
+    'review_pcc': bench_review_pcc,
+    'review_cos': bench_review_cos,
+    'to_dataset': bench_to_dataset,
+    'gen_vectors': bench_gen_vectors,
+}
+
+
+def time_benchmark(ctx, setup, repeats=REPEATS):
+    """Wall time, throughput and peak memory of one benchmark.
+
+    setup(ctx) returns (f, args, units, unit); f(*args) is what is timed.
+    It is called again before every run, outside the timing.
+    """
+    times = []
+    for _ in range(repeats):
+        f, args, units, unit = setup(ctx)
+        start_time = time.perf_counter()
+        f(*args)
+        times.append(time.perf_counter() - start_time)
+
+    f, args, units, unit = setup(ctx)
+    tracemalloc.start()
+    try:
+        f(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    seconds = min(times)
+    return {
+        'seconds': seconds,
+        'median_seconds': float(np.median(times)),
+        'units': units,
+        'unit': unit,
+        'throughput': units / seconds if seconds > 0 else float('inf'),
+        'peak_bytes': peak,
+    }
+
+
+def git_version():
+    """The current git commit, or 'unknown' outside a git checkout."""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def load_results(results_path):
+    if not path.exists(results_path):
+        return []
+    return list(_read_lines(results_path))
+
+
+def _previous(results, record):
+    for old in reversed(results):
+        if all(old.get(k) == record[k] for k in ('name', 'num_users', 'pair_users', 'seed', 'workers')):
+            return old
+    return None
+
+
+def run(names=None, num_users=NUM_USERS, pair_users=PAIR_USERS, seed=0, repeats=REPEATS,
+        workers=None, benchmark_dir=BENCHMARK_DIR, label=None):
+    """Run benchmarks, print them and append them to the results file.
+
+    :param names: The BENCHMARKS to run. Defaults to all of them.
+    :param num_users: Users in the synthetic data set.
+    :param pair_users: Users whose pairs to_dataset and gen_vectors go over.
+    :param seed: Seed of the synthetic data set.
+    :param workers: Processes for to_dataset and gen_vectors. None runs
+                    to_dataset serially and gen_vectors on every core.
+    :param benchmark_dir: Holds the generated data sets and the results file.
+    :param label: A free text note stored with the results.
+    :return: The list of result records.
+    """
+    data_dir = path.join(benchmark_dir, 'data', f'{num_users}_{seed}')
+    if not path.exists(path.join(data_dir, 'business.json')):
+        print(f"Generating synthetic data in {data_dir}")
+        synthetic.generate(data_dir, num_users, seed)
+    ctx = Context(data_dir, num_users, pair_users, workers)
+
+    results_path = path.join(benchmark_dir, RESULTS_FILE)
+    results = load_results(results_path)
+    version = git_version()
+    records = []
+    for name in names or BENCHMARKS:
+        record = {
+            'name': name,
+            'version': version,
+            'label': label,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'num_users': num_users,
+            'pair_users': ctx.pair_users,
+            'seed': seed,
+            'workers': workers,
+            'repeats': repeats,
+        }
+        record.update(time_benchmark(ctx, BENCHMARKS[name], repeats))
+        line = (f"{name:12s} {record['seconds']:9.4f} s  "
+                f"{record['throughput']:12.1f} {record['unit']}/s  "
+                f"{record['peak_bytes'] / 2 ** 20:9.1f} MiB")
+        previous = _previous(results, record)
+        if previous is not None:
+            line += (f"  {record['seconds'] / previous['seconds']:5.2f}x time "
+                     f"of {previous['version']}")
+        print(line)
+        records.append(record)
+
+    makedirs(benchmark_dir, exist_ok=True)
+    with open(results_path, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('names', nargs='*',
+                        help=f"Benchmarks to run, all by default: {', '.join(BENCHMARKS)}")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--pair-users', type=int, default=PAIR_USERS)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--dir', default=BENCHMARK_DIR)
+    parser.add_argument('--label', default=None)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    run(args.names, args.users, args.pair_users, args.seed, args.repeats, args.workers,
+        args.dir, args.label)
+
+
+if __name__ == '__main__':
+    main()
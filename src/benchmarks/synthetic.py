@@ -0,0 +1,153 @@
+"""
+Synthetic Yelp shaped data for benchmarks.
+
+generate() writes user.json, review.json, tip.json and business.json in
+the layout read_data expects, at any scale. The distributions follow the
+shape of the real data rather than its values:
+
+- reviews per user are Pareto distributed, so a few users write most
+  reviews,
+- businesses are picked with Zipf weights, so a few are very popular,
+- friend list lengths are Pareto distributed and a share of the friends
+  are users that are not in the file, like friends outside a user_range.
+
+The same arguments always give the same files.
+"""
+from os import path, makedirs
+import json
+
+import numpy as np
+
+ID_CHARS = np.array(list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-_'))
+ID_LENGTH = 22
+COMPLIMENTS = ['hot', 'more', 'profile', 'cute', 'list', 'note', 'plain', 'cool',
+               'funny', 'writer', 'photos']
+
+ITEMS_PER_USER = 0.5
+REVIEW_SHAPE = 1.2
+FRIEND_SHAPE = 1.5
+ITEM_ZIPF = 0.8
+OUTSIDE_FRIEND_RATE = 0.3
+TIP_RATE = 0.5
+FIRST_YEAR = 2005
+LAST_YEAR = 2018
+
+
+def _ids(rng, count):
+    chars = ID_CHARS[rng.integers(0, len(ID_CHARS), size=(count, ID_LENGTH))]
+    return [''.join(row) for row in chars]
+
+
+def _dates(rng, count, first_year=2010, last_year=LAST_YEAR):
+    years = rng.integers(first_year, last_year + 1, size=count)
+    months = rng.integers(1, 13, size=count)
+    days = rng.integers(1, 29, size=count)
+    hours = rng.integers(0, 24, size=count)
+    return [f'{y}-{m:02d}-{d:02d} {h:02d}:00:00' for y, m, d, h in zip(years, months, days, hours)]
+
+
+def _write_lines(file_path, rows):
+    with open(file_path, 'w') as f:
+        for row in rows:
+            f.write(json.dumps(row) + '\n')
+
+
+def generate(out_dir, num_users, seed=0, items_per_user=ITEMS_PER_USER):
+    """Write a synthetic data set for num_users users into out_dir.
+
+    :param items_per_user: Businesses generated per user.
+    :return: A dict with the number of users, reviews, tips and businesses written.
+    """
+    makedirs(out_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    num_items = max(50, int(num_users * items_per_user))
+    user_ids = _ids(rng, num_users)
+    business_ids = _ids(rng, num_items)
+
+    friend_counts = np.minimum(rng.pareto(FRIEND_SHAPE, num_users).astype(np.int64),
+                               num_users - 1)
+    since = rng.integers(FIRST_YEAR, LAST_YEAR + 1, size=num_users)
+    users = []
+    for u, user_id in enumerate(user_ids):
+        friends = rng.choice(num_users, friend_counts[u], replace=False)
+        friends = [user_ids[f] for f in friends if f != u]
+        if rng.random() < OUTSIDE_FRIEND_RATE:
+            friends += _ids(rng, 1)
+        years = range(since[u], LAST_YEAR + 1)
+        elite = sorted(rng.choice(years, min(len(years), rng.integers(0, 4)), replace=False))
+        user = {
+            'user_id': user_id,
+            'name': 'user',
+            'review_count': 0,
+            'yelping_since': _dates(rng, 1, since[u], since[u])[0],
+            'useful': int(rng.integers(0, 50)),
+            'funny': int(rng.integers(0, 20)),
+            'cool': int(rng.integers(0, 20)),
+            'elite': ','.join(str(y) for y in elite),
+            'friends': ', '.join(friends),
+            'fans': int(rng.integers(0, 30)),
+            'average_stars': 3.5,
+        }
+        for name in COMPLIMENTS:
+            user[f'compliment_{name}'] = int(rng.integers(0, 6))
+        users.append(user)
+
+    review_counts = 1 + rng.pareto(REVIEW_SHAPE, num_users).astype(np.int64)
+    review_counts = np.minimum(review_counts, num_items)
+    for user, count in zip(users, review_counts):
+        user['review_count'] = int(count)
+    item_weights = 1 / np.arange(1, num_items + 1) ** ITEM_ZIPF
+    item_weights /= item_weights.sum()
+    num_reviews = int(review_counts.sum())
+    review_users = np.repeat(np.arange(num_users), review_counts)
+    review_items = rng.choice(num_items, num_reviews, p=item_weights)
+    review_ids = _ids(rng, num_reviews)
+    stars = rng.integers(1, 6, size=num_reviews)
+    votes = rng.poisson((1.0, 0.5, 0.5), size=(num_reviews, 3))
+    review_dates = _dates(rng, num_reviews)
+    reviews = ({
+        'review_id': review_ids[k],
+        'user_id': user_ids[review_users[k]],
+        'business_id': business_ids[review_items[k]],
+        'stars': float(stars[k]),
+        'useful': int(votes[k, 0]),
+        'funny': int(votes[k, 1]),
+        'cool': int(votes[k, 2]),
+        'text': 'review',
+        'date': review_dates[k],
+    } for k in range(num_reviews))
+
+    tip_users = rng.choice(num_users, int(num_users * TIP_RATE), replace=False)
+    tip_items = rng.choice(num_items, len(tip_users), p=item_weights)
+    tip_dates = _dates(rng, len(tip_users))
+    tips = ({
+        'user_id': user_ids[u],
+        'business_id': business_ids[i],
+        'text': 'tip',
+        'date': date,
+        'compliment_count': int(rng.integers(0, 3)),
+    } for u, i, date in zip(tip_users, tip_items, tip_dates))
+
+    businesses = ({
+        'business_id': business_id,
+        'name': 'business',
+        'city': 'city',
+        'state': 'state',
+        'latitude': 0.0,
+        'longitude': 0.0,
+        'stars': 3.5,
+        'review_count': 0,
+        'is_open': 1,
+        'categories': 'Food',
+    } for business_id in business_ids)
+
+    _write_lines(path.join(out_dir, 'user.json'), users)
+    _write_lines(path.join(out_dir, 'review.json'), reviews)
+    _write_lines(path.join(out_dir, 'tip.json'), tips)
+    _write_lines(path.join(out_dir, 'business.json'), businesses)
+    return {
+        'users': num_users,
+        'reviews': num_reviews,
+        'tips': len(tip_users),
+        'businesses': num_items,
+    }
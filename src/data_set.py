@@ -1,12 +1,72 @@
+from os import path, makedirs
+import json
+
 import numpy as np
-from sklearn.preprocessing import scale
+
+# File names inside a dataset directory written by DataSetWriter.
+FEATURES_FILE = 'features.npy'
+TRUSTERS_FILE = 'trusters.npy'
+TRUSTEES_FILE = 'trustees.npy'
+LABELS_FILE = 'labels.json'
+# Rows read at a time when a dataset is scanned.
+CHUNK_ROWS = 1_000_000
 
 
 class DataSet:
-    def __init__(self, data, labels):
+    """A pair feature matrix with column labels.
+
+    data may be a memory-mapped array (see load). Splitting and masking
+    only keep column indexes; rows are read when features are asked for.
+    """
+
+    def __init__(self, data, labels, stats=None):
+        """stats: column statistics to share with the dataset this one was
+        made from, so they are only computed once."""
         self.data = data
         self._labels = labels
         self._mask_list = []
+        self._stats = stats if stats is not None else {}
+
+    @classmethod
+    def load(cls, dir_path, mmap_mode='r'):
+        """Open a dataset directory written by DataSetWriter.
+
+        The features are memory-mapped, so nothing is read until used.
+        """
+        data = np.load(path.join(dir_path, FEATURES_FILE), mmap_mode=mmap_mode)
+        with open(path.join(dir_path, LABELS_FILE), 'r') as f:
+            labels = json.load(f)
+        return cls(data, labels)
+
+    @staticmethod
+    def load_pairs(dir_path, mmap_mode='r'):
+        """Return the (trusters, trustees) user_idx columns of a dataset directory"""
+        trusters = np.load(path.join(dir_path, TRUSTERS_FILE), mmap_mode=mmap_mode)
+        trustees = np.load(path.join(dir_path, TRUSTEES_FILE), mmap_mode=mmap_mode)
+        return trusters, trustees
+
+    def column_stats(self, chunk_rows=CHUNK_ROWS):
+        """(mean, std) of every column, read chunk_rows rows at a time.
+
+        Computed once and shared with every split of this dataset. A std
+        too close to 0 is reported as 1, like sklearn's scale does.
+        """
+        if 'mean' not in self._stats:
+            num_rows = len(self.data)
+            sums = np.zeros(self.data.shape[1])
+            for start in range(0, num_rows, chunk_rows):
+                sums += self.data[start:start + chunk_rows].sum(axis=0, dtype=np.float64)
+            mean = sums / max(num_rows, 1)
+            # Squared deviations from the mean, not E[x^2] - E[x]^2, which
+            # loses precision when the mean is large.
+            squares = np.zeros(self.data.shape[1])
+            for start in range(0, num_rows, chunk_rows):
+                chunk = self.data[start:start + chunk_rows].astype(np.float64) - mean
+                squares += np.einsum('ij,ij->j', chunk, chunk)
+            std = np.sqrt(squares / max(num_rows, 1))
+            std[std < 10 * np.finfo(std.dtype).eps] = 1.0
+            self._stats['mean'], self._stats['std'] = mean, std
+        return self._stats['mean'], self._stats['std']
 
     def split(self, target_col, mask_cols=None):
         """Split this dataset into rows and labels.
@@ -14,19 +74,18 @@ class DataSet:
         target_col: the index of the column to use as targetgs
         mask: an iterable of columns indices to hide. The column at
               target_col will be masked whether it appears here or not.
+
+        Nothing is copied; the split reads data when its features are used.
         """
         if mask_cols is None:
             mask_cols = list()
 
-        Y = self.data[:, target_col]
         mask_list = list(set(mask_cols).union(self._mask_list))
-        if target_col not in mask_cols:
+        if target_col not in mask_list:
             mask_list.append(target_col)
 
-        X = np.copy(self.data)
-        X[:, mask_list] = 0
-
-        return DataSplit(self.data, self.labels, X, Y, mask_list)
+        return DataSplit(self.data, self._labels, mask_list=mask_list, target_col=target_col,
+                         stats=self._stats)
 
     @property
     def labels(self):
@@ -34,11 +93,25 @@ class DataSet:
 
 
 class DataSplit(DataSet):
-    def __init__(self, data, labels, X, Y, mask_list):
-        super().__init__(data, labels)
-        self.X = X
-        self.Y = Y
-        self._mask_list = mask_list
+    """Features and targets of a DataSet with some columns hidden.
+
+    features() and chunks() only read the visible columns of the rows
+    asked for. X is the full width matrix with the hidden columns set to
+    0, built by materialize() on first use and kept: masking and
+    unmasking update its columns in place and scale() drops it.
+    """
+
+    def __init__(self, data, labels, X=None, Y=None, mask_list=None, target_col=None,
+                 stats=None):
+        """DataSplit(data, labels, X, Y, mask_list) keeps the given X and Y.
+        DataSet.split passes target_col instead, and both are read from data.
+        """
+        super().__init__(data, labels, stats)
+        self.target_col = target_col
+        self._X = X
+        self._Y = Y
+        self._mask_list = mask_list if mask_list is not None else []
+        self._scaled = False
 
     @property
     def labels(self):
@@ -50,17 +123,151 @@ class DataSplit(DataSet):
                 hidden_labels.append(label)
         return hidden_labels
 
+    @property
+    def Y(self):
+        if self._Y is not None:
+            return self._Y
+        # A strided view of the target column; no copy for an ndarray or memmap.
+        return self.data[:, self.target_col]
+
+    @property
+    def columns(self):
+        """Sorted indexes of the visible columns"""
+        hidden = set(self._mask_list)
+        return np.array([c for c in range(self.data.shape[1]) if c not in hidden],
+                        dtype=np.int64)
+
+    def features(self, rows=slice(None)):
+        """The visible columns of the given rows, standardized if scale() was called.
+
+        rows: a slice or index array. Only these rows and the visible
+        columns are copied.
+        """
+        X = np.asarray(self.data[rows])[:, self.columns]
+        if self._scaled:
+            mean, std = self.column_stats()
+            X = ((X - mean[self.columns]) / std[self.columns]).astype(self.data.dtype)
+        return X
+
+    def chunks(self, chunk_rows=CHUNK_ROWS):
+        """Yield (features, Y) for chunk_rows rows at a time"""
+        for start in range(0, len(self.data), chunk_rows):
+            rows = slice(start, start + chunk_rows)
+            yield self.features(rows), self.Y[rows]
+
+    def materialize(self):
+        """Build X, allocating the full matrix, and keep it for later reads."""
+        if self._X is None:
+            X = np.zeros(self.data.shape, dtype=self.data.dtype)
+            columns = self.columns
+            for start in range(0, len(self.data), CHUNK_ROWS):
+                rows = slice(start, start + CHUNK_ROWS)
+                X[rows, columns] = self.features(rows)
+            self._X = X
+        return self._X
+
+    @property
+    def X(self):
+        """Every column, with the hidden ones 0. See materialize."""
+        return self.materialize()
+
+    @X.setter
+    def X(self, X):
+        self._X = X
+
+    def _column(self, col_id):
+        """The values X holds for a visible column"""
+        values = np.asarray(self.data[:, col_id])
+        if self._scaled:
+            mean, std = self.column_stats()
+            values = (values - mean[col_id]) / std[col_id]
+        return values
+
+    def mask(self, col_id):
+        if col_id not in self._mask_list:
+            self._mask_list.append(col_id)
+            if self._X is not None:
+                self._X[:, col_id] = 0
+        return self
+
     def unmask(self, col_id):
         if col_id not in self._mask_list:
             raise Exception(f"col {col_id} is not masked")
         self._mask_list.remove(col_id)
-        self.X[:, col_id] = self.data[:, col_id]
+        if self._X is not None:
+            self._X[:, col_id] = self._column(col_id)
         return self
 
     def reset(self):
         """Return a Dataset with nothing masked"""
-        return DataSet(self.data, self.labels)
+        return DataSet(self.data, self._labels, self._stats)
+
+    def unmask_all(self):
+        """Unmask every column but the target column, in place"""
+        for col_id in list(self._mask_list):
+            if col_id != self.target_col:
+                self.unmask(col_id)
+        return self
 
     def scale(self):
-        self.X = scale(self.X)
+        """Standardize the features with the dataset's column_stats from now on.
+
+        Drops X, so it is rebuilt standardized on the next read.
+        """
+        self._scaled = True
+        self._X = None
         return self
+
+
+class DataSetWriter:
+    """Writes pair feature chunks into a dataset directory as they are produced.
+
+    The features go to a memory-mapped float32 .npy of num_rows rows, next
+    to the truster and trustee user_idx columns and the column labels.
+    """
+
+    def __init__(self, dir_path, num_rows, labels):
+        makedirs(dir_path, exist_ok=True)
+        self.dir_path = dir_path
+        self.features_path = path.join(dir_path, FEATURES_FILE)
+        self._features = np.lib.format.open_memmap(
+            self.features_path, mode='w+', dtype=np.float32,
+            shape=(num_rows, len(labels)))
+        self._trusters = np.lib.format.open_memmap(
+            path.join(dir_path, TRUSTERS_FILE), mode='w+', dtype=np.int32,
+            shape=(num_rows,))
+        self._trustees = np.lib.format.open_memmap(
+            path.join(dir_path, TRUSTEES_FILE), mode='w+', dtype=np.int32,
+            shape=(num_rows,))
+        with open(path.join(dir_path, LABELS_FILE), 'w') as f:
+            json.dump(list(labels), f)
+        self._row = 0
+
+    def write_pairs(self, trusters, trustees):
+        """Write the index columns of a chunk without its features.
+
+        Used when the features are written by other processes.
+        """
+        stop = self._row + len(trusters)
+        self._trusters[self._row:stop] = trusters
+        self._trustees[self._row:stop] = trustees
+        self._row = stop
+
+    def write(self, trusters, trustees, X):
+        self._features[self._row:self._row + len(X)] = X
+        self.write_pairs(trusters, trustees)
+
+    def close(self):
+        if self._row != len(self._features):
+            msg = f"Wrote {self._row} rows but expected {len(self._features)}"
+            raise Exception(msg)
+        for array in (self._features, self._trusters, self._trustees):
+            array.flush()
+        del self._features, self._trusters, self._trustees
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
@@ -3,16 +3,22 @@ from yelp_interface.trust_indicators import YelpTrustIndicators
 from small_experiments import friend_pcc_corr as fpcc
 from small_experiments.friend_pcc_corr import gen_vectors
 from regression import *
+from tools import instrument
+import settings
 import time
 
 yd = read_data()
-yti = YelpTrustIndicators(yd)
+yti = YelpTrustIndicators(yd, store_dir=getattr(settings, 'INDICATOR_STORE_DIR', None))
 # users, reviews_by_business = fpcc.load_data()
 
 
-def gen_data(yti, start, stop):
+def gen_data(yti, start, stop, workers=None, report_path=None):
+    """report_path: if set, instrument the run and write the report there."""
+    if report_path:
+        with instrument.session(report_path):
+            return yti.to_dataset(start, stop, workers=workers)
     start_time = time.time()
-    X = yti.to_dataset(start, stop)
+    X = yti.to_dataset(start, stop, workers=workers)
     stop_time = time.time()
     print(f"Generation took {stop_time-start_time} seconds.")
     return X
@@ -1,7 +1,17 @@
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 from sklearn.metrics import confusion_matrix
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
 import numpy as np
 
+# Passes over the chunks made by learn_logit_streaming after the first,
+# which only gathers the scaling and class statistics.
+STREAMING_EPOCHS = 5
+# Rows mixed together before partial_fit sees them. Pair chunks come in
+# user order, and SGD on sorted rows drifts towards the last ones seen.
+SHUFFLE_ROWS = 500_000
+BATCH_ROWS = 10_000
+
 
 def split(X, split_index):
     """Split a data set into features and labels"""
@@ -10,9 +20,21 @@ def split(X, split_index):
     return new_X, Y
 
 
-def learn_logit(X, Y):
+def split_chunks(chunks, split_index):
+    """split for every chunk of an iterable of feature chunks.
+
+    Yields (X, Y) with the split_index column left out of X. Only the
+    chunk is copied, e.g. for chunks of YelpTrustIndicators.iter_dataset.
+    """
+    for X in chunks:
+        cols = np.arange(X.shape[1]) != split_index
+        yield X[:, cols], X[:, split_index]
+
+
+def learn_logit(X, Y, sample_weight=None):
+    """sample_weight: optional per-row weights, e.g. from candidate_pairs"""
     clf = LogisticRegression(class_weight='balanced',
-            penalty='l2', solver='saga').fit(X, Y)
+            penalty='l2', solver='saga').fit(X, Y, sample_weight=sample_weight)
     return clf
 
 
@@ -22,3 +44,88 @@ def evaluate(clf, X, Y):
     fp = confusion[0][1] / (confusion[0][1] + confusion[0][0])
     fn = confusion[1][0] / (confusion[1][0] + confusion[1][1])
     return confusion, fp, fn
+
+
+def _shuffled_batches(chunks, rng, shuffle_rows=SHUFFLE_ROWS, batch_rows=BATCH_ROWS):
+    """Regroup (X, Y, weights) chunks into shuffled batches of batch_rows rows.
+
+    Rows are shuffled within a buffer of about shuffle_rows rows.
+    """
+    buffered, size = [], 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        size += len(chunk[0])
+        if size >= shuffle_rows:
+            yield from _batches(buffered, rng, batch_rows)
+            buffered, size = [], 0
+    if buffered:
+        yield from _batches(buffered, rng, batch_rows)
+
+
+def _batches(chunks, rng, batch_rows):
+    X, Y, weights = (np.concatenate(parts) for parts in zip(*chunks))
+    order = rng.permutation(len(X))
+    for start in range(0, len(X), batch_rows):
+        rows = order[start:start + batch_rows]
+        yield X[rows], Y[rows], weights[rows]
+
+
+def learn_logit_streaming(make_chunks, epochs=STREAMING_EPOCHS, alpha=1e-4, seed=None,
+                          shuffle_rows=SHUFFLE_ROWS, batch_rows=BATCH_ROWS):
+    """An SGD logistic regression fitted one chunk at a time.
+
+    make_chunks: f() -> a new iterable of (X, Y) or (X, Y, sample_weight)
+                 chunks, e.g. lambda: DataSet.load(d).split(t).chunks().
+                 It is called once per pass over the data.
+    epochs: Passes of partial_fit over the chunks.
+    alpha: The l2 regularization strength of SGDClassifier.
+    shuffle_rows: Rows held at once and shuffled before they are fitted.
+    batch_rows: Rows per partial_fit call.
+
+    A first pass fits a StandardScaler with partial_fit and counts the
+    classes, so the chunks can then be standardized and weighted like
+    class_weight='balanced' without holding the data in memory.
+    Returns a Pipeline of the scaler and the classifier, which has
+    predict and predict_proba like learn_logit's model.
+    """
+    scaler = StandardScaler()
+    classes, counts = np.array([]), np.array([])
+    for chunk in make_chunks():
+        X, Y = chunk[0], chunk[1]
+        scaler.partial_fit(X)
+        chunk_classes, chunk_counts = np.unique(Y, return_counts=True)
+        merged = np.union1d(classes, chunk_classes)
+        counts = (np.bincount(np.searchsorted(merged, classes), counts, len(merged)) +
+                  np.bincount(np.searchsorted(merged, chunk_classes), chunk_counts,
+                              len(merged)))
+        classes = merged
+    # Balanced weights: n_samples / (n_classes * count of the class).
+    class_weights = counts.sum() / (len(classes) * counts)
+
+    def weighted_chunks():
+        for chunk in make_chunks():
+            X, Y = chunk[0], chunk[1]
+            weights = class_weights[np.searchsorted(classes, Y)]
+            if len(chunk) > 2 and chunk[2] is not None:
+                weights = weights * chunk[2]
+            yield scaler.transform(X), Y, weights
+
+    rng = np.random.default_rng(seed)
+    clf = SGDClassifier(loss='log_loss', penalty='l2', alpha=alpha, random_state=seed)
+    for _ in range(epochs):
+        for X, Y, weights in _shuffled_batches(weighted_chunks(), rng, shuffle_rows,
+                                               batch_rows):
+            clf.partial_fit(X, Y, classes=classes, sample_weight=weights)
+    return Pipeline([('scaler', scaler), ('logit', clf)])
+
+
+def evaluate_streaming(clf, chunks):
+    """evaluate over an iterable of (X, Y) chunks, adding up the confusion matrices"""
+    confusion = None
+    for chunk in chunks:
+        X, Y = chunk[0], chunk[1]
+        chunk_confusion = confusion_matrix(Y, clf.predict(X), labels=clf.classes_)
+        confusion = chunk_confusion if confusion is None else confusion + chunk_confusion
+    fp = confusion[0][1] / (confusion[0][1] + confusion[0][0])
+    fn = confusion[1][0] / (confusion[1][0] + confusion[1][1])
+    return confusion, fp, fn
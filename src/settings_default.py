@@ -3,3 +3,10 @@
 DATA_NUM_USERS = 10000
 DATA_DIR = '/home/aparment/Documents/datasets/yelp'
 DATA_READ_SAMPLE = False
+DATA_CACHE_DIR = '/home/aparment/Documents/datasets/yelp/cache'
+DATA_USE_CACHE = False
+DATA_PARALLEL_READ = False
+PAIR_PARALLEL = False
+DATA_HYDRATION_BUDGET = None
+INDICATOR_STORE_DIR = '/home/aparment/Documents/datasets/yelp/indicators'
+BENCHMARK_DIR = '/home/aparment/Documents/datasets/yelp/benchmarks'
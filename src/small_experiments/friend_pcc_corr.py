@@ -6,10 +6,18 @@ than a non friend to give advise on the yelp data set?
 
 from os import path
 import json
+import numpy as np
+from scipy import sparse
 from collections import defaultdict
 from yelp_interface.data_interface import YelpData as YD
+from yelp_interface.trust_indicators import triangle_blocks
 from tools.user_reviews import UserReviews
-from tools.review_similarity import review_pcc
+from tools.id_registry import IdRegistry, sorted_contains
+from tools.review_similarity import shared_ratings
+from tools import similarity_kernels
+from tools.sparse_similarity import build_rating_matrix, PairSimilarity
+from tools.rating_stats import RatingStats
+from tools import parallel_pairs
 import settings
 """
 EXP 1:
@@ -43,20 +51,24 @@ SHARE_CUTOFF = 3
 
 
 def are_friends(u1, u2):
-    return 1 if u2['user_id'] in u1['friends'] else 0
+    return 1 if sorted_contains(u1['friends'], u2['user_idx']) else 0
 
 
 def load_data():
     users = {}
+    user_ids = IdRegistry()
+    item_ids = IdRegistry()
     read_count = 0
     print("Loading USERS")
     with open(USER_PATH, 'r') as f:
         for line in f:
             full_user = json.loads(line)
+            user_idx = user_ids.intern(full_user['user_id'])
             friends = YD.parse_friends(full_user)
             light_user = {
                 'user_id': full_user['user_id'],
-                'friends': friends
+                'user_idx': user_idx,
+                'friends': np.unique(user_ids.intern_many(friends))
             }
             users[light_user['user_id']] = light_user
             read_count += 1
@@ -73,38 +85,121 @@ def load_data():
                 continue
             light_review = {
                 'user_id': full_review['user_id'],
+                'user_idx': user_ids.index(full_review['user_id']),
                 'date': full_review['date'],
                 'business_id': full_review['business_id'],
+                'item_idx': item_ids.intern(full_review['business_id']),
                 'stars': full_review['stars']
             }
             reviews_by_user[light_review['user_id']].append(light_review)
 
-    reviews_by_business = defaultdict(list)
+    # Indexed by item_idx
+    reviews_by_business = [[] for _ in range(len(item_ids))]
     for reviewlist in reviews_by_user.values():
         for review in reviewlist:
-            reviews_by_business[review['business_id']].append(review)
+            reviews_by_business[review['item_idx']].append(review)
 
+    rating_matrix = build_rating_matrix(
+        (r for reviewlist in reviews_by_user.values() for r in reviewlist),
+        len(user_ids), len(item_ids))
+    rating_stats = RatingStats(reviews_by_business, rating_matrix)
     for user in users.values():
         user['reviews'] = UserReviews(
             reviews_by_user[user['user_id']],
-            reviews_by_business)
+            rating_stats)
 
     return users, reviews_by_business
 
 
-def gen_vectors(users, reviews_by_business, PARALLEL=True):
+def gen_vectors(users, reviews_by_business,
+                PARALLEL=getattr(settings, 'PAIR_PARALLEL', False), workers=None):
+    """Return [are_friends, pcc] for every pair of users sharing at least SHARE_CUTOFF businesses.
+
+    PARALLEL: set to true to score the pairs in a process pool (see gen_vectors_parallel).
+    workers: the number of processes to use when PARALLEL is set. Defaults to all cores.
+    """
+    if PARALLEL:
+        return gen_vectors_parallel(users, reviews_by_business, workers)
+
     print("Generating function calls")
     user_list = list(users.values())
     vectors = []
 
     for i1 in range(len(user_list)):
         u1 = user_list[i1]
+        # The shared ratings of u1 with every later user, scored in one
+        # kernel call per u1.
+        friends, columns, counts = [], ([], [], [], []), []
         for i2 in range(i1 + 1, len(user_list)):
             u2 = user_list[i2]
             shared_items = u1['reviews'].mutually_reviewed_items(u2['reviews'])
             if len(shared_items) < SHARE_CUTOFF:
                 continue
 
-            u1u2_pcc = review_pcc(u1['reviews'], u2['reviews'], "OVERALL")
-            vectors.append([are_friends(u1, u2), u1u2_pcc])
+            ratings = shared_ratings(u1['reviews'], u2['reviews'], "OVERALL", shared_items)
+            for column, values in zip(columns, ratings):
+                column.append(values)
+            counts.append(len(shared_items))
+            friends.append(are_friends(u1, u2))
+        if not counts:
+            continue
+        indptr = np.concatenate([[0], np.cumsum(counts)])
+        pccs = similarity_kernels.pcc(*(np.concatenate(c) for c in columns), indptr)
+        vectors.extend([f, float(p)] for f, p in zip(friends, pccs))
+    return vectors
+
+
+def _tile_vectors(tile, stop, share_cutoff):
+    arrays = parallel_pairs.worker_arrays()
+    user_idxs = arrays['user_idxs']
+    similarity = PairSimilarity.from_matrices(
+        {name: arrays[name] for name in PairSimilarity.MATRICES})
+    rated = arrays['B']
+    row_start, row_stop, _ = tile
+    vectors = []
+    for i1s, i2s in triangle_blocks(row_start, stop, row_stop=row_stop):
+        u1s, u2s = user_idxs[i1s], user_idxs[i2s]
+        shared = np.asarray(rated[u1s].multiply(rated[u2s]).sum(axis=1)).ravel()
+        keep = shared >= share_cutoff
+        u1s, u2s = u1s[keep], u2s[keep]
+        friends = np.asarray(arrays['friends'][u1s, u2s]).ravel()
+        pccs = similarity.pcc(u1s, u2s)
+        vectors.extend([int(f), float(p)] for f, p in zip(friends, pccs))
     return vectors
+
+
+def gen_vectors_parallel(users, reviews_by_business, workers=None):
+    """gen_vectors over a process pool, with the same output as the serial loop.
+
+    Pairs are tiled with tools.parallel_pairs and each tile is scored with
+    sparse products against a rating matrix shared between the workers.
+    """
+    print("Generating vectors in parallel")
+    user_list = list(users.values())
+    user_idxs = np.array([u['user_idx'] for u in user_list])
+    friend_lists = [u['friends'] for u in user_list]
+    # load_data interns friend ids in between users, so a user's own index
+    # can be past both the user count and every friend index.
+    num_ids = max([len(user_idxs), user_idxs.max(initial=-1) + 1] +
+                  [f.max() + 1 for f in friend_lists if len(f)])
+
+    reviews = (r for u in user_list for r in u['reviews'])
+    R = build_rating_matrix(reviews, num_ids, len(reviews_by_business))
+    friend_rows = np.zeros(num_ids + 1, dtype=np.int64)
+    friend_rows[user_idxs + 1] = [len(f) for f in friend_lists]
+    friends = sparse.csr_matrix(
+        (np.ones(friend_rows.sum()),
+         np.concatenate([friend_lists[i] for i in np.argsort(user_idxs)] + [[]]),
+         np.cumsum(friend_rows)),
+        shape=(num_ids, num_ids))
+
+    tiles = parallel_pairs.balanced_tiles(
+        0, len(user_list), parallel_pairs.num_tiles(workers))
+    with parallel_pairs.SharedArrays() as shared:
+        shared.add('user_idxs', user_idxs)
+        shared.add('friends', friends)
+        for name, matrix in PairSimilarity(R, 'OVERALL').matrices().items():
+            shared.add(name, matrix)
+        results = parallel_pairs.run_tiles(_tile_vectors, shared, tiles, workers,
+                                           args=(len(user_list), SHARE_CUTOFF))
+    return [vector for tile_vectors in results for vector in tile_vectors]
@@ -0,0 +1,117 @@
+"""
+The friend graph as a CSR adjacency matrix of interned user indexes.
+
+Row u lists the sorted user_idx values of u's friends, as given in u's
+profile. Friends that are not loaded are columns without a row of their
+own. All queries take arrays of users or pairs and avoid building
+per-pair sets: friendship and intersection sizes are binary searches
+into the sorted (row, column) keys of the edges, and Jaccard unions are
+|A| + |B| - |A & B|.
+"""
+import numpy as np
+from scipy import sparse
+
+from tools.sparse_similarity import replace_rows
+
+
+class FriendGraph:
+    """Batch friendship, Jaccard, common neighbour and 2-hop queries."""
+
+    def __init__(self, adjacency, edge_keys=None):
+        """adjacency: a CSR num_users x num_ids 0/1 matrix with sorted rows,
+        e.g. from from_lists.
+        edge_keys: a saved edge_keys() of the same matrix, so it is not
+        recomputed when the graph is rebuilt around shared arrays.
+        """
+        self.adjacency = adjacency
+        self.degrees = np.diff(adjacency.indptr)
+        self._keys = edge_keys
+
+    @classmethod
+    def from_lists(cls, friend_lists, num_rows, num_ids):
+        """Build from a dict of user_idx -> sorted friend user_idx array."""
+        counts = np.zeros(num_rows, dtype=np.int64)
+        rows = sorted(friend_lists)
+        counts[rows] = [len(friend_lists[u]) for u in rows]
+        adjacency = sparse.csr_matrix(
+            (np.ones(counts.sum()),
+             np.concatenate([friend_lists[u] for u in rows] + [[]]).astype(np.int32),
+             np.concatenate([[0], np.cumsum(counts)])),
+            shape=(num_rows, num_ids))
+        adjacency.sort_indices()
+        return cls(adjacency)
+
+    def with_rows(self, friend_lists, num_rows, num_ids):
+        """A FriendGraph with the rows of some users replaced, e.g. after new
+        profiles arrive, grown to num_rows x num_ids.
+
+        friend_lists: a dict of user_idx -> sorted friend user_idx array.
+        """
+        rows = sorted(friend_lists)
+        changed = FriendGraph.from_lists({k: friend_lists[u] for k, u in enumerate(rows)},
+                                         len(rows), num_ids)
+        return FriendGraph(replace_rows(self.adjacency, rows, changed.adjacency,
+                                        (num_rows, num_ids)))
+
+    @property
+    def num_rows(self):
+        return self.adjacency.shape[0]
+
+    def edge_keys(self):
+        """row * num_ids + column of every edge, sorted"""
+        if self._keys is None:
+            rows = np.repeat(np.arange(self.num_rows, dtype=np.int64), self.degrees)
+            self._keys = rows * self.adjacency.shape[1] + self.adjacency.indices
+        return self._keys
+
+    def _has_edges(self, us, vs):
+        keys = self.edge_keys()
+        query = np.asarray(us, dtype=np.int64) * self.adjacency.shape[1] + vs
+        pos = np.searchsorted(keys, query)
+        pos = np.minimum(pos, len(keys) - 1)
+        return (len(keys) > 0) & (keys[pos] == query)
+
+    def neighbors(self, u):
+        """Sorted user_idx array of u's friends"""
+        return self.adjacency.indices[self.adjacency.indptr[u]:self.adjacency.indptr[u + 1]]
+
+    def is_friend(self, us, vs):
+        """1.0 where vs[k] is in us[k]'s friend list, else 0.0"""
+        return self._has_edges(us, vs).astype(np.float64)
+
+    def common_neighbors(self, us, vs):
+        """|friends(us[k]) & friends(vs[k])| for every k.
+
+        Each pair walks the shorter of its two lists and looks every entry
+        up in the other one.
+        """
+        us = np.asarray(us, dtype=np.int64)
+        vs = np.asarray(vs, dtype=np.int64)
+        swap = self.degrees[vs] > self.degrees[us]
+        short, long = np.where(swap, us, vs), np.where(swap, vs, us)
+        lengths = self.degrees[short]
+        pairs = np.repeat(np.arange(len(us)), lengths)
+        starts = np.repeat(self.adjacency.indptr[short] - np.cumsum(lengths) + lengths, lengths)
+        entries = self.adjacency.indices[np.arange(lengths.sum()) + starts]
+        found = self._has_edges(long[pairs], entries)
+        return np.bincount(pairs, weights=found, minlength=len(us))
+
+    def jaccard(self, us, vs):
+        """Jaccard similarity of the friend lists of every (us[k], vs[k])"""
+        shared = self.common_neighbors(us, vs)
+        union = self.degrees[us] + self.degrees[vs] - shared
+        return np.divide(shared, union, out=np.zeros(len(shared)), where=shared > 0)
+
+    def two_hop_counts(self, users):
+        """Number of distinct friends of friends of each user, not counting the user.
+
+        Only friends that are loaded (have a row) are followed.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        A = self.adjacency
+        # Columns past num_rows have no friends of their own to follow.
+        reach = (A[users][:, :self.num_rows] @ A).tocsr()
+        reach.data[:] = 1
+        counts = np.diff(reach.indptr).astype(np.int64)
+        counts -= np.asarray(reach[np.arange(len(users)), users]).ravel().astype(np.int64)
+        return counts
@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class IdRegistry:
+    """Maps string ids (user_id, business_id) to dense int32 indexes.
+
+    Indexes are handed out in order of first sight, so interning the
+    loaded users first gives them the indexes 0..n-1.
+    """
+
+    def __init__(self, ids=()):
+        self._index = {}
+        self._ids = []
+        for key in ids:
+            self.intern(key)
+
+    def intern(self, key):
+        """Return the index of key, assigning a new one if it is unseen."""
+        idx = self._index.get(key)
+        if idx is None:
+            idx = len(self._ids)
+            self._index[key] = idx
+            self._ids.append(key)
+        return idx
+
+    def intern_many(self, keys):
+        return np.array([self.intern(k) for k in keys], dtype=np.int32)
+
+    def index(self, key):
+        """Return the index of a known key. Raises KeyError otherwise."""
+        return self._index[key]
+
+    def indexes(self, keys):
+        return np.array([self._index[k] for k in keys], dtype=np.int32)
+
+    def lookup(self, idx):
+        """Reverse lookup of an index to its string id."""
+        return self._ids[idx]
+
+    def lookup_many(self, idxs):
+        return [self._ids[i] for i in idxs]
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __len__(self):
+        return len(self._ids)
+
+
+def sorted_contains(sorted_idxs, idx):
+    """Membership test on a sorted array of indexes."""
+    pos = np.searchsorted(sorted_idxs, idx)
+    return bool(pos < len(sorted_idxs) and sorted_idxs[pos] == idx)
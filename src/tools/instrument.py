@@ -0,0 +1,217 @@
+"""
+Opt-in timers and counters for the trust pipeline.
+
+Nothing is recorded until enable() is called (or inside a session()).
+While disabled, timer() hands back one shared no-op context manager,
+count() returns after a single flag check and timed functions call
+straight through, so the hooks can stay in hot code.
+
+    with instrument.session('report.json', trace_memory=True):
+        yti.to_dataset(0, 1000)
+
+Timers add up calls and seconds per name. With trace_memory, tracemalloc
+runs for the session and every timer also records the largest increase
+in traced memory seen while it ran. report() returns everything as a
+dict, summary() as text.
+"""
+from contextlib import contextmanager
+from functools import wraps
+import json
+import time
+import tracemalloc
+
+
+class _State:
+    enabled = False
+    trace_memory = False
+    timers = {}
+    counters = {}
+    started = None
+    stopped = None
+    # Timers running under trace_memory, outermost first.
+    memory_timers = []
+    peak_bytes = 0
+    memory = None
+    owns_tracing = False
+
+
+_state = _State()
+
+
+class _NoTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def _fold_peak():
+    # tracemalloc keeps a single peak, so it is handed to every running
+    # timer before an inner timer resets it.
+    peak = tracemalloc.get_traced_memory()[1]
+    for t in _state.memory_timers:
+        t._peak = max(t._peak, peak)
+    _state.peak_bytes = max(_state.peak_bytes, peak)
+
+
+class _Timer:
+    __slots__ = ('name', '_start', '_memory', '_peak')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        if _state.trace_memory:
+            _fold_peak()
+            tracemalloc.reset_peak()
+            self._memory = self._peak = tracemalloc.get_traced_memory()[0]
+            _state.memory_timers.append(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self._start
+        entry = _state.timers.get(self.name)
+        if entry is None:
+            entry = _state.timers[self.name] = {'calls': 0, 'seconds': 0.0}
+        entry['calls'] += 1
+        entry['seconds'] += seconds
+        if _state.trace_memory and self in _state.memory_timers:
+            _fold_peak()
+            _state.memory_timers.remove(self)
+            entry['peak_bytes'] = max(entry.get('peak_bytes', 0), self._peak - self._memory)
+        return False
+
+
+def enabled():
+    return _state.enabled
+
+
+def enable(trace_memory=False):
+    """Start recording. trace_memory also starts tracemalloc, which slows
+    down allocation heavy code considerably."""
+    _state.enabled = True
+    _state.trace_memory = trace_memory
+    _state.stopped = None
+    if _state.started is None:
+        _state.started = time.perf_counter()
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _state.owns_tracing = True
+
+
+def disable():
+    """Stop recording. What was recorded is kept until reset()."""
+    _state.enabled = False
+    _state.stopped = time.perf_counter()
+    if _state.trace_memory:
+        _fold_peak()
+        _state.memory = (tracemalloc.get_traced_memory()[0], _state.peak_bytes)
+        if _state.owns_tracing:
+            tracemalloc.stop()
+            _state.owns_tracing = False
+    _state.trace_memory = False
+    _state.memory_timers = []
+
+
+def reset():
+    _state.timers = {}
+    _state.counters = {}
+    _state.started = time.perf_counter() if _state.enabled else None
+    _state.stopped = None
+    _state.peak_bytes = 0
+    _state.memory = None
+
+
+def timer(name):
+    """A context manager adding the time spent in it to the timer name"""
+    if not _state.enabled:
+        return _NO_TIMER
+    return _Timer(name)
+
+
+def count(name, n=1):
+    """Add n to the counter name"""
+    if _state.enabled:
+        _state.counters[name] = _state.counters.get(name, 0) + n
+
+
+def timed(name):
+    """Decorator timing every call of a function under name"""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return f(*args, **kwargs)
+            with _Timer(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    """Everything recorded since the last reset() as a json-able dict"""
+    result = {
+        'timers': {name: dict(entry) for name, entry in sorted(_state.timers.items())},
+        'counters': dict(sorted(_state.counters.items())),
+    }
+    if _state.started is not None:
+        result['wall_seconds'] = (_state.stopped or time.perf_counter()) - _state.started
+    memory = _state.memory
+    if _state.trace_memory:
+        _fold_peak()
+        memory = (tracemalloc.get_traced_memory()[0], _state.peak_bytes)
+    if memory:
+        result['memory'] = {'current_bytes': memory[0], 'peak_bytes': memory[1]}
+    return result
+
+
+def summary(rep=None):
+    """report() as an aligned text table, slowest timers first"""
+    rep = rep or report()
+    lines = []
+    if 'wall_seconds' in rep:
+        lines.append(f"wall time {rep['wall_seconds']:.3f} s")
+    if 'memory' in rep:
+        lines.append(f"peak traced memory {rep['memory']['peak_bytes'] / 2 ** 20:.1f} MiB")
+    if rep['timers']:
+        lines.append(f"{'timer':40s} {'calls':>10s} {'seconds':>10s} {'us/call':>10s} {'peak MiB':>9s}")
+        for name, entry in sorted(rep['timers'].items(), key=lambda kv: -kv[1]['seconds']):
+            peak = entry.get('peak_bytes')
+            lines.append(f"{name:40s} {entry['calls']:10d} {entry['seconds']:10.4f} "
+                         f"{1e6 * entry['seconds'] / entry['calls']:10.2f} "
+                         f"{'' if peak is None else f'{peak / 2 ** 20:9.1f}'}")
+    if rep['counters']:
+        lines.append(f"{'counter':40s} {'count':>10s}")
+        for name, value in rep['counters'].items():
+            lines.append(f"{name:40s} {value:10d}")
+    return '\n'.join(lines)
+
+
+def write_report(file_path):
+    """Write report() to file_path as json"""
+    with open(file_path, 'w') as f:
+        json.dump(report(), f, indent=2)
+
+
+@contextmanager
+def session(report_path=None, trace_memory=False, print_summary=True):
+    """Record everything run inside the with block.
+
+    Clears what was recorded before, writes the json report to
+    report_path if given and prints the summary at the end.
+    """
+    reset()
+    enable(trace_memory)
+    try:
+        yield
+    finally:
+        disable()
+        if report_path:
+            write_report(report_path)
+        if print_summary:
+            print(summary())
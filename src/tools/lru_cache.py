@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+from tools import instrument
+
+
+class LRUCache:
+    """A dict-like cache that evicts the least recently used entry.
+
+    Entries are evicted once there are more than maxsize of them, or once
+    their sizes add up to more than maxbytes. Counts hits and misses so
+    callers can report how well it works, and passes them on to
+    tools.instrument when it has a name.
+    """
+
+    def __init__(self, maxsize=None, maxbytes=None, sizeof=None, name=None):
+        """sizeof: f(value) -> bytes, needed with maxbytes.
+        name: the instrument counters are name.hit and name.miss.
+        """
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._hit_counter = f'{name}.hit' if name else None
+        self._miss_counter = f'{name}.miss' if name else None
+
+    def get(self, key, default=None):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            if self._hit_counter:
+                instrument.count(self._hit_counter)
+            return self._entries[key]
+        self.misses += 1
+        if self._miss_counter:
+            instrument.count(self._miss_counter)
+        return default
+
+    def put(self, key, value):
+        self.pop(key)
+        self._entries[key] = value
+        if self.maxbytes is not None:
+            self._sizes[key] = self._sizeof(value)
+            self.nbytes += self._sizes[key]
+        # The newest entry is kept even if it alone is over maxbytes.
+        while len(self._entries) > 1 and self._over_budget():
+            self.pop(next(iter(self._entries)))
+
+    def _over_budget(self):
+        return ((self.maxsize is not None and len(self._entries) > self.maxsize) or
+                (self.maxbytes is not None and self.nbytes > self.maxbytes))
+
+    def pop(self, key, default=None):
+        self.nbytes -= self._sizes.pop(key, 0)
+        return self._entries.pop(key, default)
+
+    def clear(self):
+        self._entries.clear()
+        self._sizes.clear()
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,148 @@
+"""
+Process pool engine for the upper-triangle pair loops.
+
+The pair space i1 < i2 of a user range is cut into contiguous runs of i1
+rows ("tiles") holding about the same number of pairs, and the tiles are
+sent to a process pool. Read-only inputs (numpy arrays and CSR matrices)
+are copied once into shared memory and attached by every worker, so
+nothing large is pickled per task. Workers can also write their rows
+straight into a shared output array at the tile's row offset.
+"""
+from os import cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+from scipy import sparse
+
+# Tiles per worker, so a slow tile does not hold up the whole pool.
+TILES_PER_WORKER = 4
+
+# Set in each worker by _init_worker.
+_arrays = None
+_blocks = None
+
+
+class SharedArrays:
+    """A set of named arrays and CSR matrices held in shared memory."""
+
+    def __init__(self):
+        self.specs = {}
+        self._blocks = []
+
+    def _alloc(self, shape, dtype):
+        dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(shape)) * dtype.itemsize)
+        block = shared_memory.SharedMemory(create=True, size=size)
+        self._blocks.append(block)
+        spec = (block.name, tuple(shape), dtype.str)
+        return spec, np.ndarray(shape, dtype=dtype, buffer=block.buf)
+
+    def add(self, name, value):
+        """Copy an array or a CSR matrix into shared memory under name."""
+        if sparse.issparse(value):
+            value = sparse.csr_matrix(value)
+            parts = {}
+            for part in ('data', 'indices', 'indptr'):
+                spec, view = self._alloc(getattr(value, part).shape,
+                                         getattr(value, part).dtype)
+                view[:] = getattr(value, part)
+                parts[part] = spec
+            self.specs[name] = ('csr', parts, value.shape)
+        else:
+            value = np.asarray(value)
+            spec, view = self._alloc(value.shape, value.dtype)
+            view[...] = value
+            self.specs[name] = ('array', spec)
+
+    def empty(self, name, shape, dtype):
+        """Allocate a shared output array under name and return a view of it."""
+        spec, view = self._alloc(shape, dtype)
+        self.specs[name] = ('array', spec)
+        return view
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _attach_block(spec, blocks):
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    blocks.append(block)
+    return np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+
+
+def attach(specs):
+    """Rebuild the arrays described by SharedArrays.specs in this process."""
+    arrays, blocks = {}, []
+    for name, spec in specs.items():
+        if spec[0] == 'csr':
+            _, parts, shape = spec
+            data, indices, indptr = (_attach_block(parts[p], blocks)
+                                     for p in ('data', 'indices', 'indptr'))
+            arrays[name] = sparse.csr_matrix((data, indices, indptr),
+                                             shape=shape, copy=False)
+        else:
+            arrays[name] = _attach_block(spec[1], blocks)
+    return arrays, blocks
+
+
+def _init_worker(specs):
+    global _arrays, _blocks
+    _arrays, _blocks = attach(specs)
+
+
+def worker_arrays():
+    """The shared arrays, as seen from inside a worker."""
+    return _arrays
+
+
+def pair_count(start, stop):
+    n = stop - start
+    return n * (n - 1) // 2
+
+
+def balanced_tiles(start, stop, num_tiles):
+    """Split rows i1 in [start, stop) into runs with about equal pair counts.
+
+    Returns a list of (first_i1, last_i1 + 1, row_offset) where row_offset
+    is the number of pairs that come before the tile in to_dataset order.
+    """
+    row_pairs = stop - 1 - np.arange(start, stop)
+    ends = np.cumsum(row_pairs)
+    total = ends[-1] if len(ends) else 0
+    targets = total * np.arange(1, num_tiles) / num_tiles
+    cuts = np.unique(np.searchsorted(ends, targets) + 1 + start)
+    bounds = [start] + [c for c in cuts.tolist() if start < c < stop] + [stop]
+
+    tiles = []
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        offset = pair_count(start, stop) - pair_count(lo, stop)
+        if pair_count(lo, stop) - pair_count(hi, stop) > 0:
+            tiles.append((lo, hi, offset))
+    return tiles
+
+
+def run_tiles(fn, shared, tiles, workers=None, args=()):
+    """Call fn(tile, *args) for every tile in a pool attached to shared.
+
+    Results are returned in tile order.
+    """
+    workers = workers or cpu_count()
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(shared.specs,)) as pool:
+        futures = [pool.submit(fn, tile, *args) for tile in tiles]
+        return [f.result() for f in futures]
+
+
+def num_tiles(workers=None):
+    return (workers or cpu_count()) * TILES_PER_WORKER
@@ -0,0 +1,140 @@
+"""
+Per-item and per-user rating statistics, held as numpy arrays.
+
+Everything is computed once with grouped numpy operations, so lookups
+are array indexing and the memory used is fixed by the number of users
+and items. Call RatingStats.update with the items and users that changed
+after new reviews arrive, or RatingStats.rebuild to start over.
+"""
+import numpy as np
+
+# Stars are half-integer values from 1 to 5, one histogram bin each.
+MIN_STARS = 1
+NUM_STAR_BINS = 9
+
+
+def star_bins(stars):
+    """Histogram bin of each star value: 1 -> 0, 1.5 -> 1, ..., 5 -> 8"""
+    bins = (np.asarray(stars, dtype=np.float64) - MIN_STARS) * 2
+    if not np.all((bins == np.round(bins)) & (bins >= 0) & (bins < NUM_STAR_BINS)):
+        raise Exception("Stars must be half-integer values from 1 to 5")
+    return bins.astype(np.int64)
+
+
+def _group_stats(groups, stars, num_groups):
+    """count, mean, variance and star histogram of stars grouped by index"""
+    count = np.bincount(groups, minlength=num_groups).astype(np.int64)
+    total = np.bincount(groups, weights=stars, minlength=num_groups)
+    total_sq = np.bincount(groups, weights=stars ** 2, minlength=num_groups)
+    mean = np.divide(total, count, out=np.zeros(num_groups), where=count > 0)
+    mean_sq = np.divide(total_sq, count, out=np.zeros(num_groups), where=count > 0)
+    var = np.maximum(mean_sq - mean ** 2, 0)
+    hist = np.zeros((num_groups, NUM_STAR_BINS), dtype=np.int32)
+    np.add.at(hist, (groups, star_bins(stars)), 1)
+    return count, mean, var, hist
+
+
+class RatingStats:
+    """Item and user rating statistics keyed by item_idx and user_idx.
+
+    Item statistics cover every review of the item (duplicates included,
+    as reviews_by_item). User statistics cover each user's deduplicated
+    ratings, i.e. the rows of the rating matrix. Nothing is recomputed
+    until update() or rebuild() is called.
+    """
+
+    def __init__(self, reviews_by_item, rating_matrix):
+        """reviews_by_item: reviews indexed by item_idx.
+        rating_matrix: the CSR user x item matrix of latest ratings.
+        """
+        self._reviews_by_item = reviews_by_item
+        self._rating_matrix = rating_matrix
+        self.rebuild()
+
+    def rebuild(self, reviews_by_item=None, rating_matrix=None):
+        """Recompute every statistic, optionally from new data."""
+        if reviews_by_item is not None:
+            self._reviews_by_item = reviews_by_item
+        if rating_matrix is not None:
+            self._rating_matrix = rating_matrix
+
+        if hasattr(self._reviews_by_item, 'flat'):
+            # ReviewGroups hands over its columns without making views.
+            items, stars = self._reviews_by_item.flat('stars')
+        else:
+            items, stars = [], []
+            for item_idx, reviews in enumerate(self._reviews_by_item):
+                items.extend([item_idx] * len(reviews))
+                stars.extend(r['stars'] for r in reviews)
+        (self.item_count, self.item_mean,
+         self.item_var, self.item_hist) = _group_stats(
+            np.array(items, dtype=np.int64), np.array(stars, dtype=np.float64),
+            len(self._reviews_by_item))
+
+        R = self._rating_matrix
+        users = np.repeat(np.arange(R.shape[0]), np.diff(R.indptr))
+        (self.user_count, self.user_mean,
+         self.user_var, self.user_hist) = _group_stats(
+            users, np.asarray(R.data, dtype=np.float64), R.shape[0])
+
+    def update(self, item_idxs, users):
+        """Recompute the statistics of some items and users only.
+
+        item_idxs: item_idx values whose reviews changed. Their rows are
+        recomputed from reviews_by_item, which may have grown.
+        users: hydrated users whose reviews changed. Their rows are
+        recomputed from their deduplicated reviews.
+        The arrays grow to fit new items and users. rebuild() afterwards
+        needs the new rating matrix passed in.
+        """
+        num_items = len(self._reviews_by_item)
+        num_users = max([self.num_users] + [u['user_idx'] + 1 for u in users])
+        for prefix, size in (('item', num_items), ('user', num_users)):
+            for name in ('count', 'mean', 'var', 'hist'):
+                array = getattr(self, f'{prefix}_{name}')
+                if len(array) < size:
+                    grown = np.zeros((size,) + array.shape[1:], dtype=array.dtype)
+                    grown[:len(array)] = array
+                    setattr(self, f'{prefix}_{name}', grown)
+
+        item_idxs = np.asarray(item_idxs, dtype=np.int64)
+        items = [self._reviews_by_item[i] for i in item_idxs]
+        self._set_rows('item', item_idxs, items)
+        user_idxs = np.array([u['user_idx'] for u in users], dtype=np.int64)
+        self._set_rows('user', user_idxs, [u['reviews'].review_list for u in users])
+
+    def _set_rows(self, prefix, idxs, review_lists):
+        groups = np.repeat(np.arange(len(idxs)), [len(r) for r in review_lists])
+        # A ReviewList hands over its stars column without making views.
+        stars = np.concatenate([np.zeros(0)] + [
+            np.asarray(reviews.column('stars') if hasattr(reviews, 'column')
+                       else [r['stars'] for r in reviews], dtype=np.float64)
+            for reviews in review_lists])
+        stats = _group_stats(groups, stars, len(idxs))
+        for name, rows in zip(('count', 'mean', 'var', 'hist'), stats):
+            getattr(self, f'{prefix}_{name}')[idxs] = rows
+
+    @property
+    def num_users(self):
+        return len(self.user_mean)
+
+    @property
+    def num_items(self):
+        return len(self.item_mean)
+
+    def _arrays(self):
+        return {name: getattr(self, name) for name in (
+            'item_count', 'item_mean', 'item_var', 'item_hist',
+            'user_count', 'user_mean', 'user_var', 'user_hist')}
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays().values())
+
+    def memory_report(self):
+        lines = [f"RatingStats: {self.num_items} items, {self.num_users} users, "
+                 f"{self.nbytes / 2 ** 20:.2f} MiB"]
+        for name, array in self._arrays().items():
+            lines.append(f"  {name}: {array.dtype} {array.shape} "
+                         f"{array.nbytes / 2 ** 20:.2f} MiB")
+        return "\n".join(lines)
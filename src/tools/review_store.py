@@ -0,0 +1,314 @@
+"""
+Compact storage for reviews as parallel typed columns.
+
+A review dict costs close to a kilobyte, most of it key strings and
+boxed numbers. ReviewStore keeps one numpy column per field instead:
+int32 user and item indexes, float32 stars, uint16 vote counts and the
+date as int32 seconds since DATE_EPOCH. Seconds rather than days, so two
+reviews of an item on one day still order by their time, as the date
+strings did when picking the latest one. Review is a two-slot view of one
+row that answers the same r['stars'] style lookups as the dicts did, so
+UserReviews, FangTrust and MauroTrust work on it unchanged. Views are
+made on access and nothing per review is kept.
+"""
+import numpy as np
+
+from tools import instrument
+
+# Dates are stored as seconds since this instant. int32 seconds reach 2072.
+DATE_EPOCH = np.datetime64('2004-01-01T00:00:00', 's')
+MAX_VOTES = np.iinfo(np.uint16).max
+
+COLUMNS = {
+    'user_idx': np.int32,
+    'item_idx': np.int32,
+    'stars': np.float32,
+    'useful': np.uint16,
+    'funny': np.uint16,
+    'cool': np.uint16,
+    'date': np.int32,
+}
+VOTE_COLUMNS = ('useful', 'funny', 'cool')
+
+
+def encode_dates(dates):
+    """Yelp date strings to int32 seconds since DATE_EPOCH"""
+    seconds = np.array(dates, dtype='datetime64[s]') - DATE_EPOCH
+    return seconds.astype(np.int64).astype(np.int32)
+
+
+def decode_date(seconds, date_only=False):
+    """int32 seconds since DATE_EPOCH to a Yelp date string.
+
+    The string is 'YYYY-MM-DD HH:MM:SS', or 'YYYY-MM-DD' if date_only is
+    set for dumps whose dates have no time.
+    """
+    date = str(DATE_EPOCH + np.timedelta64(int(seconds), 's'))
+    return date[:10] if date_only else date.replace('T', ' ')
+
+
+class Review:
+    """A read-only view of one row of a ReviewStore with dict style access."""
+
+    __slots__ = ('_store', 'row')
+
+    KEYS = ('review_id', 'user_id', 'business_id', 'user_idx', 'item_idx',
+            'stars', 'useful', 'funny', 'cool', 'date')
+
+    def __init__(self, store, row):
+        self._store = store
+        self.row = row
+
+    def __getitem__(self, key):
+        store, row = self._store, self.row
+        if key in COLUMNS:
+            value = store._columns[key][row]
+            if key == 'date':
+                return decode_date(value, store._date_only)
+            if key == 'stars':
+                return float(value)
+            return int(value)
+        elif key == 'review_id':
+            return store._review_id[row].decode()
+        elif key == 'user_id':
+            return store.user_ids.lookup(store._columns['user_idx'][row])
+        elif key == 'business_id':
+            return store.item_ids.lookup(store._columns['item_idx'][row])
+        elif key == 'business':
+            return store.business(store._columns['item_idx'][row])
+        elif key == 'text':
+            return ''
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.KEYS or key in ('business', 'text')
+
+    def keys(self):
+        return self.KEYS
+
+    def to_dict(self):
+        return {key: self[key] for key in self.KEYS}
+
+    def __eq__(self, other):
+        return (isinstance(other, Review) and other._store is self._store and
+                other.row == self.row)
+
+    def __hash__(self):
+        return hash((id(self._store), self.row))
+
+    def __repr__(self):
+        return f"Review({self.to_dict()})"
+
+
+class ReviewList:
+    """A sequence of Review views over some rows of a ReviewStore."""
+
+    __slots__ = ('_store', 'rows')
+
+    def __init__(self, store, rows):
+        self._store = store
+        self.rows = rows
+
+    def column(self, name):
+        """The values of one column for these rows"""
+        return getattr(self._store, name)[self.rows]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return ReviewList(self._store, self.rows[key])
+        return Review(self._store, int(self.rows[key]))
+
+    def __iter__(self):
+        store = self._store
+        return (Review(store, row) for row in self.rows.tolist())
+
+    def __len__(self):
+        return len(self.rows)
+
+
+class ReviewGroups:
+    """ReviewLists of a ReviewStore grouped by one index column.
+
+    reviews_by_item[item_idx] gives the item's reviews in the order they
+    were added, like the list of lists it replaces.
+    """
+
+    def __init__(self, store, key, registry):
+        self._store = store
+        self._key = key
+        self._registry = registry
+
+    def __getitem__(self, group):
+        indptr, order = self._store.grouping(self._key, len(self))
+        return ReviewList(self._store, order[indptr[group]:indptr[group + 1]])
+
+    def __iter__(self):
+        return (self[group] for group in range(len(self)))
+
+    def __len__(self):
+        return len(self._registry)
+
+    def flat(self, name):
+        """(group, value) arrays over every review, ordered by group."""
+        indptr, order = self._store.grouping(self._key, len(self))
+        return (getattr(self._store, self._key)[order],
+                getattr(self._store, name)[order])
+
+
+class ReviewStore:
+    """Reviews held as one typed numpy column per field.
+
+    Rows are appended with extend() and never move, so a row number
+    identifies a review for as long as the store lives.
+    """
+
+    def __init__(self, user_ids, item_ids, businesses=None):
+        """user_ids, item_ids: the IdRegistry instances used to intern ids.
+        businesses: an optional dict of business_id -> business, for
+        review['business'].
+        """
+        self.user_ids = user_ids
+        self.item_ids = item_ids
+        self._businesses = businesses or {}
+        self._size = 0
+        self._columns = {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        self._review_id = np.zeros(0, dtype='S22')
+        self._groupings = {}
+        # True while every date added was a bare 'YYYY-MM-DD', so they
+        # decode the way they were given. Once any date has a time, all of
+        # them decode with one.
+        self._date_only = None
+
+    def extend(self, reviews):
+        """Append review dicts, interning their user and business ids.
+
+        Returns the row numbers of the new reviews.
+        """
+        reviews = list(reviews)
+        start, stop = self._size, self._size + len(reviews)
+        self._reserve(stop)
+
+        columns = self._columns
+        columns['user_idx'][start:stop] = [self.user_ids.intern(r['user_id']) for r in reviews]
+        columns['item_idx'][start:stop] = [self.item_ids.intern(r['business_id']) for r in reviews]
+        columns['stars'][start:stop] = [r['stars'] for r in reviews]
+        for name in VOTE_COLUMNS:
+            columns[name][start:stop] = np.minimum([r.get(name, 0) for r in reviews], MAX_VOTES)
+        dates = [r['date'] for r in reviews]
+        columns['date'][start:stop] = encode_dates(dates)
+        if dates:
+            date_only = all(len(d) == 10 for d in dates)
+            self._date_only = date_only and self._date_only is not False
+
+        review_ids = np.array([r.get('review_id', '') for r in reviews], dtype='S')
+        if review_ids.dtype.itemsize > self._review_id.dtype.itemsize:
+            self._review_id = self._review_id.astype(review_ids.dtype)
+        self._review_id[start:stop] = review_ids
+
+        self._size = stop
+        return np.arange(start, stop)
+
+    def _reserve(self, size):
+        capacity = len(self._review_id)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity)
+        for name, column in self._columns.items():
+            grown = np.zeros(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+        grown = np.zeros(capacity, dtype=self._review_id.dtype)
+        grown[:self._size] = self._review_id[:self._size]
+        self._review_id = grown
+
+    def __getattr__(self, name):
+        # The columns, trimmed to the rows in use, e.g. store.stars.
+        columns = self.__dict__.get('_columns', {})
+        if name in columns:
+            return columns[name][:self._size]
+        raise AttributeError(name)
+
+    @property
+    def review_id(self):
+        return self._review_id[:self._size]
+
+    def business(self, item_idx):
+        return self._businesses[self.item_ids.lookup(item_idx)]
+
+    def grouping(self, key, num_groups):
+        """(indptr, order): rows of group g are order[indptr[g]:indptr[g + 1]].
+
+        Rows keep the order they were added in within a group. Rows added
+        since the last call are sorted on their own and merged in, so
+        keeping a grouping up to date costs a sort of the new rows only.
+        """
+        cached = self._groupings.get(key)
+        if cached is None:
+            values = getattr(self, key)
+            instrument.count('review_store.grouping.sorted_rows', len(values))
+            order = np.argsort(values, kind='stable')
+            counts = np.bincount(values, minlength=num_groups)
+            cached = (np.concatenate([[0], np.cumsum(counts)]), order, self._size)
+        elif cached[2] < self._size or len(cached[0]) < num_groups + 1:
+            indptr, order, num_rows = cached
+            values = getattr(self, key)[num_rows:]
+            instrument.count('review_store.grouping.sorted_rows', len(values))
+            new_order = np.argsort(values, kind='stable')
+            counts = np.bincount(values, minlength=max(num_groups, len(indptr) - 1))
+            indptr = np.concatenate([indptr, np.full(len(counts) + 1 - len(indptr), indptr[-1])])
+            # Every new row goes after the old rows of its group.
+            order = np.insert(order, indptr[values[new_order] + 1],
+                              num_rows + new_order)
+            indptr = indptr + np.concatenate([[0], np.cumsum(counts)])
+            cached = (indptr, order, self._size)
+        self._groupings[key] = cached
+        return cached[:2]
+
+    def latest_by_user(self, user_idxs):
+        """(indptr, item_idx, stars) of the latest review per item of each user.
+
+        Segment k, [indptr[k], indptr[k + 1]), holds the reviews of
+        user_idxs[k] sorted by item_idx and deduplicated like UserReviews:
+        the latest date wins and the first one added wins a tie. Read
+        straight from the columns, without making any views.
+        """
+        indptr, order = self.grouping('user_idx', len(self.user_ids))
+        user_idxs = np.asarray(user_idxs, dtype=np.int64)
+        starts = indptr[user_idxs]
+        lengths = indptr[user_idxs + 1] - starts
+        segment = np.repeat(np.arange(len(user_idxs)), lengths)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        rows = order[np.arange(len(segment)) + offsets]
+
+        items = self.item_idx[rows]
+        sort = np.lexsort((rows, -self.date[rows].astype(np.int64), items, segment))
+        segment, items, rows = segment[sort], items[sort], rows[sort]
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = (segment[1:] != segment[:-1]) | (items[1:] != items[:-1])
+        counts = np.bincount(segment[first], minlength=len(user_idxs))
+        return (np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+                items[first].astype(np.int64), self.stars[rows[first]].astype(np.float64))
+
+    def by_user(self, user_idx):
+        """The ReviewList of one user, in the order added"""
+        indptr, order = self.grouping('user_idx', len(self.user_ids))
+        return ReviewList(self, order[indptr[user_idx]:indptr[user_idx + 1]])
+
+    def __getitem__(self, row):
+        return Review(self, row)
+
+    def __iter__(self):
+        return (Review(self, row) for row in range(self._size))
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def nbytes(self):
+        return (sum(c.nbytes for c in self._columns.values()) + self._review_id.nbytes)
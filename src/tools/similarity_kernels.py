@@ -0,0 +1,153 @@
+"""
+Array kernels for rating similarity: PCC, cosine, adjusted cosine,
+Spearman and significance weighted PCC.
+
+Every kernel takes its inputs in one of three layouts:
+
+- 1-D arrays: one pair of rating vectors, gives a float.
+- 2-D arrays: one pair per row, padded with NaN; a position that is NaN
+  in any input is left out. Gives one value per row.
+- 1-D arrays with indptr: ragged segments laid end to end, segment k
+  being [indptr[k], indptr[k + 1]) like the rows of a CSR matrix.
+  Gives one value per segment.
+
+A similarity whose denominator is 0 (no shared items, or no variance in
+one of the vectors) is 0, for every kernel and backend.
+
+PCC and cosine run as compiled loops when numba is installed and as
+numpy segment sums otherwise; BACKEND says which.
+"""
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+BACKEND = 'numba' if numba is not None else 'numpy'
+# Shared items at which significance_pcc stops discounting (Herlocker et al).
+SIGNIFICANCE_THRESHOLD = 50
+
+
+def _segments(arrays, indptr):
+    """(flat float64 arrays, indptr, shape) of any of the three layouts.
+
+    shape is None for a single pair, else the number of results.
+    """
+    arrays = [np.asarray(a, dtype=np.float64) for a in arrays]
+    lengths = set(a.shape for a in arrays)
+    if len(lengths) != 1:
+        raise ValueError(f"Similarity inputs must have the same shape, got {sorted(lengths)}")
+    first = arrays[0]
+    if indptr is not None:
+        return arrays, np.asarray(indptr, dtype=np.int64), len(indptr) - 1
+    if first.ndim == 1:
+        return arrays, np.array([0, len(first)], dtype=np.int64), None
+    if first.ndim == 2:
+        keep = np.ones(first.shape, dtype=bool)
+        for a in arrays:
+            keep &= ~np.isnan(a)
+        indptr = np.concatenate([[0], np.cumsum(keep.sum(axis=1))])
+        return [a[keep] for a in arrays], indptr, len(first)
+    raise ValueError(f"Similarity inputs must be 1-D or 2-D, got {first.ndim}-D")
+
+
+def _result(values, shape):
+    return float(values[0]) if shape is None else values
+
+
+def _ratio(numer, denom1, denom2):
+    denom = np.sqrt(denom1 * denom2)
+    return np.divide(numer, denom, out=np.zeros(len(numer)), where=denom > 0)
+
+
+def _segment_sums(values, indptr):
+    sums = np.zeros(len(indptr) - 1)
+    nonempty = indptr[1:] > indptr[:-1]
+    if len(values):
+        sums[nonempty] = np.add.reduceat(values, indptr[:-1][nonempty])
+    return sums
+
+
+def _dot_ratio_numpy(x, y, indptr):
+    return _ratio(_segment_sums(x * y, indptr), _segment_sums(x * x, indptr),
+                  _segment_sums(y * y, indptr))
+
+
+def _dot_ratio_loop(x, y, indptr):
+    out = np.zeros(len(indptr) - 1)
+    for k in range(len(indptr) - 1):
+        numer = 0.0
+        denom1 = 0.0
+        denom2 = 0.0
+        for i in range(indptr[k], indptr[k + 1]):
+            numer += x[i] * y[i]
+            denom1 += x[i] * x[i]
+            denom2 += y[i] * y[i]
+        denom = np.sqrt(denom1 * denom2)
+        if denom > 0:
+            out[k] = numer / denom
+    return out
+
+
+if numba is not None:
+    _dot_ratio = numba.njit(cache=True)(_dot_ratio_loop)
+else:
+    _dot_ratio = _dot_ratio_numpy
+
+
+def pcc(scores1, avgs1, scores2, avgs2, indptr=None):
+    """Pearson correlation of scores1 - avgs1 and scores2 - avgs2.
+
+    The averages are per element, so the same kernel covers the OVERALL,
+    ITEM and USER modes of UserReviews.get_avgs.
+    """
+    (s1, a1, s2, a2), indptr, shape = _segments((scores1, avgs1, scores2, avgs2), indptr)
+    return _result(_dot_ratio(s1 - a1, s2 - a2, indptr), shape)
+
+
+def cos(scores1, scores2, indptr=None):
+    """Cosine similarity of two rating vectors"""
+    (s1, s2), indptr, shape = _segments((scores1, scores2), indptr)
+    return _result(_dot_ratio(s1, s2, indptr), shape)
+
+
+def adjusted_cos(scores1, scores2, item_avgs, indptr=None):
+    """Cosine similarity after subtracting each item's average rating"""
+    (s1, s2, a), indptr, shape = _segments((scores1, scores2, item_avgs), indptr)
+    return _result(_dot_ratio(s1 - a, s2 - a, indptr), shape)
+
+
+def _ranks(values, indptr):
+    """1-based ranks of values within each segment, ties getting their average rank"""
+    segment = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    order = np.lexsort((values, segment))
+    sorted_values, sorted_segment = values[order], segment[order]
+    # Runs of equal values within a segment.
+    starts = np.ones(len(values), dtype=bool)
+    starts[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_segment[1:] != sorted_segment[:-1])
+    run = np.cumsum(starts) - 1
+    run_starts = np.flatnonzero(starts)
+    run_ends = np.append(run_starts[1:], len(values))
+    positions = (run_starts + run_ends - 1) / 2 - indptr[sorted_segment[run_starts]]
+    ranks = np.empty(len(values))
+    ranks[order] = positions[run] + 1
+    return ranks
+
+
+def spearman(scores1, scores2, indptr=None):
+    """Spearman rank correlation: the PCC of the ranks within each pair"""
+    (s1, s2), indptr, shape = _segments((scores1, scores2), indptr)
+    r1, r2 = _ranks(s1, indptr), _ranks(s2, indptr)
+    lengths = np.diff(indptr)
+    mean_rank = np.repeat((lengths + 1) / 2, lengths)
+    return _result(_dot_ratio(r1 - mean_rank, r2 - mean_rank, indptr), shape)
+
+
+def significance_pcc(scores1, avgs1, scores2, avgs2, indptr=None,
+                     threshold=SIGNIFICANCE_THRESHOLD):
+    """pcc scaled by min(n, threshold) / threshold for n shared items,
+    so correlations over a few items count for less."""
+    (s1, a1, s2, a2), indptr, shape = _segments((scores1, avgs1, scores2, avgs2), indptr)
+    weights = np.minimum(np.diff(indptr), threshold) / threshold
+    return _result(_dot_ratio(s1 - a1, s2 - a2, indptr) * weights, shape)
@@ -0,0 +1,235 @@
+"""
+Batch review similarity over a sparse user x item rating matrix.
+
+These compute the same values as review_similarity.review_pcc and
+review_cos, but for one user against many, for a whole block of users
+or for arrays of pairs at once, using sparse matrix products.
+
+For users u and v, with C the matrix of centered ratings and B the
+0/1 matrix of which items were rated, the PCC over their shared items is
+    (C[u] . C[v]) / sqrt((C[u]^2 . B[v]) * (B[u] . C[v]^2))
+since multiplying by B[v] restricts a sum to the items v also rated.
+Cosine is the same with raw ratings in place of C.
+"""
+import numpy as np
+from scipy import sparse
+
+from tools.user_reviews import UserReviews
+
+
+def build_rating_matrix(reviews, num_users, num_items):
+    """Build a CSR user x item matrix of the latest rating per pair.
+
+    reviews: an iterable of reviews carrying user_idx, item_idx, stars and date.
+    Duplicates are resolved like UserReviews._remove_dupes: the review with
+    the latest date wins, and the first one seen wins a tie.
+    """
+    users, items, stars, dates = [], [], [], []
+    for r in reviews:
+        users.append(r['user_idx'])
+        items.append(r['item_idx'])
+        stars.append(r['stars'])
+        dates.append(r['date'])
+    return rating_matrix_from_columns(
+        users, items, stars, np.array(dates, dtype='datetime64[s]').astype(np.int64),
+        num_users, num_items)
+
+
+def rating_matrix_from_columns(users, items, stars, dates, num_users, num_items):
+    """build_rating_matrix from parallel arrays, e.g. the columns of a ReviewStore.
+
+    dates: any integer encoding of the review dates that sorts like them.
+    """
+    users = np.asarray(users, dtype=np.int32)
+    items = np.asarray(items, dtype=np.int32)
+    stars = np.asarray(stars, dtype=np.float64)
+    dates = np.asarray(dates, dtype=np.int64)
+    order = np.arange(len(users))
+
+    # Group by (user, item), newest first, then in order seen.
+    sort = np.lexsort((order, -dates, items, users))
+    users, items, stars = users[sort], items[sort], stars[sort]
+    first = np.ones(len(users), dtype=bool)
+    first[1:] = (users[1:] != users[:-1]) | (items[1:] != items[:-1])
+
+    return sparse.csr_matrix((stars[first], (users[first], items[first])),
+                             shape=(num_users, num_items))
+
+
+def replace_rows(M, rows, new_rows, shape):
+    """A CSR matrix of the given shape holding M with some rows swapped out.
+
+    rows: unique row indexes; row rows[k] becomes row k of the CSR new_rows.
+    M may have fewer rows and columns than shape. Entries are moved by
+    their positions, so this costs a copy of M and no sorting.
+    """
+    num_rows = shape[0]
+    rows = np.asarray(rows, dtype=np.int64)
+    old_counts = np.zeros(num_rows, dtype=np.int64)
+    old_counts[:M.shape[0]] = np.diff(M.indptr)
+    counts = old_counts.copy()
+    counts[rows] = np.diff(new_rows.indptr)
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    indices = np.empty(indptr[-1], dtype=np.int32)
+    data = np.empty(indptr[-1], dtype=np.result_type(M.data, new_rows.data))
+
+    replaced = np.zeros(num_rows, dtype=bool)
+    replaced[rows] = True
+    entry_rows = np.repeat(np.arange(M.shape[0]), np.diff(M.indptr))
+    kept = np.flatnonzero(~replaced[entry_rows])
+    positions = indptr[entry_rows[kept]] + kept - M.indptr[entry_rows[kept]]
+    indices[positions] = M.indices[kept]
+    data[positions] = M.data[kept]
+
+    new_counts = np.diff(new_rows.indptr)
+    new_entry_rows = np.repeat(np.arange(len(rows)), new_counts)
+    positions = (indptr[rows[new_entry_rows]] + np.arange(len(new_entry_rows)) -
+                 new_rows.indptr[new_entry_rows])
+    indices[positions] = new_rows.indices
+    data[positions] = new_rows.data
+    return sparse.csr_matrix((data, indices, indptr), shape=shape)
+
+
+def _indicator(R):
+    B = R.copy()
+    B.data[:] = 1
+    return B
+
+
+def centered(R, avg_mode='OVERALL', item_avgs=None):
+    """Return a copy of R with the matching average subtracted from each rating.
+
+    avg_mode is one of UserReviews.AVG_MODES. ITEM needs item_avgs, the
+    average rating of every item (RatingStats.item_mean).
+    USER uses each user's average over their deduplicated ratings.
+    """
+    R = sparse.csr_matrix(R, dtype=np.float64, copy=True)
+    if avg_mode == "OVERALL":
+        R.data -= UserReviews.AVG_REVIEW_SCORE
+    elif avg_mode == "ITEM":
+        if item_avgs is None:
+            raise Exception("'item_avgs' is required for avg_mode ITEM")
+        R.data -= np.asarray(item_avgs)[R.indices]
+    elif avg_mode == "USER":
+        counts = np.diff(R.indptr)
+        sums = np.asarray(R.sum(axis=1)).ravel()
+        user_avgs = np.divide(sums, counts, out=np.zeros(len(sums)),
+                              where=counts > 0)
+        R.data -= np.repeat(user_avgs, counts)
+    else:
+        modes = ", ".join(UserReviews.AVG_MODES)
+        msg = f"'avg_mode' must be in {modes}"
+        raise Exception(msg)
+    return R
+
+
+def _ratio(numer, denom1, denom2):
+    numer = np.asarray(numer, dtype=np.float64)
+    denom = np.sqrt(np.asarray(denom1) * np.asarray(denom2))
+    return np.divide(numer, denom, out=np.zeros(numer.shape), where=denom > 0)
+
+
+def _one_to_many(C, B, user, others):
+    others = np.asarray(others)
+    C2 = C.multiply(C).tocsr()
+    numer = (C[others] @ C[user].T).toarray().ravel()
+    denom1 = (B[others] @ C2[user].T).toarray().ravel()
+    denom2 = (C2[others] @ B[user].T).toarray().ravel()
+    return _ratio(numer, denom1, denom2)
+
+
+def _block(C, B, users):
+    users = np.asarray(users)
+    Cu, Bu = C[users], B[users]
+    C2u = Cu.multiply(Cu).tocsr()
+    numer = (Cu @ Cu.T).toarray()
+    denom1 = (C2u @ Bu.T).toarray()
+    return _ratio(numer, denom1, denom1.T)
+
+
+def _pairs(C, C2, B, us, vs):
+    us, vs = np.asarray(us), np.asarray(vs)
+    numer = np.asarray(C[us].multiply(C[vs]).sum(axis=1)).ravel()
+    denom1 = np.asarray(C2[us].multiply(B[vs]).sum(axis=1)).ravel()
+    denom2 = np.asarray(B[us].multiply(C2[vs]).sum(axis=1)).ravel()
+    return _ratio(numer, denom1, denom2)
+
+
+def pcc_one_to_many(R, user, others, avg_mode='OVERALL', item_avgs=None):
+    """PCC between row `user` of R and each row in `others`"""
+    return _one_to_many(centered(R, avg_mode, item_avgs), _indicator(R),
+                        user, others)
+
+
+def cos_one_to_many(R, user, others):
+    """Cosine similarity between row `user` of R and each row in `others`"""
+    return _one_to_many(R, _indicator(R), user, others)
+
+
+def pcc_block(R, users, avg_mode='OVERALL', item_avgs=None):
+    """Dense len(users) x len(users) matrix of PCC between the given rows"""
+    return _block(centered(R, avg_mode, item_avgs), _indicator(R), users)
+
+
+def cos_block(R, users):
+    """Dense len(users) x len(users) matrix of cosine between the given rows"""
+    return _block(R, _indicator(R), users)
+
+
+def pcc_pairs(R, us, vs, avg_mode='OVERALL', item_avgs=None):
+    """PCC between rows us[k] and vs[k] for every k"""
+    return PairSimilarity(R, avg_mode, item_avgs).pcc(us, vs)
+
+
+def cos_pairs(R, us, vs):
+    """Cosine similarity between rows us[k] and vs[k] for every k"""
+    return PairSimilarity(R).cos(us, vs)
+
+
+class PairSimilarity:
+    """pcc_pairs and cos_pairs with the derived matrices built once.
+
+    Use this when scoring many batches of pairs against the same R.
+    """
+
+    MATRICES = ('R', 'R2', 'B', 'C', 'C2')
+
+    def __init__(self, R, avg_mode='OVERALL', item_avgs=None):
+        self._R = sparse.csr_matrix(R, dtype=np.float64)
+        self._R2 = self._R.multiply(self._R).tocsr()
+        self._B = _indicator(self._R)
+        self._C = centered(self._R, avg_mode, item_avgs)
+        self._C2 = self._C.multiply(self._C).tocsr()
+
+    def matrices(self):
+        """The derived matrices, keyed by the names in MATRICES"""
+        return {name: getattr(self, f'_{name}') for name in self.MATRICES}
+
+    @classmethod
+    def from_matrices(cls, matrices):
+        """Rebuild a PairSimilarity from the output of matrices()"""
+        similarity = cls.__new__(cls)
+        for name in cls.MATRICES:
+            setattr(similarity, f'_{name}', matrices[name])
+        return similarity
+
+    def update_rows(self, R, rows, avg_mode='OVERALL'):
+        """Rebuild the rows of users whose ratings changed from the new R.
+
+        The other rows are kept, which is only right when their averages
+        did not move: ITEM averages change with any new rating of an item,
+        so a new PairSimilarity is needed for them.
+        """
+        if avg_mode == "ITEM":
+            raise Exception("ITEM averages change with new ratings; build a new PairSimilarity")
+        rows = np.asarray(rows, dtype=np.int64)
+        changed = PairSimilarity(R[rows], avg_mode)
+        for name in self.MATRICES:
+            setattr(self, f'_{name}', replace_rows(getattr(self, f'_{name}'), rows,
+                                                   getattr(changed, f'_{name}'), R.shape))
+
+    def pcc(self, us, vs):
+        return _pairs(self._C, self._C2, self._B, us, vs)
+
+    def cos(self, us, vs):
+        return _pairs(self._R, self._R2, self._B, us, vs)
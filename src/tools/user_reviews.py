@@ -1,29 +1,4 @@
-def cache_func(fn):
-    """Cache a func where the first arg is an id"""
-    cache = {}
-
-    def wrapped(*args):
-        key = args[0]
-        if key in cache:
-            return cache[key]
-        val = fn(*args)
-        cache[key] = val
-        return val
-    return wrapped
-
-
-def avg_review(review_list):
-    return sum(r['stars'] for r in review_list) / len(review_list)
-
-
-@cache_func
-def avg_user_score(user_id, review_list):
-    return avg_review(review_list)
-
-
-@cache_func
-def avg_item_score(item_id, review_list):
-    return avg_review(review_list)
+import numpy as np
 
 
 class UserReviews:
@@ -34,29 +9,35 @@ class UserReviews:
     AVG_MODES = set(["ITEM", "USER", "OVERALL"])
     AVG_REVIEW_SCORE = 3.7161
 
-    def __init__(self, review_list, reviews_by_items):
-        self.reviewed_items = set(r['business_id'] for r in review_list)
-        sorted_reviews = sorted(review_list, key=lambda r: r['business_id'])
+    def __init__(self, review_list, rating_stats):
+        """review_list: reviews carrying interned 'user_idx' and 'item_idx'.
+        rating_stats: a RatingStats, for the ITEM and USER averages.
+        """
+        self.reviewed_items = np.unique(np.array(
+            [r['item_idx'] for r in review_list], dtype=np.int32))
+        sorted_reviews = sorted(review_list, key=lambda r: r['item_idx'])
         self.review_list = self._remove_dupes(
             sorted_reviews,
             self.reviewed_items)
-        self.review_list.sort(key=lambda r: r['business_id'])
-        self.reviews_by_items = reviews_by_items
+        self.rating_stats = rating_stats
 
     def get_pcc_tuples(self, item_ids, avg_mode='OVERALL'):
+        """item_ids: a sorted array of item indexes this user has reviewed"""
         review_tuples = []
-        relevant_reviews = [r for r in self.review_list
-                            if r['business_id'] in item_ids]
+        positions = np.searchsorted(self.reviewed_items, item_ids)
+        relevant_reviews = [self.review_list[p] for p in positions]
         review_avgs = self.get_avgs(relevant_reviews, avg_mode)
         for review, avg in zip(relevant_reviews, review_avgs):
-            item_id = review['business_id']
+            item_id = review['item_idx']
             score = review['stars']
             review_tuples.append((item_id, score, avg))
         return review_tuples
 
     def mutually_reviewed_items(self, other_reviews):
-        """Compute the set of items both users have reviewed"""
-        shared = self.reviewed_items.intersection(other_reviews.reviewed_items)
+        """Compute the sorted array of items both users have reviewed"""
+        shared = np.intersect1d(self.reviewed_items,
+                                other_reviews.reviewed_items,
+                                assume_unique=True)
         return shared
 
     def get_avgs(self, review_list, avg_mode):
@@ -79,14 +60,12 @@ class UserReviews:
             raise Exception(msg)
 
     def _item_review_avg(self, review_list):
-        for review in review_list:
-            item_id = review['business_id']
-            avg = avg_item_score(item_id, self._reviews_by_items[item_id])
-            yield avg
+        item_means = self.rating_stats.item_mean
+        return (item_means[review['item_idx']] for review in review_list)
 
     def _user_review_avg(self, review_list):
-        user_id = self.review_list[0]['user_id']
-        avg = avg_user_score(user_id, self.review_list)
+        user_id = self.review_list[0]['user_idx']
+        avg = self.rating_stats.user_mean[user_id]
         return (avg for i in range(len(review_list)))
 
     def _overall_review_avg(self, review_list):
@@ -95,7 +74,7 @@ class UserReviews:
     def _remove_dupes(self, reviews, reviewed_items):
         """Only retain the latest review for each item.
 
-        Assumes reviews is sorted by business id.
+        Assumes reviews is sorted by item_idx.
         """
         if not self._has_dupes(reviews, reviewed_items):
             return reviews
@@ -116,19 +95,19 @@ class UserReviews:
         """
         i = 0
         deduped_reviews = []
-        current_item = reviews[0]['business_id']
+        current_item = reviews[0]['item_idx']
         latest_review_for_item = reviews[0]
         while i < len(reviews) - 1:
             next_review = reviews[i + 1]
-            if (next_review['business_id'] < current_item):
-                raise Exception("Reviews must be sorted by business_id")
+            if (next_review['item_idx'] < current_item):
+                raise Exception("Reviews must be sorted by item_idx")
 
-            if next_review['business_id'] == current_item:
+            if next_review['item_idx'] == current_item:
                 if next_review['date'] > latest_review_for_item['date']:
                     latest_review_for_item = next_review
             else:
                 deduped_reviews.append(latest_review_for_item)
-                current_item = next_review['business_id']
+                current_item = next_review['item_idx']
                 latest_review_for_item = next_review
             i += 1
         deduped_reviews.append(latest_review_for_item)
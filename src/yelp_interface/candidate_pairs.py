@@ -0,0 +1,152 @@
+"""
+Candidate pair pruning for pair feature generation.
+
+Most user pairs share no businesses, so benevolence_pcc/cos are 0 and
+the pair carries little signal. CoRatingIndex is an inverted
+item -> users index built from YelpData.reviews_by_item that lists only
+the pairs with at least k co-rated items. candidate_pairs adds every
+friend pair and optionally a random sample of the remaining pairs, with
+weights that undo the sampling.
+"""
+import numpy as np
+from scipy import sparse
+
+# Users per block when multiplying out co-rating counts.
+ROW_BLOCK_SIZE = 2000
+
+
+class CoRatingIndex:
+    """Inverted item -> users index, with co-rating counts between users."""
+
+    def __init__(self, reviews_by_item, num_users):
+        """reviews_by_item: reviews indexed by item_idx (YelpData.reviews_by_item)
+        num_users: the number of loaded users (user_idx values).
+        """
+        if hasattr(reviews_by_item, 'flat'):
+            items, users = reviews_by_item.flat('user_idx')
+            items, users = items[users < num_users], users[users < num_users]
+        else:
+            items, users = [], []
+            for item_idx, reviews in enumerate(reviews_by_item):
+                for review in reviews:
+                    if review['user_idx'] < num_users:
+                        items.append(item_idx)
+                        users.append(review['user_idx'])
+        item_users = sparse.csr_matrix(
+            (np.ones(len(items), dtype=np.int32), (items, users)),
+            shape=(len(reviews_by_item), num_users))
+        # Repeat reviews of an item by one user only count once.
+        item_users.data[:] = 1
+        self._item_users = item_users
+        self._user_items = item_users.T.tocsr()
+
+    def users_of(self, item_idx):
+        """Sorted user_idx array of the users who reviewed an item"""
+        start, stop = self._item_users.indptr[item_idx:item_idx + 2]
+        return self._item_users.indices[start:stop]
+
+    def shared_counts(self, us, vs):
+        """Number of distinct items co-rated by us[k] and vs[k] for every k"""
+        rated = self._user_items
+        return np.asarray(rated[us].multiply(rated[vs]).sum(axis=1)).ravel()
+
+    def corated_with(self, user_idx, min_shared=1):
+        """(users, counts) of every other user sharing at least min_shared items"""
+        counts = (self._user_items[user_idx] @ self._user_items.T).tocoo()
+        keep = (counts.data >= min_shared) & (counts.col != user_idx)
+        order = np.argsort(counts.col[keep])
+        return counts.col[keep][order], counts.data[keep][order]
+
+    def corated_pairs(self, start, stop, min_shared=1, block_size=ROW_BLOCK_SIZE):
+        """All pairs i1 < i2 in [start, stop) with at least min_shared co-rated items.
+
+        Returns (trustees, trusters, counts), sorted in to_dataset order.
+        """
+        rated = self._user_items[start:stop]
+        trustees, trusters, counts = [], [], []
+        for block_start in range(0, stop - start, block_size):
+            block = (rated[block_start:block_start + block_size] @ rated.T).tocoo()
+            rows = block.row + block_start
+            keep = (block.col > rows) & (block.data >= min_shared)
+            trustees.append(rows[keep] + start)
+            trusters.append(block.col[keep] + start)
+            counts.append(block.data[keep])
+        return _sorted_pairs(np.concatenate(trustees + [[]]),
+                             np.concatenate(trusters + [[]]),
+                             np.concatenate(counts + [[]]))
+
+
+def _sorted_pairs(trustees, trusters, *columns):
+    order = np.lexsort((trusters, trustees))
+    return tuple(np.asarray(c)[order].astype(np.int64)
+                 for c in (trustees, trusters) + columns)
+
+
+def friend_pairs(yelp_data, start, stop):
+    """All pairs i1 < i2 in [start, stop) where either user lists the other as a friend."""
+    graph = yelp_data.friend_graph()
+    trustees, trusters = [], []
+    for i in range(start, stop):
+        friends = graph.neighbors(i)
+        friends = friends[(friends >= start) & (friends < stop) & (friends != i)]
+        trustees.append(np.minimum(friends, i))
+        trusters.append(np.maximum(friends, i))
+    keys = np.unique(_pair_keys(np.concatenate(trustees + [[]]),
+                                np.concatenate(trusters + [[]]), stop))
+    return keys // stop, keys % stop
+
+
+def _pair_keys(trustees, trusters, stop):
+    return np.asarray(trustees, dtype=np.int64) * stop + np.asarray(trusters, dtype=np.int64)
+
+
+def _unrank_pairs(ranks, start, stop):
+    """Map positions in to_dataset order back to (trustees, trusters)"""
+    rows = np.arange(start, stop)
+    row_ends = np.cumsum(stop - 1 - rows)
+    row = np.searchsorted(row_ends, ranks, side='right')
+    row_starts = row_ends[row] - (stop - 1 - rows[row])
+    trustees = rows[row]
+    return trustees, trustees + 1 + (ranks - row_starts)
+
+
+def candidate_pairs(yelp_data, start, stop, min_shared=1, include_friends=True,
+                    negative_rate=0.0, seed=None, index=None):
+    """The pairs of [start, stop) worth featurizing, in to_dataset order.
+
+    :param min_shared: Keep pairs with at least this many co-rated items.
+    :param include_friends: Also keep every friend pair.
+    :param negative_rate: Fraction of the remaining pairs to sample at random,
+                          so models still see pairs with nothing in common.
+    :param seed: Seed for the negative sample.
+    :param index: A CoRatingIndex to reuse. Built from yelp_data if not given.
+    :return: (trustees, trusters, weights). Sampled negatives get weight
+             1 / negative_rate so weighted fits match the full pair set.
+    """
+    if not 0 <= negative_rate <= 1:
+        raise ValueError(f"negative_rate must be in [0, 1], got {negative_rate}")
+    if index is None:
+        index = CoRatingIndex(yelp_data.reviews_by_item, yelp_data.num_users)
+    trustees, trusters, _ = index.corated_pairs(start, stop, min_shared)
+    keys = _pair_keys(trustees, trusters, stop)
+    if include_friends:
+        keys = np.union1d(keys, _pair_keys(*friend_pairs(yelp_data, start, stop), stop))
+    weights = np.ones(len(keys))
+
+    n = stop - start
+    num_negatives = int(round(negative_rate * (n * (n - 1) // 2 - len(keys))))
+    if num_negatives > 0:
+        rng = np.random.default_rng(seed)
+        sampled = np.array([], dtype=np.int64)
+        while len(sampled) < num_negatives:
+            ranks = rng.integers(0, n * (n - 1) // 2, size=2 * num_negatives)
+            new = _pair_keys(*_unrank_pairs(ranks, start, stop), stop)
+            new = np.setdiff1d(new, keys)
+            sampled = np.union1d(sampled, new)
+        sampled = rng.choice(sampled, num_negatives, replace=False)
+        keys = np.concatenate([keys, sampled])
+        weights = np.concatenate([weights, np.full(num_negatives, 1 / negative_rate)])
+        order = np.argsort(keys)
+        keys, weights = keys[order], weights[order]
+
+    return keys // stop, keys % stop, weights
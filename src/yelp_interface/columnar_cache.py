@@ -0,0 +1,288 @@
+"""
+A columnar binary cache of the YELP json files.
+
+Parsing review.json takes minutes, so the four json files are ingested
+once into a directory of .npy columns. User and business ids are
+interned to integers (their position in user_ids.npy/business_ids.npy),
+numeric fields are stored as fixed width columns and free text is
+dropped. Loading memory-maps the columns and only builds dicts for the
+rows that are actually selected.
+
+The cache records the size and mtime of every source file and is
+rebuilt whenever one of them changes.
+"""
+from os import path, makedirs, stat
+from collections import defaultdict
+import json
+
+import numpy as np
+
+CACHE_VERSION = 2
+META_FILE = 'meta.json'
+
+USER_INT_COLS = [
+    'review_count', 'useful', 'funny', 'cool', 'fans',
+    'compliment_hot', 'compliment_more', 'compliment_profile',
+    'compliment_cute', 'compliment_list', 'compliment_note',
+    'compliment_plain', 'compliment_cool', 'compliment_funny',
+    'compliment_writer', 'compliment_photos',
+]
+USER_FLOAT_COLS = ['average_stars']
+REVIEW_INT_COLS = ['useful', 'funny', 'cool']
+TIP_INT_COLS = ['compliment_count']
+BUSINESS_INT_COLS = ['review_count', 'is_open']
+BUSINESS_FLOAT_COLS = ['stars', 'latitude', 'longitude']
+
+
+class _Interner:
+    """Assign dense integer ids to strings in order of first sight."""
+
+    def __init__(self):
+        self.ids = {}
+
+    def __call__(self, key):
+        idx = self.ids.get(key)
+        if idx is None:
+            idx = len(self.ids)
+            self.ids[key] = idx
+        return idx
+
+    def to_array(self):
+        width = max((len(k) for k in self.ids), default=1)
+        return np.array(list(self.ids.keys()), dtype=f'S{width}')
+
+
+def source_stats(files):
+    """The path, size and mtime of every source file, by kind"""
+    stats = {}
+    for kind, file_path in files.items():
+        st = stat(file_path)
+        stats[kind] = {'path': path.abspath(file_path),
+                       'size': st.st_size,
+                       'mtime_ns': st.st_mtime_ns}
+    return stats
+
+
+def is_fresh(files, cache_dir):
+    """True if cache_dir holds a cache built from the current files."""
+    meta_path = path.join(cache_dir, META_FILE)
+    if not path.exists(meta_path):
+        return False
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    return (meta.get('version') == CACHE_VERSION and
+            meta.get('sources') == source_stats(files))
+
+
+def _to_datetime(dates):
+    return np.array(dates, dtype='datetime64[s]')
+
+
+def _from_datetime(dates):
+    as_str = np.datetime_as_string(dates, unit='s')
+    return np.char.replace(as_str, 'T', ' ').tolist()
+
+
+def _save(cache_dir, kind, columns):
+    for name, values in columns.items():
+        np.save(path.join(cache_dir, f'{kind}.{name}.npy'), values)
+
+
+def _load(cache_dir, kind, name):
+    return np.load(path.join(cache_dir, f'{kind}.{name}.npy'), mmap_mode='r')
+
+
+def ingest(files, cache_dir):
+    """Parse the json files once and write them out as columns.
+
+    :param files: A dict with 'users', 'reviews', 'tips' and 'businesses' paths.
+    :param cache_dir: The directory to write the cache to.
+    """
+    makedirs(cache_dir, exist_ok=True)
+    sources = source_stats(files)
+    user_ids = _Interner()
+    business_ids = _Interner()
+
+    cols = defaultdict(list)
+    friend_ids = []
+    friend_ptr = [0]
+    with open(files['users'], 'r') as f:
+        for line in f:
+            user = json.loads(line)
+            cols['user'].append(user_ids(user['user_id']))
+            cols['yelping_since'].append(user['yelping_since'])
+            cols['elite'].append(user['elite'] or '')
+            for col in USER_INT_COLS + USER_FLOAT_COLS:
+                cols[col].append(user[col])
+            if user['friends']:
+                friend_ids.extend(user_ids(u.strip())
+                                  for u in user['friends'].split(','))
+            friend_ptr.append(len(friend_ids))
+    columns = {
+        'user': np.array(cols['user'], dtype=np.int32),
+        'yelping_since': _to_datetime(cols['yelping_since']),
+        'elite': np.array(cols['elite'], dtype=np.bytes_),
+        'friends_indptr': np.array(friend_ptr, dtype=np.int64),
+        'friends_indices': np.array(friend_ids, dtype=np.int32),
+    }
+    columns.update({c: np.array(cols[c], dtype=np.int32) for c in USER_INT_COLS})
+    columns.update({c: np.array(cols[c], dtype=np.float32) for c in USER_FLOAT_COLS})
+    _save(cache_dir, 'users', columns)
+
+    cols = defaultdict(list)
+    with open(files['reviews'], 'r') as f:
+        for line in f:
+            review = json.loads(line)
+            cols['review_id'].append(review['review_id'])
+            cols['user'].append(user_ids(review['user_id']))
+            cols['business'].append(business_ids(review['business_id']))
+            cols['stars'].append(review['stars'])
+            cols['date'].append(review['date'])
+            for col in REVIEW_INT_COLS:
+                cols[col].append(review[col])
+    columns = {
+        'review_id': np.array(cols['review_id'], dtype=np.bytes_),
+        'user': np.array(cols['user'], dtype=np.int32),
+        'business': np.array(cols['business'], dtype=np.int32),
+        'stars': np.array(cols['stars'], dtype=np.float32),
+        'date': _to_datetime(cols['date']),
+    }
+    columns.update({c: np.array(cols[c], dtype=np.int32) for c in REVIEW_INT_COLS})
+    _save(cache_dir, 'reviews', columns)
+
+    cols = defaultdict(list)
+    with open(files['tips'], 'r') as f:
+        for line in f:
+            tip = json.loads(line)
+            cols['user'].append(user_ids(tip['user_id']))
+            cols['business'].append(business_ids(tip['business_id']))
+            cols['date'].append(tip['date'])
+            for col in TIP_INT_COLS:
+                cols[col].append(tip[col])
+    columns = {
+        'user': np.array(cols['user'], dtype=np.int32),
+        'business': np.array(cols['business'], dtype=np.int32),
+        'date': _to_datetime(cols['date']),
+    }
+    columns.update({c: np.array(cols[c], dtype=np.int32) for c in TIP_INT_COLS})
+    _save(cache_dir, 'tips', columns)
+
+    cols = defaultdict(list)
+    with open(files['businesses'], 'r') as f:
+        for line in f:
+            business = json.loads(line)
+            cols['business'].append(business_ids(business['business_id']))
+            for col in BUSINESS_INT_COLS:
+                cols[col].append(business[col])
+            for col in BUSINESS_FLOAT_COLS:
+                value = business[col]
+                cols[col].append(np.nan if value is None else value)
+    columns = {'business': np.array(cols['business'], dtype=np.int32)}
+    columns.update({c: np.array(cols[c], dtype=np.int32) for c in BUSINESS_INT_COLS})
+    columns.update({c: np.array(cols[c], dtype=np.float64) for c in BUSINESS_FLOAT_COLS})
+    _save(cache_dir, 'businesses', columns)
+
+    np.save(path.join(cache_dir, 'user_ids.npy'), user_ids.to_array())
+    np.save(path.join(cache_dir, 'business_ids.npy'), business_ids.to_array())
+
+    # Written last so a half written cache is never considered fresh.
+    with open(path.join(cache_dir, META_FILE), 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'sources': sources}, f)
+
+
+def _decode(ids, idx):
+    return [i.decode() for i in ids[idx].tolist()]
+
+
+def load(files, cache_dir, user_range, user_filter, review_filter,
+         tip_filter, business_filter):
+    """Build the read_data structures from the cache, ingesting first if stale.
+
+    Arguments mirror read_data. Businesses only carry their numeric
+    fields, and users, reviews and tips carry no free text.
+    """
+    if not is_fresh(files, cache_dir):
+        print(f"Building data cache in {cache_dir}")
+        ingest(files, cache_dir)
+
+    user_ids = np.load(path.join(cache_dir, 'user_ids.npy'), mmap_mode='r')
+    business_ids = np.load(path.join(cache_dir, 'business_ids.npy'), mmap_mode='r')
+
+    # Indexed by user_id.
+    users = {}
+    rows = slice(user_range[0], user_range[1])
+    user_idx = np.array(_load(cache_dir, 'users', 'user')[rows])
+    indptr = np.array(_load(cache_dir, 'users', 'friends_indptr')[user_range[0]:user_range[1] + 1])
+    friend_idx = _load(cache_dir, 'users', 'friends_indices')
+    fields = {
+        'user_id': _decode(user_ids, user_idx),
+        'yelping_since': _from_datetime(_load(cache_dir, 'users', 'yelping_since')[rows]),
+        'elite': [e.decode() for e in _load(cache_dir, 'users', 'elite')[rows].tolist()],
+    }
+    for col in USER_INT_COLS + USER_FLOAT_COLS:
+        fields[col] = _load(cache_dir, 'users', col)[rows].tolist()
+    for i in range(len(user_idx)):
+        user = {name: values[i] for name, values in fields.items()}
+        friends = friend_idx[indptr[i]:indptr[i + 1]]
+        user['friends'] = ', '.join(_decode(user_ids, friends))
+        filtered_user = user_filter(user)
+        if filtered_user:
+            users[user['user_id']] = filtered_user
+    kept_idx = user_idx[[uid in users for uid in fields['user_id']]]
+
+    # Indexed by user_id
+    reviews = defaultdict(list)
+    # Businesses of the kept reviews and tips, by their interned id.
+    referenced = []
+    selected = np.flatnonzero(np.isin(_load(cache_dir, 'reviews', 'user'), kept_idx))
+    review_business = np.array(_load(cache_dir, 'reviews', 'business')[selected])
+    fields = {
+        'review_id': [r.decode() for r in _load(cache_dir, 'reviews', 'review_id')[selected].tolist()],
+        'user_id': _decode(user_ids, _load(cache_dir, 'reviews', 'user')[selected]),
+        'business_id': _decode(business_ids, review_business),
+        'stars': _load(cache_dir, 'reviews', 'stars')[selected].tolist(),
+        'date': _from_datetime(_load(cache_dir, 'reviews', 'date')[selected]),
+    }
+    for col in REVIEW_INT_COLS:
+        fields[col] = _load(cache_dir, 'reviews', col)[selected].tolist()
+    for i in range(len(selected)):
+        review = {name: values[i] for name, values in fields.items()}
+        review['text'] = ''
+        filtered_review = review_filter(review)
+        if filtered_review:
+            reviews[review['user_id']].append(filtered_review)
+            referenced.append(review_business[i])
+
+    # Indexed by user_id
+    tips = defaultdict(list)
+    selected = np.flatnonzero(np.isin(_load(cache_dir, 'tips', 'user'), kept_idx))
+    tip_business = np.array(_load(cache_dir, 'tips', 'business')[selected])
+    fields = {
+        'user_id': _decode(user_ids, _load(cache_dir, 'tips', 'user')[selected]),
+        'business_id': _decode(business_ids, tip_business),
+        'date': _from_datetime(_load(cache_dir, 'tips', 'date')[selected]),
+    }
+    for col in TIP_INT_COLS:
+        fields[col] = _load(cache_dir, 'tips', col)[selected].tolist()
+    for i in range(len(selected)):
+        tip = {name: values[i] for name, values in fields.items()}
+        tip['text'] = ''
+        filtered_tip = tip_filter(tip)
+        if filtered_tip:
+            tips[tip['user_id']].append(filtered_tip)
+            referenced.append(tip_business[i])
+
+    # Indexed by business_id. Only the referenced rows are decoded.
+    businesses = {}
+    business = _load(cache_dir, 'businesses', 'business')
+    selected = np.flatnonzero(np.isin(business, np.array(referenced, dtype=np.int32)))
+    fields = {'business_id': _decode(business_ids, business[selected])}
+    for col in BUSINESS_INT_COLS + BUSINESS_FLOAT_COLS:
+        fields[col] = _load(cache_dir, 'businesses', col)[selected].tolist()
+    for i, business_id in enumerate(fields['business_id']):
+        business = {name: values[i] for name, values in fields.items()}
+        filtered_business = business_filter(business)
+        if filtered_business:
+            businesses[business_id] = filtered_business
+
+    return users, reviews, tips, businesses
@@ -14,9 +14,22 @@ a subset before doing all the dev work.
 from os import path
 from collections import defaultdict
 from collections import namedtuple
+import hashlib
 import json
 
+import numpy as np
+from scipy import sparse
+
 from tools.user_reviews import UserReviews
+from tools.id_registry import IdRegistry
+from tools.lru_cache import LRUCache
+from tools import instrument
+from tools.friend_graph import FriendGraph
+from tools.sparse_similarity import rating_matrix_from_columns, replace_rows
+from tools.review_store import ReviewStore, ReviewGroups
+from tools.rating_stats import RatingStats
+from yelp_interface import columnar_cache
+from yelp_interface import parallel_ingest
 
 try:
     import settings
@@ -26,47 +39,202 @@ except ImportError as e:
 
 
 RatingTuple = namedtuple('Rating', 'user_id item_id score')
+# The user_idx and item_idx values touched by YelpData.add_data.
+DataDelta = namedtuple('DataDelta', 'user_idxs item_idxs')
+
+# Rough bytes held by a hydrated user on top of its friend array: the
+# dict, and per review a view, a list slot and a reviewed_items entry.
+HYDRATED_USER_BYTES = 1500
+HYDRATED_REVIEW_BYTES = 80
 
 
 class YelpData:
-    def __init__(self, users, reviews, tips, businesses):
+    def __init__(self, users, reviews, tips, businesses, hydration_budget=None, source=None):
+        """hydration_budget: if set, get_user hydrates users into copies held
+        in an LRU cache of about this many bytes, instead of hydrating the
+        loaded dicts in place for good.
+        source: a json-serializable description of the files and options the
+        data was read with (see read_data). fingerprint hashes it instead of
+        the data until add_data changes the data.
+        """
         self._users = users
-        self._reviews = reviews
+        self._source = source
+        # Set when add_data gives a user a friend's earlier index, so
+        # _users is no longer in user_idx order.
+        self._users_unordered = False
+        self._hydrated = None
+        if hydration_budget is not None:
+            self._hydrated = LRUCache(maxbytes=hydration_budget, sizeof=_hydrated_nbytes,
+                                     name='yelp_data.hydrated')
         self._tips = tips
         self._businesses = businesses
-        self.review_avg = sum(r['stars'] for rlist in self._reviews.values() for r in rlist) / sum(
-            len(rlist) for rlist in self._reviews.values())
+
+        # Loaded users are interned first so they get indexes 0..num_users-1.
+        # Friends outside the loaded set are interned after them. Users added
+        # later by add_data may reuse a friend's index, so num_users is the
+        # number of rows per-user arrays need rather than a count.
+        self.user_ids = IdRegistry(self._users.keys())
+        self.item_ids = IdRegistry(self._businesses.keys())
+        self.num_users = len(self._users)
 
         self._rating_tuples = []
-        self.reviews_by_item = defaultdict(list)
-        for review_list in self._reviews.values():
-            for review in review_list:
-                self.reviews_by_item[review['business_id']].append(review)
+        self._rating_matrix = None
+        self._rating_stats = None
+        self._fingerprint = None
+        self._friend_graph = None
+
+        # Reviews are kept as columns rather than dicts (see review_store).
+        self.reviews = ReviewStore(self.user_ids, self.item_ids, self._businesses)
+        self.reviews.extend(r for rlist in reviews.values() for r in rlist)
+        self.review_avg = float(self.reviews.stars.mean(dtype=np.float64))
+        for tip_list in self._tips.values():
+            for tip in tip_list:
+                tip['user_idx'] = self.user_ids.intern(tip['user_id'])
+                tip['item_idx'] = self.item_ids.intern(tip['business_id'])
 
-        self.tips_by_item = defaultdict(list)
+        # Indexed by item_idx.
+        self.reviews_by_item = ReviewGroups(self.reviews, 'item_idx', self.item_ids)
+        self.tips_by_item = [[] for _ in range(len(self.item_ids))]
         for tip_list in self._tips.values():
             for tip in tip_list:
-                self.tips_by_item[tip['business_id']].append(tip)
+                self.tips_by_item[tip['item_idx']].append(tip)
 
     def get_user(self, user_id):
+        instrument.count('yelp_data.get_user')
+        if self._hydrated is not None:
+            user = self._hydrated.get(user_id)
+            if user is None:
+                user = self._hydrate(dict(self._users[user_id]))
+                self._hydrated.put(user_id, user)
+            return user
         user = self._users[user_id]
-        if user.get('reviews'):
+        if 'user_idx' in user:
             return user
-        reviews = self._reviews.get(user_id, [])
-        tips = self._tips.get(user_id, [])
-        user['reviews'], user['tips'] = [], []
-        user['friends'] = self.parse_friends(user)
-        for review in reviews:
-            business = self._businesses[review['business_id']]
-            review['business'] = business
-            user['reviews'].append(review)
+        return self._hydrate(user)
+
+    def get_user_at(self, user_idx):
+        return self.get_user(self.user_ids.lookup(user_idx))
+
+    @instrument.timed('yelp_data.hydrate')
+    def _hydrate(self, user):
+        friends = self._friend_idxs(user)
+        user['user_idx'] = self.user_ids.index(user['user_id'])
+        user['friends'] = friends
+        self._attach_activity(user)
+        return user
+
+    def _friend_idxs(self, user):
+        """Sorted user_idx array of a loaded user's friends, hydrated or not"""
+        if 'user_idx' in user:
+            return user['friends']
+        return np.unique(self.user_ids.intern_many(self.parse_friends(user)))
+
+    def friend_graph(self):
+        """The FriendGraph of the loaded users, built on first use.
+
+        Reads the friend lists without hydrating anyone.
+        """
+        if self._friend_graph is None:
+            friend_lists = {self.user_ids.index(user_id): self._friend_idxs(user)
+                            for user_id, user in self._users.items()}
+            self._friend_graph = FriendGraph.from_lists(
+                friend_lists, self.num_users, len(self.user_ids))
+        return self._friend_graph
+
+    def _attach_activity(self, user):
+        """Attach a user's reviews and tips, with their businesses.
+
+        Reviews are views into the ReviewStore and look their business up
+        on access.
+        """
+        tips = self._tips.get(user['user_id'], [])
+        user['tips'] = []
         for tip in tips:
             business = self._businesses[tip['business_id']]
             tip['business'] = business
             user['tips'].append(tip)
-        user['reviews'] = UserReviews(user['reviews'], self.reviews_by_item)
-
-        return user
+        user['reviews'] = UserReviews(self.reviews.by_user(user['user_idx']),
+                                      self.rating_stats())
+
+    def add_data(self, users=None, reviews=(), tips=(), businesses=None):
+        """Merge new or changed records, e.g. from a newer YELP dump.
+
+        :param users: A dict of user_id -> user. Known users are replaced.
+        :param reviews: An iterable of new reviews. Reviews by users that are
+                        not loaded are dropped, as in read_data.
+        :param tips: An iterable of new tips, filtered the same way.
+        :param businesses: A dict of business_id -> business for new items.
+        :return: A DataDelta of the users and items that changed. Work done
+                 here is proportional to the delta: the rating matrix and
+                 friend graph, if built, get the rows of changed users
+                 replaced.
+        """
+        users = users or {}
+        businesses = businesses or {}
+        touched_users, touched_items = set(), set()
+
+        for business_id, business in businesses.items():
+            self._businesses[business_id] = business
+            touched_items.add(self.item_ids.intern(business_id))
+        reused_idx = False
+        for user_id, user in users.items():
+            reused_idx |= user_id not in self._users and user_id in self.user_ids
+            self._users[user_id] = user
+            touched_users.add(self.user_ids.intern(user_id))
+        # users() puts them back in user_idx order on its next sweep.
+        self._users_unordered |= reused_idx
+
+        num_reviews = len(self.reviews)
+        rows = self.reviews.extend(r for r in reviews if r['user_id'] in self._users)
+        touched_users.update(self.reviews.user_idx[rows].tolist())
+        touched_items.update(self.reviews.item_idx[rows].tolist())
+        new_tips = [t for t in tips if t['user_id'] in self._users]
+        for tip in new_tips:
+            tip['user_idx'] = self.user_ids.index(tip['user_id'])
+            tip['item_idx'] = self.item_ids.intern(tip['business_id'])
+            touched_users.add(tip['user_idx'])
+            touched_items.add(tip['item_idx'])
+
+        new_items = len(self.item_ids) - len(self.tips_by_item)
+        self.tips_by_item.extend([] for _ in range(new_items))
+        for tip in new_tips:
+            self._tips.setdefault(tip['user_id'], []).append(tip)
+            self.tips_by_item[tip['item_idx']].append(tip)
+
+        if len(rows):
+            total = self.review_avg * num_reviews + self.reviews.stars[rows].sum(dtype=np.float64)
+            self.review_avg = float(total / len(self.reviews))
+        if touched_users:
+            self.num_users = max(self.num_users, max(touched_users) + 1)
+        self._rating_tuples = []
+        self._fingerprint = None
+        self._source = None
+        if self._rating_matrix is not None:
+            changed = np.array(sorted(touched_users), dtype=np.int64)
+            self._rating_matrix = replace_rows(
+                self._rating_matrix, changed, self._rating_rows(changed),
+                (self.num_users, len(self.item_ids)))
+        if self._friend_graph is not None and users:
+            friend_lists = {self.user_ids.index(user_id): self._friend_idxs(user)
+                            for user_id, user in users.items()}
+            self._friend_graph = self._friend_graph.with_rows(
+                friend_lists, self.num_users, len(self.user_ids))
+
+        # Re-attach activity of users that were already hydrated. Replaced
+        # users are hydrated from scratch by get_user.
+        hydrated = []
+        for user_idx in touched_users:
+            user = self._users[self.user_ids.lookup(user_idx)]
+            if self._hydrated is not None:
+                self._hydrated.pop(user['user_id'])
+            elif 'user_idx' in user:
+                self._attach_activity(user)
+            hydrated.append(self.get_user(user['user_id']))
+        if self._rating_stats is not None:
+            self._rating_stats.update(sorted(touched_items), hydrated)
+
+        return DataDelta(np.array(sorted(touched_users), dtype=np.int64),
+                         np.array(sorted(touched_items), dtype=np.int64))
 
     def get_reviews_for_item(self, business):
         if isinstance(business, dict):
@@ -76,7 +244,7 @@ class YelpData:
         else:
             raise Exception("'business' is not a string or a dict")
 
-        return self.reviews_by_item[key]
+        return self.reviews_by_item[self.item_ids.index(key)]
 
     def get_tips_for_item(self, business):
         if isinstance(business, dict):
@@ -86,19 +254,117 @@ class YelpData:
         else:
             raise Exception("'business' is not a string or a dict")
 
-        return self.tips_by_item[key]
+        return self.tips_by_item[self.item_ids.index(key)]
+
+    # Keys added to users by get_user, left out of the fingerprint.
+    HYDRATED_KEYS = ('friends', 'reviews', 'tips', 'user_idx')
+    TIP_KEYS = ('business_id', 'date', 'compliment_count')
+
+    def fingerprint(self):
+        """A hex digest of the loaded users, reviews, tips and their order.
+
+        Two YelpData with the same fingerprint give the same indicators,
+        so it can key anything derived from them (see indicator_store).
+        Data read by read_data is identified by its source files and read
+        options, which is cheap. Otherwise everything is hashed a column at
+        a time: the ReviewStore columns as raw buffers, profiles, friend ids
+        and tips as one list per field.
+        """
+        if self._fingerprint is None and self._source is not None:
+            digest = hashlib.sha1(json.dumps(['source', self._source], sort_keys=True).encode())
+            self._fingerprint = digest.hexdigest()
+        if self._fingerprint is None:
+            digest = hashlib.sha1()
+            users = self._ordered_users()
+            profiles = list(users.values())
+            keys = set().union(*(u.keys() for u in profiles)) - set(self.HYDRATED_KEYS)
+            for key in sorted(keys):
+                digest.update(json.dumps([key, [u.get(key) for u in profiles]],
+                                         default=str).encode())
+
+            # Friend ids in string order, since their indexes depend on the
+            # order users were hydrated in.
+            user_idxs = self.user_ids.indexes(users)
+            adjacency = self.friend_graph().adjacency[user_idxs]
+            degrees = np.diff(adjacency.indptr)
+            ids = np.array(self.user_ids.lookup_many(range(len(self.user_ids))), dtype=str)
+            friends = ids[adjacency.indices]
+            rows = np.repeat(np.arange(len(user_idxs)), degrees)
+            digest.update(degrees.tobytes())
+            digest.update(friends[np.lexsort((friends, rows))].tobytes())
+
+            indptr, order = self.reviews.grouping('user_idx', len(self.user_ids))
+            digest.update(np.diff(indptr)[user_idxs].tobytes())
+            for name in ('review_id', 'item_idx', 'stars', 'date', 'useful', 'funny', 'cool'):
+                digest.update(getattr(self.reviews, name)[order].tobytes())
+
+            tip_lists = [self._tips.get(user_id, ()) for user_id in users]
+            digest.update(np.array([len(t) for t in tip_lists], dtype=np.int64).tobytes())
+            for key in self.TIP_KEYS:
+                digest.update(json.dumps([t.get(key) for tips in tip_lists for t in tips],
+                                         default=str).encode())
+            digest.update("\n".join(self.item_ids.lookup_many(range(len(self.item_ids)))).encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def _ordered_users(self):
+        """_users, put back in user_idx order if add_data reused an index"""
+        if self._users_unordered:
+            self._users = dict(sorted(self._users.items(),
+                                      key=lambda kv: self.user_ids.index(kv[0])))
+            self._users_unordered = False
+        return self._users
+
+    def rating_matrix(self, fmt='csr'):
+        """Sparse num_users x num_items matrix of stars, indexed by user_idx and item_idx.
+
+        Only the latest review of an item by a user is kept, as in UserReviews.
+        fmt: 'csr' for fast user rows or 'csc' for fast item columns.
+        """
+        if self._rating_matrix is None:
+            store = self.reviews
+            self._rating_matrix = rating_matrix_from_columns(
+                store.user_idx, store.item_idx, store.stars, store.date,
+                self.num_users, len(self.item_ids))
+        if fmt == 'csr':
+            return self._rating_matrix
+        elif fmt == 'csc':
+            return self._rating_matrix.tocsc()
+        else:
+            raise Exception("'fmt' must be 'csr' or 'csc'")
+
+    def _rating_rows(self, user_idxs):
+        """The rating_matrix rows of some users, as a CSR matrix"""
+        indptr, item_idxs, stars = self.reviews.latest_by_user(user_idxs)
+        return sparse.csr_matrix((stars, item_idxs, indptr),
+                                 shape=(len(user_idxs), len(self.item_ids)))
+
+    def rating_stats(self):
+        """The RatingStats of the loaded reviews, built on first use."""
+        if self._rating_stats is None:
+            self._rating_stats = RatingStats(self.reviews_by_item, self.rating_matrix())
+        return self._rating_stats
 
     def users(self):
-        for user in self._users.values():
-            yield self.get_user(user['user_id'])
+        """Yield every loaded user, hydrated, in user_idx order.
+
+        With a hydration_budget this streams: only the users still in the
+        LRU cache are kept.
+        """
+        for user_id in list(self._ordered_users()):
+            yield self.get_user(user_id)
+
+    def user_idxs(self):
+        """The user_idx of every loaded user, in user_idx order, without hydrating"""
+        return self.user_ids.indexes(self._ordered_users())
 
     def rating_tuples(self):
         if self._rating_tuples:
-            return self.self._rating_tuples
+            return self._rating_tuples
 
         rating_tuples = []
-        for user in self._users.values():
-            for review in self._reviews[user['user_id']]:
+        for user in self._ordered_users().values():
+            for review in self.reviews.by_user(self.user_ids.index(user['user_id'])):
                 user_id = user['user_id']
                 item_id = review['business_id']
                 score = review['stars']
@@ -114,9 +380,32 @@ class YelpData:
             return set(u.strip() for u in user['friends'].split(","))
 
 
+def _hydrated_nbytes(user):
+    return (HYDRATED_USER_BYTES + user['friends'].nbytes +
+            HYDRATED_REVIEW_BYTES * (len(user['reviews']) + len(user['tips'])))
+
+
+def _data_files(read_sample):
+    suffix = '_sample' if read_sample else ''
+    return {
+        'users': path.join(settings.DATA_DIR, f'user{suffix}.json'),
+        'businesses': path.join(settings.DATA_DIR, f'business{suffix}.json'),
+        'reviews': path.join(settings.DATA_DIR, f'review{suffix}.json'),
+        'tips': path.join(settings.DATA_DIR, f'tip{suffix}.json'),
+    }
+
+
+def _cache_dir(read_sample):
+    cache_root = getattr(settings, 'DATA_CACHE_DIR',
+                         path.join(settings.DATA_DIR, 'cache'))
+    return path.join(cache_root, 'sample' if read_sample else 'full')
+
+
 def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA_READ_SAMPLE,
               user_filter=None, review_filter=None, tip_filter=None,
-              business_filter=None):
+              business_filter=None, use_cache=getattr(settings, 'DATA_USE_CACHE', False),
+              parallel=getattr(settings, 'DATA_PARALLEL_READ', False), workers=None,
+              hydration_budget=getattr(settings, 'DATA_HYDRATION_BUDGET', None)):
     """Read data from yelp data set. Return a YelpData object with contents.
 
     :param user_range: A tuple specifying the indexes of the first and last user to read.
@@ -125,18 +414,26 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
     :param tip_filter:  An optional f: dict -> dict which can be used to modify tips as they are read.
     :param business_filter:  An optional f: dict -> dict which can be used to modify businesses as they are read.
     :param read_sample: A boolean flag. Set to true to load a predefined sample (for testing)
+    :param use_cache: A boolean flag. Set to true to read from the columnar cache (see columnar_cache),
+                      building it first if it is missing or out of date. Cached records only keep
+                      the numeric fields and ids: text, names, categories and attributes are dropped.
+    :param parallel: A boolean flag. Set to true to parse the json files in a process pool (see parallel_ingest).
+    :param workers: The number of processes to use when parallel is set. Defaults to all cores.
+    :param hydration_budget: Bytes of hydrated users to keep, see YelpData. None keeps them all.
     :return: A YelpData with the data read from text files.
     """
-    if not read_sample:
-        USERS_FILE = path.join(settings.DATA_DIR, 'user.json')
-        BUSINESS_FILE = path.join(settings.DATA_DIR, 'business.json')
-        REVIEW_FILE = path.join(settings.DATA_DIR, 'review.json')
-        TIP_FILE = path.join(settings.DATA_DIR, 'tip.json')
-    else:
-        USERS_FILE = path.join(settings.DATA_DIR, 'user_sample.json')
-        BUSINESS_FILE = path.join(settings.DATA_DIR, 'business_sample.json')
-        REVIEW_FILE = path.join(settings.DATA_DIR, 'review_sample.json')
-        TIP_FILE = path.join(settings.DATA_DIR, 'tip_sample.json')
+    files = _data_files(read_sample)
+    USERS_FILE = files['users']
+    # What the data is read from, for YelpData.fingerprint. Filters can't be
+    # told apart reliably, so filtered data is fingerprinted from its contents.
+    source = None
+    if not (user_filter or review_filter or tip_filter or business_filter):
+        source = {'files': columnar_cache.source_stats(files),
+                  'user_range': list(user_range),
+                  'use_cache': bool(use_cache)}
+    BUSINESS_FILE = files['businesses']
+    REVIEW_FILE = files['reviews']
+    TIP_FILE = files['tips']
 
     if not user_filter:
         user_filter = lambda x: x
@@ -147,9 +444,23 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
     if not business_filter:
         business_filter = lambda x: x
 
+    if use_cache:
+        with instrument.timer('read_data.cache'):
+            users, reviews, tips, businesses = columnar_cache.load(
+                files, _cache_dir(read_sample), user_range, user_filter,
+                review_filter, tip_filter, business_filter)
+        return _yelp_data(users, reviews, tips, businesses, hydration_budget, source)
+
+    if parallel:
+        with instrument.timer('read_data.parallel'):
+            users, reviews, tips, businesses = parallel_ingest.read_parallel(
+                files, user_range, user_filter, review_filter, tip_filter,
+                business_filter, workers)
+        return _yelp_data(users, reviews, tips, businesses, hydration_budget, source)
+
     # Indexed by user_id.
     users = {}
-    with open(USERS_FILE, 'r') as f:
+    with instrument.timer('read_data.users'), open(USERS_FILE, 'r') as f:
         line_no = 0
         for line in f:
             if line_no >= user_range[0]:
@@ -164,7 +475,7 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
 
     # Indexed by user_id
     reviews = defaultdict(list)
-    with open(REVIEW_FILE, 'r') as f:
+    with instrument.timer('read_data.reviews'), open(REVIEW_FILE, 'r') as f:
         for line in f:
             review = json.loads(line)
             if review['user_id'] in user_ids:
@@ -176,7 +487,7 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
 
     # Indexed by user_id
     tips = defaultdict(list)
-    with open(TIP_FILE, 'r') as f:
+    with instrument.timer('read_data.tips'), open(TIP_FILE, 'r') as f:
         for line in f:
             tip = json.loads(line)
             if tip['user_id'] in user_ids:
@@ -188,7 +499,7 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
 
     # Indexed by review_id and tip id
     businesses = {}
-    with open(BUSINESS_FILE) as f:
+    with instrument.timer('read_data.businesses'), open(BUSINESS_FILE) as f:
         for line in f:
             business = json.loads(line)
             if business['business_id'] in reviewed_business_ids or business['business_id'] in tipped_business_ids:
@@ -196,7 +507,17 @@ def read_data(user_range=(0, settings.DATA_NUM_USERS), read_sample=settings.DATA
                 if filtered_business:
                     businesses[business['business_id']] = filtered_business
 
-    return YelpData(users, reviews, tips, businesses)
+    return _yelp_data(users, reviews, tips, businesses, hydration_budget, source)
+
+
+def _yelp_data(users, reviews, tips, businesses, hydration_budget, source):
+    with instrument.timer('read_data.yelp_data'):
+        return YelpData(users, reviews, tips, businesses, hydration_budget, source)
+
+
+def build_cache(read_sample=settings.DATA_READ_SAMPLE):
+    """Ingest the json files into the columnar cache used by read_data."""
+    columnar_cache.ingest(_data_files(read_sample), _cache_dir(read_sample))
 
 
 def save_sample(users, reviews, tips, businesses):
@@ -208,22 +529,24 @@ def save_sample(users, reviews, tips, businesses):
 
     with open(USER_SAMPLE_PATH, 'w') as f:
         for user in users.values():
-            if user.get('reviews'):
-                del user['reviews']
+            for key in ('reviews', 'user_idx'):
+                user.pop(key, None)
             f.write(json.dumps(user) + "\n")
 
     with open(REVIEW_SAMPLE_PATH, 'w') as f:
         for user_reviews in reviews.values():
             for review in user_reviews:
-                if review.get('business'):
-                    del review['business']
+                if hasattr(review, 'to_dict'):
+                    review = review.to_dict()
+                for key in ('business', 'user_idx', 'item_idx'):
+                    review.pop(key, None)
                 f.write(json.dumps(review) + "\n")
 
     with open(TIP_SAMPLE_PATH, 'w') as f:
         for user_tips in tips.values():
             for tip in user_tips:
-                if tip.get('business'):
-                    del tip['business']
+                for key in ('business', 'user_idx', 'item_idx'):
+                    tip.pop(key, None)
                 f.write(json.dumps(tip) + "\n")
 
     with open(BUSINESS_SAMPLE_PATH, 'w') as f:
@@ -1,21 +1,102 @@
-from collections import defaultdict
-from tools.review_similarity import review_pcc, review_cos, pcc, cos
-from tools.user_reviews import avg_user_score, avg_item_score
+import numpy as np
+from tools import instrument
+from tools.review_similarity import review_pcc, review_cos
+from tools import similarity_kernels
+from tools.rating_stats import star_bins, NUM_STAR_BINS
 from small_experiments.avg_review_score import AVG_REVIEW_SCORE
 
 
+# Users whose review columns user_indicators holds at once.
+USER_BLOCK_SIZE = 50_000
+
+
+def _user_blocks(users, block_size=USER_BLOCK_SIZE):
+    if isinstance(users, np.ndarray):
+        for start in range(0, len(users), block_size):
+            yield users[start:start + block_size]
+        return
+    block = []
+    for user in users:
+        block.append(user)
+        if len(block) == block_size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _user_idx(user):
+    return user if isinstance(user, (int, np.integer)) else user['user_idx']
+
+
+def _user_idxs(users):
+    if isinstance(users, np.ndarray):
+        return users.astype(np.int64)
+    return np.array([_user_idx(u) for u in users], dtype=np.int64)
+
+
 class FangTrust():
     """Trust indicators from Fang et al"""
 
-    def __init__(self, reviews_by_item):
-        self._reviews_by_item = reviews_by_item
-        self._cache = defaultdict(dict)
+    CACHED_INDICATORS = ['integrity_pcc', 'integrity_cos', 'competence']
+    COMPETENCE_E = 0.5
+
+    def __init__(self, rating_stats, reviews=None):
+        """rating_stats: a RatingStats over the loaded users and items.
+        reviews: the ReviewStore of the loaded reviews (YelpData.reviews).
+        With it the per-user indicators are read from its columns instead
+        of from hydrated users.
+        """
+        self._stats = rating_stats
+        self._reviews = reviews
+        # NaN marks an indicator that has not been computed yet.
+        self._cache = {title: np.full(rating_stats.num_users, np.nan)
+                       for title in self.CACHED_INDICATORS}
+        self._star_cumsums = None
 
     def _put_cache(self, user, indicator_title, indicator_value):
-        self._cache[user['user_id']][indicator_title] = indicator_value
+        self._cache[indicator_title][user['user_idx']] = indicator_value
 
     def _get_cache(self, user, indicator_title):
-        return self._cache[user['user_id']].get(indicator_title, None)
+        val = self._cache[indicator_title][user['user_idx']]
+        if np.isnan(val):
+            instrument.count('fang_trust.cache.miss')
+            return None
+        instrument.count('fang_trust.cache.hit')
+        return val
+
+    def update(self, user_idxs, item_idxs, reviews_by_item):
+        """Forget the cached indicators that new reviews made stale.
+
+        user_idxs: users whose reviews changed (YelpData.add_data's delta).
+        item_idxs: items whose reviews changed. Integrity and competence of
+        every user who reviewed one of them depend on its statistics.
+        The RatingStats must have been updated first.
+        Returns the user_idx array of the stale users; user_indicators
+        recomputes just those.
+        """
+        num_users = self._stats.num_users
+        for title, values in self._cache.items():
+            if len(values) < num_users:
+                grown = np.full(num_users, np.nan)
+                grown[:len(values)] = values
+                self._cache[title] = grown
+
+        reviewers = []
+        for item_idx in item_idxs:
+            reviews = reviews_by_item[item_idx]
+            if hasattr(reviews, 'column'):
+                reviewers.append(reviews.column('user_idx'))
+            else:
+                reviewers.append([r['user_idx'] for r in reviews])
+        stale = np.unique(np.concatenate(
+            [np.asarray(user_idxs, dtype=np.int64)] +
+            [np.asarray(r, dtype=np.int64) for r in reviewers]))
+        for values in self._cache.values():
+            values[stale] = np.nan
+        if self._star_cumsums is not None:
+            self._update_star_cumsums(np.asarray(item_idxs, dtype=np.int64))
+        return stale
 
     def get_vector(self, truster, trustee):
         vect = []
@@ -29,7 +110,46 @@ class FangTrust():
         vect.append(self.competence(truster))
         return vect
 
-    def vector_labels(self):
+    @instrument.timed('fang_trust.user_indicators')
+    def user_indicators(self, users):
+        """Compute the per-user indicators for every user in users.
+
+        users: hydrated users, or user_idx values if this FangTrust has a
+        ReviewStore. It is read once, so it can be a streaming generator.
+        Only the indicators that are not cached yet are computed, in blocks
+        of USER_BLOCK_SIZE users.
+        Returns a dict from indicator title to an array indexed by user_idx.
+        """
+        for block in _user_blocks(users):
+            user_idxs = _user_idxs(block)
+            missing = np.zeros(len(block), dtype=bool)
+            for values in self._cache.values():
+                missing |= np.isnan(values[user_idxs])
+            if not missing.any():
+                continue
+            if isinstance(block, np.ndarray):
+                block = block[missing]
+            else:
+                block = [u for u, m in zip(block, missing) if m]
+            user_idxs = user_idxs[missing]
+            instrument.count('fang_trust.user_indicators.users', len(user_idxs))
+            indptr, item_idxs, stars = self._review_segments(block)
+            review_users = np.repeat(user_idxs, np.diff(indptr))
+            self._cache['integrity_pcc'][user_idxs] = self._integrity_pcc_kernel(
+                review_users, item_idxs, stars, indptr)
+            self._cache['integrity_cos'][user_idxs] = self._integrity_cos_kernel(
+                review_users, item_idxs, stars, indptr)
+            self._cache['competence'][user_idxs] = self._competence_kernel(
+                item_idxs, stars, indptr, self.COMPETENCE_E)
+        return self._cache
+
+    def load_cache(self, indicators):
+        """Seed the cache from saved user_indicators arrays."""
+        for title in self.CACHED_INDICATORS:
+            self._cache[title][:] = indicators[title]
+
+    @staticmethod
+    def vector_labels():
         return [
             'benevolence_pcc',
             'benevolence_cos',
@@ -41,66 +161,144 @@ class FangTrust():
             'truster_competence',
         ]
 
+    @instrument.timed('fang_trust.benevolence_pcc')
     def benevolence_pcc(self, truster, trustee):
         reviews1 = truster['reviews']
         reviews2 = trustee['reviews']
         return review_pcc(reviews1, reviews2, avg_mode='OVERALL')
 
+    @instrument.timed('fang_trust.benevolence_cos')
     def benevolence_cos(self, truster, trustee):
         reviews1 = truster['reviews']
         reviews2 = trustee['reviews']
         return review_cos(reviews1, reviews2)
 
+    def _integrity_pcc_kernel(self, user_idxs, item_idxs, stars, indptr=None):
+        """integrity_pcc of the reviews in each indptr segment, or of all of them"""
+        return similarity_kernels.pcc(
+            stars, self._stats.user_mean[user_idxs],
+            self._stats.item_mean[item_idxs], np.full(len(stars), AVG_REVIEW_SCORE), indptr)
+
+    def _integrity_cos_kernel(self, user_idxs, item_idxs, stars, indptr=None):
+        """integrity_cos of the reviews in each indptr segment, or of all of them"""
+        return similarity_kernels.cos(stars, self._stats.item_mean[item_idxs], indptr)
+
+    def _review_segments(self, users):
+        """(indptr, item_idxs, stars) of the deduplicated reviews of each user"""
+        if self._reviews is not None:
+            return self._reviews.latest_by_user(_user_idxs(users))
+        columns = [self._user_columns(u) for u in users]
+        indptr = np.concatenate([[0], np.cumsum([len(c[0]) for c in columns])])
+        return (indptr.astype(np.int64),
+                np.concatenate([c[0] for c in columns] + [np.zeros(0, dtype=np.int64)]),
+                np.concatenate([c[1] for c in columns] + [np.zeros(0)]))
+
+    @staticmethod
+    def _user_columns(user):
+        reviews = user['reviews']
+        item_idxs = np.array([r['item_idx'] for r in reviews], dtype=np.int64)
+        stars = np.array([r['stars'] for r in reviews], dtype=np.float64)
+        return item_idxs, stars
+
+    def _review_columns(self, user):
+        """(user_idxs, item_idxs, stars) of one user's deduplicated reviews"""
+        _, item_idxs, stars = self._review_segments([user])
+        return np.full(len(stars), user['user_idx'], dtype=np.int64), item_idxs, stars
+
+    @instrument.timed('fang_trust.integrity_pcc')
     def integrity_pcc(self, trustee):
         cached_val = self._get_cache(trustee, 'integrity_pcc')
-        if cached_val:
+        if cached_val is not None:
             return cached_val
 
-        reviews = trustee['reviews']
-        avg_reviews = []
-        for r in reviews:
-            revs = self._reviews_by_item[r['business_id']]
-            avg = avg_item_score(r['business_id'], revs)
-            avg_reviews.append(avg)
-
-        trustee_scores = [r['stars'] for r in reviews]
-        trustee_avg = avg_user_score(trustee['user_id'], reviews)
-        trustee_avgs = [trustee_avg for i in range(len(reviews))]
-        global_avgs = [AVG_REVIEW_SCORE for i in range(len(reviews))]
-        val = pcc(trustee_scores, trustee_avgs, avg_reviews, global_avgs)
+        val = self._integrity_pcc_kernel(*self._review_columns(trustee))
         self._put_cache(trustee, 'integrity_pcc', val)
         return val
 
+    @instrument.timed('fang_trust.integrity_cos')
     def integrity_cos(self, trustee):
         cached_val = self._get_cache(trustee, 'integrity_cos')
-        if cached_val:
+        if cached_val is not None:
             return cached_val
 
-        reviews = trustee['reviews']
-        avg_reviews = []
-        for r in reviews:
-            revs = self._reviews_by_item[r['business_id']]
-            avg = avg_item_score(r['business_id'], revs)
-            avg_reviews.append(avg)
-
-        trustee_scores = [r['stars'] for r in reviews]
-        val = cos(trustee_scores, avg_reviews)
+        val = self._integrity_cos_kernel(*self._review_columns(trustee))
         self._put_cache(trustee, 'integrity_cos', val)
         return val
 
-    def competence(self, trustee):
-        cached_val = self._get_cache(trustee, 'competence')
-        if cached_val:
-            return cached_val
+    def _get_star_cumsums(self):
+        """Per-item prefix sums of star counts: row i, column k counts the
+        reviews of item i with a star bin below k."""
+        if self._star_cumsums is None:
+            hist = self._stats.item_hist
+            cumsums = np.zeros((len(hist), NUM_STAR_BINS + 1), dtype=np.int64)
+            np.cumsum(hist, axis=1, out=cumsums[:, 1:])
+            self._star_cumsums = cumsums
+        return self._star_cumsums
 
-        e = 0.5
-        numer = 0
-        denom = 0
-        for review in trustee['reviews']:
-            other_reviews = self._reviews_by_item[review['business_id']]
-            numer += len([r for r in other_reviews if abs(r['stars'] - review['stars']) < e])
-            denom += len(other_reviews)
-        val = numer / denom
+    def _update_star_cumsums(self, item_idxs):
+        """Recompute the _get_star_cumsums rows of some items, growing it for new ones."""
+        hist = self._stats.item_hist
+        cumsums = self._star_cumsums
+        if len(cumsums) < len(hist):
+            grown = np.zeros((len(hist), NUM_STAR_BINS + 1), dtype=np.int64)
+            grown[:len(cumsums)] = cumsums
+            item_idxs = np.concatenate([item_idxs, np.arange(len(cumsums), len(hist))])
+            self._star_cumsums = cumsums = grown
+        cumsums[item_idxs, 1:] = np.cumsum(hist[item_idxs], axis=1)
 
-        self._put_cache(trustee, 'competence', val)
+    def _competence_counts(self, item_idxs, stars, e):
+        """For each review, the number of reviews of the same item whose stars
+        are within e of it, and the total number of reviews of the item."""
+        cumsums = self._get_star_cumsums()
+        bins = star_bins(stars)
+        # |stars - other| < e  <=>  |bin - other_bin| < 2e
+        lo = np.clip(np.floor(bins - 2 * e).astype(np.int64) + 1, 0, NUM_STAR_BINS)
+        hi = np.clip(np.ceil(bins + 2 * e).astype(np.int64), 0, NUM_STAR_BINS)
+        hi = np.maximum(hi, lo)
+        within = cumsums[item_idxs, hi] - cumsums[item_idxs, lo]
+        return within, cumsums[item_idxs, NUM_STAR_BINS]
+
+    @instrument.timed('fang_trust.competence')
+    def competence(self, trustee, e=COMPETENCE_E):
+        """Fraction of the ratings of the trustee's items that are within e of theirs.
+
+        Only the default e is cached; any other e is computed from the
+        same histograms.
+        """
+        if e == self.COMPETENCE_E:
+            cached_val = self._get_cache(trustee, 'competence')
+            if cached_val is not None:
+                return cached_val
+
+        _, item_idxs, stars = self._review_columns(trustee)
+        within, totals = self._competence_counts(item_idxs, stars, e)
+        # 0 for users without reviews, as in competence_all.
+        total = int(totals.sum())
+        val = int(within.sum()) / total if total else 0.0
+
+        if e == self.COMPETENCE_E:
+            self._put_cache(trustee, 'competence', val)
         return val
+
+    @instrument.timed('fang_trust.competence_all')
+    def competence_all(self, users, e=COMPETENCE_E):
+        """competence for every user in one vectorized pass per block of users.
+
+        users: as for user_indicators.
+        Returns an array indexed by user_idx. Users without reviews get 0.
+        """
+        values = np.zeros(len(self._cache['competence']))
+        for block in _user_blocks(users):
+            indptr, item_idxs, stars = self._review_segments(block)
+            user_idxs = _user_idxs(block)
+            values[user_idxs] = self._competence_kernel(item_idxs, stars, indptr, e)
+        return values
+
+    def _competence_kernel(self, item_idxs, stars, indptr, e):
+        """competence of the reviews in each indptr segment"""
+        within, totals = self._competence_counts(item_idxs, stars, e)
+        num_segments = len(indptr) - 1
+        segment = np.repeat(np.arange(num_segments), np.diff(indptr))
+        numer = np.bincount(segment, weights=within, minlength=num_segments)
+        denom = np.bincount(segment, weights=totals, minlength=num_segments)
+        return np.divide(numer, denom, out=np.zeros(num_segments), where=denom > 0)
@@ -0,0 +1,106 @@
+"""
+A persistent on-disk store of the per-user trust indicators.
+
+YelpTrustIndicators computes every Mauro indicator, the Fang integrity
+and competence values and the friend and similarity matrices before it
+can featurize a single pair. The store saves those inputs and the
+MauroTrust state as .npy files under a key made from a fingerprint of the
+data and the indicator parameters, so a warm start only has to
+memory-map them.
+
+Each key is a directory holding one .npy file per array (three for a
+CSR matrix) and a meta.json with the store version, the parameters and
+the labels of every array.
+"""
+from os import path, makedirs, rename
+from shutil import rmtree
+import hashlib
+import json
+
+import numpy as np
+from scipy import sparse
+
+STORE_VERSION = 3
+META_FILE = 'meta.json'
+
+
+def store_key(fingerprint, params):
+    """Key for a dataset fingerprint and a dict of indicator parameters"""
+    digest = hashlib.sha1(fingerprint.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    digest.update(str(STORE_VERSION).encode())
+    return digest.hexdigest()
+
+
+class IndicatorStore:
+    """A directory of saved indicator arrays, one sub directory per key."""
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+
+    def _key_dir(self, key):
+        return path.join(self.store_dir, key)
+
+    def has(self, key):
+        meta_path = path.join(self._key_dir(key), META_FILE)
+        if not path.exists(meta_path):
+            return False
+        with open(meta_path, 'r') as f:
+            return json.load(f).get('version') == STORE_VERSION
+
+    def save(self, key, arrays, params, labels):
+        """Save a dict of arrays and CSR matrices under key.
+
+        :param params: The parameters the arrays were computed with.
+        :param labels: A dict of labels to keep with the arrays, e.g. column
+                       names or vector_labels().
+        """
+        key_dir = self._key_dir(key)
+        # Write next to the final directory and rename it into place, so
+        # a reader never sees a half written key.
+        tmp_dir = key_dir + '.tmp'
+        rmtree(tmp_dir, ignore_errors=True)
+        makedirs(tmp_dir)
+
+        kinds = {}
+        for name, value in arrays.items():
+            if sparse.issparse(value):
+                value = sparse.csr_matrix(value)
+                for part in ('data', 'indices', 'indptr'):
+                    np.save(path.join(tmp_dir, f'{name}.{part}.npy'), getattr(value, part))
+                kinds[name] = ['csr', list(value.shape)]
+            else:
+                np.save(path.join(tmp_dir, f'{name}.npy'), np.asarray(value))
+                kinds[name] = ['array']
+
+        meta = {
+            'version': STORE_VERSION,
+            'params': params,
+            'labels': labels,
+            'arrays': kinds,
+        }
+        with open(path.join(tmp_dir, META_FILE), 'w') as f:
+            json.dump(meta, f)
+        rmtree(key_dir, ignore_errors=True)
+        rename(tmp_dir, key_dir)
+
+    def load(self, key, mmap_mode='r'):
+        """Return (arrays, meta) saved under key. Arrays are memory-mapped."""
+        key_dir = self._key_dir(key)
+        with open(path.join(key_dir, META_FILE), 'r') as f:
+            meta = json.load(f)
+        if meta.get('version') != STORE_VERSION:
+            raise Exception(f"Indicator store {key_dir} has version {meta.get('version')}, "
+                            f"expected {STORE_VERSION}")
+
+        arrays = {}
+        for name, kind in meta['arrays'].items():
+            if kind[0] == 'csr':
+                data, indices, indptr = (
+                    np.load(path.join(key_dir, f'{name}.{part}.npy'), mmap_mode=mmap_mode)
+                    for part in ('data', 'indices', 'indptr'))
+                arrays[name] = sparse.csr_matrix((data, indices, indptr),
+                                                 shape=tuple(kind[1]), copy=False)
+            else:
+                arrays[name] = np.load(path.join(key_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+        return arrays, meta
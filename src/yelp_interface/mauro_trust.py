@@ -1,74 +1,242 @@
-from collections import defaultdict, Counter, OrderedDict
+from collections import Counter
+
+import numpy as np
+
+from tools.id_registry import sorted_contains
+from tools import instrument
 
 
 class MauroTrust():
     """Trust indicators from Mauro et al"""
     LAST_YEAR = 2019
+    INDICATORS = [
+        'elite_years',
+        'elite_years_per_year',
+        'profile_up',
+        'profile_up_per_year',
+        'fans',
+        'fans_per_year',
+        'visibility',
+        'global_feedback',
+        'global_feedback_norm',
+    ]
+    # Raw per-user values the indicators are derived from.
+    RAW_COUNTS = [
+        'elite_years',
+        'years_on_site',
+        'profile_ups',
+        'fans',
+        'global_feedback',
+        'contributions',
+    ]
 
     def __init__(self, users):
-        self._users = users
-        self._indicators = defaultdict(OrderedDict)
-        self.compute_indicators()
+        """users: an iterable of hydrated users. It is read once and not kept,
+        so it can be a streaming generator such as YelpData.users().
+        """
+        self.compute_indicators(users)
+
+    @classmethod
+    def from_state(cls, raw, has_indicators, maxima):
+        """A MauroTrust restored from state() arrays, without reading any users."""
+        mauro = cls.__new__(cls)
+        mauro._raw = np.array(raw, dtype=np.float64)
+        mauro._has_indicators = np.array(has_indicators, dtype=bool)
+        mauro._maxima = dict(maxima)
+        mauro._indicators = np.zeros((len(mauro._raw), len(cls.INDICATORS)))
+        mauro._indicators[mauro._has_indicators] = mauro._normalize(
+            mauro._raw[mauro._has_indicators], mauro._maxima)
+        return mauro
+
+    def state(self):
+        """(raw, has_indicators, maxima) to save and pass to from_state.
 
+        raw holds the RAW_COUNTS of every user_idx and maxima is a dict of
+        the maxima the indicators are normalized by.
+        """
+        return self._raw, self._has_indicators, self._maxima
+
+    @instrument.timed('mauro_trust.get_vector')
     def get_vector(self, truster, trustee):
-        truster_indicators = list(self.get_indicators(truster).values())
-        trustee_indicators = list(self.get_indicators(trustee).values())
+        truster_indicators = list(self.get_indicators(truster))
+        trustee_indicators = list(self.get_indicators(trustee))
         values = truster_indicators + trustee_indicators
         values.append(self.social_relation(truster, trustee))
         values.append(self.is_friend(truster, trustee))
         return values
 
-    def vector_labels(self):
-        rand_key = next(iter(self._indicators.keys()))
-        indi_labels = list(self._indicators[rand_key].keys())
+    @classmethod
+    def vector_labels(cls):
         labels = []
         for prefix in ('truster_', 'trustee_'):
-            for label in indi_labels:
+            for label in cls.INDICATORS:
                 labels.append(f'{prefix}{label}')
         labels.append('social_jac')
         labels.append('are_friends')
         return labels
 
     def get_indicators(self, user):
-        indicators = None
-        if isinstance(user, str):
+        """Return the indicator row (ordered as INDICATORS) for a user.
+
+        user: a user dict or a user_idx.
+        """
+        if isinstance(user, dict):
+            key = user['user_idx']
+        elif isinstance(user, (int, np.integer)):
             key = user
-        elif isinstance(user, dict):
-            key = user['user_id']
         else:
-            raise Exception("'user' is not string or a dict")
+            raise Exception("'user' is not a user_idx or a dict")
 
-        indicators = self._indicators.get(key)
-        if indicators is None:
+        if key >= len(self._has_indicators) or not self._has_indicators[key]:
             raise KeyError(f"'{key}'")
-        return indicators
+        return self._indicators[key]
 
-    def compute_indicators(self):
-        self.compute_elite_years()
-        self.compute_elite_per_year()
-        self.compute_profile_up()
-        self.compute_profile_up_per_year()
-        self.compute_fans()
-        self.compute_fans_per_year()
-        self.compute_visibility()
-        self.compute_global_feedback()
-        self.compute_global_norm_feedback()
-
-    def _addi(self, user, indicator_title, indicator_value):
-        """Add an indicator with given title for given user"""
-        self._indicators[user['user_id']][indicator_title] = indicator_value
+    def get_indicator_rows(self, user_idxs):
+        """Batch form of get_indicators for an array of user_idx values"""
+        user_idxs = np.asarray(user_idxs)
+        if not self._has_indicators[user_idxs].all():
+            missing = user_idxs[~self._has_indicators[user_idxs]]
+            raise KeyError(f"'{missing[0]}'")
+        return self._indicators[user_idxs]
+
+    def indicator_matrix(self, num_rows):
+        """Indicator rows for user_idx 0..num_rows-1.
+
+        Friends that are not loaded get a row of zeros.
+        """
+        matrix = np.zeros((num_rows, len(self.INDICATORS)))
+        rows = min(num_rows, len(self._indicators))
+        matrix[:rows] = self._indicators[:rows]
+        return matrix
+
+    @instrument.timed('mauro_trust.compute_indicators')
+    def compute_indicators(self, users):
+        """Count the raw per-user values in one pass, then normalize them."""
+        user_idxs, raw = [], []
+        for u in users:
+            user_idxs.append(u['user_idx'])
+            raw.append(self._raw_counts(u))
+        # Indexed by user_idx, one column per indicator.
+        num_rows = max(user_idxs, default=-1) + 1
+        self._raw = np.zeros((num_rows, len(self.RAW_COUNTS)))
+        self._raw[user_idxs] = np.array(raw).reshape(-1, len(self.RAW_COUNTS))
+        self._has_indicators = np.zeros(num_rows, dtype=bool)
+        self._has_indicators[user_idxs] = True
+        self._indicators = np.zeros((num_rows, len(self.INDICATORS)))
+        self._maxima = self._get_maxima(self._raw[self._has_indicators])
+        self._indicators[self._has_indicators] = self._normalize(
+            self._raw[self._has_indicators], self._maxima)
+
+    @instrument.timed('mauro_trust.update')
+    def update(self, users):
+        """Add new users and recompute the indicators of changed ones.
+
+        users: hydrated users that are new or whose profile, reviews or
+        tips changed. Only their raw counts are recounted and the maxima
+        are updated from their rows; all users are rescanned only when a
+        changed user held a maximum and dropped below it. Other rows are
+        renormalized only if one of the maxima moved.
+        Returns the user_idx array of the rows whose indicators changed.
+        """
+        users = list(users)
+        if not users:
+            return np.zeros(0, dtype=np.int64)
+        idxs = np.array([u['user_idx'] for u in users], dtype=np.int64)
+        num_rows = max(len(self._has_indicators), idxs.max() + 1)
+        if num_rows > len(self._has_indicators):
+            grow = num_rows - len(self._has_indicators)
+            self._indicators = np.vstack([self._indicators,
+                                          np.zeros((grow, len(self.INDICATORS)))])
+            self._raw = np.vstack([self._raw, np.zeros((grow, len(self.RAW_COUNTS)))])
+            self._has_indicators = np.concatenate([self._has_indicators,
+                                                   np.zeros(grow, dtype=bool)])
+
+        known = idxs[self._has_indicators[idxs]]
+        old_maxima = self._get_maxima(self._raw[known]) if len(known) else None
+        for u in users:
+            self._raw[u['user_idx']] = self._raw_counts(u)
+        self._has_indicators[idxs] = True
+
+        maxima = self._get_maxima(self._raw[idxs])
+        if old_maxima is not None and any(
+                old_maxima[k] >= self._maxima[k] > maxima[k] for k in maxima):
+            instrument.count('mauro_trust.maxima.rescans')
+            maxima = self._get_maxima(self._raw[self._has_indicators])
+        else:
+            maxima = {k: max(v, self._maxima[k]) for k, v in maxima.items()}
+        if maxima != self._maxima:
+            self._maxima = maxima
+            idxs = np.flatnonzero(self._has_indicators)
+        instrument.count('mauro_trust.normalized_rows', len(idxs))
+        self._indicators[idxs] = self._normalize(self._raw[idxs], self._maxima)
+        return idxs
+
+    def _raw_counts(self, user):
+        """The values of RAW_COUNTS for one user"""
+        return (self._elite_year_count(user),
+                self._years_on_site(user),
+                self._profile_up_count(user),
+                user['fans'],
+                self._count_global_feedback(user),
+                self._count_contributions(user))
+
+    @staticmethod
+    def _get_maxima(raw):
+        """The maxima over all users that _normalize divides by."""
+        elite, years, ups, fans, feedback, contributions = raw.T
+        with np.errstate(divide='raise', invalid='raise'):
+            return {
+                'elite': elite.max(),
+                'ups': ups.max(),
+                'ups_per_year': (ups / years).max(),
+                'fans': fans.max(),
+                'fans_per_year': (fans / years).max(),
+                'feedback': feedback.max(),
+                'feedback_per_contribution': (feedback / contributions).max(),
+            }
+
+    def _normalize(self, raw, maxima):
+        """Derive the INDICATORS columns from rows of RAW_COUNTS columns.
+
+        Every indicator is normalized by its maximum over all users.
+        """
+        elite, years, ups, fans, feedback, contributions = raw.T
+        indicators = np.empty((len(raw), len(self.INDICATORS)))
+        with np.errstate(divide='raise', invalid='raise'):
+            # Based on Mauro eq 13
+            indicators[:, 0] = elite / maxima['elite']
+            # A new indicator, elite years w.r.t number of years on site
+            indicators[:, 1] = np.divide(elite, years, out=np.zeros(len(raw)),
+                                         where=elite != 0)
+            # Based on Mauro eq 14, but some changes because of yelp data
+            indicators[:, 2] = ups / maxima['ups']
+            # Based on Mauro eq 14, normalized for years on site
+            indicators[:, 3] = ups / (years * maxima['ups_per_year'])
+            # Based on Mauro eq 15
+            indicators[:, 4] = fans / maxima['fans']
+            # Based on Mauro eq 15, normalized for years on site
+            indicators[:, 5] = fans / (years * maxima['fans_per_year'])
+            # Based on Mauro eq 16
+            indicators[:, 6] = ups / (maxima['ups'] * contributions)
+            # Based on Mauro eq 17
+            indicators[:, 7] = feedback / maxima['feedback']
+            # Based on Mauro eq 17, normalized for number of contributions
+            indicators[:, 8] = feedback / (contributions * maxima['feedback_per_contribution'])
+        return indicators
 
     @staticmethod
     def social_relation(truster, trustee):
-        numer = len(truster['friends'].intersection(trustee['friends']))
-        denom = len(truster['friends'].union(trustee['friends']))
+        """Jaccard similarity of the sorted friend index arrays"""
+        numer = len(np.intersect1d(truster['friends'], trustee['friends'],
+                                   assume_unique=True))
         if numer == 0:
             return 0
+        denom = len(truster['friends']) + len(trustee['friends']) - numer
         return numer / denom
 
     @staticmethod
     def is_friend(truster, trustee):
-        return trustee['user_id'] in truster['friends']
+        return sorted_contains(truster['friends'], trustee['user_idx'])
 
     def _elite_year_count(self, user):
         if not user['elite']:
@@ -84,70 +252,10 @@ class MauroTrust():
         years_since_join = self.LAST_YEAR - join_year
         return years_since_join
 
-    def compute_elite_years(self):
-        """Based on Mauro eq 13"""
-        max_elite_years = max(self._elite_year_count(u)
-                              for u in self._users)
-
-        for u in self._users:
-            elite_years = self._elite_year_count(u)
-            self._addi(u, 'elite_years', elite_years / max_elite_years)
-
-    def compute_elite_per_year(self):
-        """A new indicator, elite years w.r.t number of years on site"""
-        for u in self._users:
-            elite_years = self._elite_year_count(u)
-            if elite_years == 0:
-                self._addi(u, 'elite_years_per_year', 0)
-                continue
-
-            years_on_site = self._years_on_site(u)
-            self._addi(u, 'elite_years_per_year', elite_years / years_on_site)
-
     def _profile_up_count(self, user):
         return (user['compliment_hot'] + user['compliment_more'] +
                 user['compliment_writer'] + user['compliment_profile'])
 
-    def compute_profile_up(self):
-        """Based on Mauro eq 14, but some changes because of yelp data"""
-        max_ups = max(self._profile_up_count(u)
-                      for u in self._users)
-        for u in self._users:
-            self._addi(u, 'profile_up', self._profile_up_count(u) / max_ups)
-
-    def compute_profile_up_per_year(self):
-        """Based on Mauro eq 14, normalized for years on site."""
-        max_ups_per_year = max(self._profile_up_count(u) /
-                               self._years_on_site(u)
-                               for u in self._users)
-        for u in self._users:
-            indi = (self._profile_up_count(u) /
-                    (self._years_on_site(u) * max_ups_per_year))
-            self._addi(u, 'profile_up_per_year', indi)
-
-    def compute_fans(self):
-        """Based on Mauro eq 15"""
-        max_fans = max(u['fans'] for u in self._users)
-        for u in self._users:
-            self._addi(u, 'fans', u['fans'] / max_fans)
-
-    def compute_fans_per_year(self):
-        """Based on Mauro eq 15, normalized for years on site"""
-        max_fans_per_year = max(u['fans'] / self._years_on_site(u)
-                                for u in self._users)
-        for u in self._users:
-            indi = u['fans'] / (self._years_on_site(u) * max_fans_per_year)
-            self._addi(u, 'fans_per_year', indi)
-
-    def compute_visibility(self):
-        """Based on Mauro eq 16."""
-        max_ups = max(self._profile_up_count(u)
-                      for u in self._users)
-        for u in self._users:
-            activity_level = self._count_contributions(u)
-            indi = self._profile_up_count(u) / (max_ups * activity_level)
-            self._addi(u, 'visibility', indi)
-
     def _count_global_feedback(self, user):
         up_count = 0
         for review in user['reviews']:
@@ -161,24 +269,6 @@ class MauroTrust():
     def _count_contributions(self, user):
         return len(user['reviews']) + len(user['tips'])
 
-    def compute_global_feedback(self):
-        """Based on Mauro eq 17"""
-        max_feedback = max(self._count_global_feedback(u)
-                           for u in self._users)
-        for u in self._users:
-            indi = self._count_global_feedback(u) / max_feedback
-            self._addi(u, 'global_feedback', indi)
-
-    def compute_global_norm_feedback(self):
-        """Based on Mauro eq 17, normalized for number of contributions"""
-        max_feedback = max((self._count_global_feedback(u) /
-                            self._count_contributions(u))
-                           for u in self._users)
-        for u in self._users:
-            indi = (self._count_global_feedback(u) /
-                    (self._count_contributions(u) * max_feedback))
-            self._addi(u, 'global_feedback_norm', indi)
-
     def global_feedback(self, user, item):
         """Based on Mauro eq 18: feedback relative to an item"""
         # TODO do I ever call this???
@@ -187,12 +277,12 @@ class MauroTrust():
         counter = Counter()
 
         for review in reviews:
-            user_id = review['user_id']
+            user_id = review['user_idx']
             counter[user_id] += review['useful']
             counter[user_id] += review['funny']
             counter[user_id] += review['cool']
         for tip in tips:
-            user_id = tip['user_id']
+            user_id = tip['user_idx']
             counter[user_id] += tip['compliment_count']
 
         most_common = counter.most_common()
@@ -201,4 +291,4 @@ class MauroTrust():
         _, max_ups = most_common[0]
         if max_ups == 0:
             raise Exception(f"No one has ever been complimented for reviewing {item}")
-        return counter[user['user_id']] / max_ups
+        return counter[user['user_idx']] / max_ups
@@ -0,0 +1,157 @@
+"""
+Parallel ingestion of the YELP json-lines files.
+
+Each file is split into byte ranges that start and end on line
+boundaries and the ranges are parsed in a process pool. Reviews and
+tips only depend on the set of loaded user ids, so both files are
+scanned at the same time once users are loaded. Workers only parse
+and select rows; the read_data filters are applied in this process
+in file order, so the result is the same as the serial reader.
+
+orjson is used for parsing if it is installed.
+"""
+from os import path, cpu_count
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import json
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    _loads = json.loads
+
+# Aim for a few chunks per worker so uneven chunks still balance.
+CHUNKS_PER_WORKER = 4
+
+# Set in each worker by _init_worker.
+_keep_ids = None
+
+
+def _init_worker(keep_ids):
+    global _keep_ids
+    _keep_ids = keep_ids
+
+
+def chunk_ranges(file_path, num_chunks):
+    """Split a file into (start, end) byte ranges aligned to line starts."""
+    size = path.getsize(file_path)
+    bounds = [0]
+    with open(file_path, 'rb') as f:
+        for i in range(1, num_chunks):
+            f.seek(max(size * i // num_chunks, bounds[-1]))
+            f.readline()
+            pos = f.tell()
+            if pos >= size:
+                break
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_range(file_path, start, end):
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        return f.read(end - start)
+
+
+def _count_lines(file_path, start, end):
+    return len(_read_range(file_path, start, end).splitlines())
+
+
+def _parse_range(file_path, start, end, skip, limit):
+    lines = _read_range(file_path, start, end).splitlines()
+    return [_loads(line) for line in lines[skip:skip + limit]]
+
+
+def _parse_matching(file_path, start, end, key):
+    """Parse the rows whose `key` field is in the worker's keep set."""
+    rows = []
+    for line in _read_range(file_path, start, end).splitlines():
+        row = _loads(line)
+        if row[key] in _keep_ids:
+            if 'text' in row:
+                row['text'] = ''
+            rows.append(row)
+    return rows
+
+
+def _num_chunks(workers):
+    return workers * CHUNKS_PER_WORKER
+
+
+def read_parallel(files, user_range, user_filter, review_filter,
+                  tip_filter, business_filter, workers=None):
+    """Parallel counterpart of the read_data json reader.
+
+    Arguments mirror read_data. workers defaults to all cores.
+    """
+    workers = workers or cpu_count()
+    num_chunks = _num_chunks(workers)
+
+    # Users: count lines per chunk, then only parse the chunks that
+    # overlap user_range.
+    user_chunks = chunk_ranges(files['users'], num_chunks)
+    with ProcessPoolExecutor(workers) as pool:
+        counts = [pool.submit(_count_lines, files['users'], s, e)
+                  for s, e in user_chunks]
+        counts = [c.result() for c in counts]
+        futures = []
+        first_line = 0
+        for (start, end), count in zip(user_chunks, counts):
+            skip = max(0, user_range[0] - first_line)
+            limit = min(count, user_range[1] - first_line) - skip
+            if limit > 0:
+                futures.append(pool.submit(_parse_range, files['users'],
+                                           start, end, skip, limit))
+            first_line += count
+
+        # Indexed by user_id.
+        users = {}
+        for future in futures:
+            for user in future.result():
+                filtered_user = user_filter(user)
+                if filtered_user:
+                    users[user['user_id']] = filtered_user
+    user_ids = set(users.keys())
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(user_ids,)) as pool:
+        review_futures = [pool.submit(_parse_matching, files['reviews'], s, e, 'user_id')
+                          for s, e in chunk_ranges(files['reviews'], num_chunks)]
+        tip_futures = [pool.submit(_parse_matching, files['tips'], s, e, 'user_id')
+                       for s, e in chunk_ranges(files['tips'], num_chunks)]
+
+        # Indexed by user_id
+        reviews = defaultdict(list)
+        for future in review_futures:
+            for review in future.result():
+                filtered_review = review_filter(review)
+                if filtered_review:
+                    reviews[review['user_id']].append(filtered_review)
+
+        # Indexed by user_id
+        tips = defaultdict(list)
+        for future in tip_futures:
+            for tip in future.result():
+                filtered_tip = tip_filter(tip)
+                if filtered_tip:
+                    tips[tip['user_id']].append(filtered_tip)
+
+    business_ids = set([r['business_id'] for rlist in reviews.values() for r in rlist])
+    business_ids.update(t['business_id'] for tlist in tips.values() for t in tlist)
+
+    # Indexed by business_id
+    businesses = {}
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(business_ids,)) as pool:
+        futures = [pool.submit(_parse_matching, files['businesses'], s, e, 'business_id')
+                   for s, e in chunk_ranges(files['businesses'], num_chunks)]
+        for future in futures:
+            for business in future.result():
+                filtered_business = business_filter(business)
+                if filtered_business:
+                    businesses[business['business_id']] = filtered_business
+
+    return users, reviews, tips, businesses
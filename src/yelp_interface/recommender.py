@@ -0,0 +1,158 @@
+"""
+Trust-aware rating prediction.
+
+A user's rating for an item is predicted from the ratings other users
+gave it, weighted by how much the user trusts them:
+
+    pred(u, i) = mean(u) + sum_v w(u, v) (r(v, i) - mean(v)) / sum_v |w(u, v)|
+
+where v runs over the users who rated i and w(u, v) is the score of a
+trust model fitted on to_dataset rows, with u as truster and v as
+trustee. Predictions fall back to the user's mean, then the item's mean,
+then the overall mean when there are no weighted neighbours.
+
+evaluate() holds out a fraction of YelpData.rating_tuples and reports
+RMSE and MAE of the predictions for them.
+"""
+import time
+
+import numpy as np
+from scipy import sparse
+
+from yelp_interface.trust_query import score_pairs
+
+# Neighbour ratings weighed at once by predict.
+PREDICT_BLOCK_SIZE = 200_000
+MIN_STARS = 1
+MAX_STARS = 5
+
+
+class TrustRecommender:
+    """Predict ratings as trust weighted averages of neighbours' ratings."""
+
+    def __init__(self, trust_indicators, model, rating_matrix, feature_cols=None,
+                 min_weight=0.0):
+        """
+        :param trust_indicators: The YelpTrustIndicators to featurize pairs with.
+        :param model: A fitted classifier with predict_proba or decision_function.
+        :param rating_matrix: The CSR user x item matrix of known ratings
+                              (YelpData.rating_matrix(), or a training part of it).
+        :param feature_cols: The vector_labels columns the model was fitted on.
+        :param min_weight: Neighbours with |weight| at or below this are ignored.
+        """
+        self._trust_indicators = trust_indicators
+        self._model = model
+        self._feature_cols = feature_cols
+        self._min_weight = min_weight
+        self._R = sparse.csr_matrix(rating_matrix)
+        self._R_items = self._R.tocsc()
+
+        counts = np.diff(self._R.indptr)
+        sums = np.asarray(self._R.sum(axis=1)).ravel()
+        self._user_mean = np.divide(sums, counts, out=np.zeros(len(counts)), where=counts > 0)
+        self._has_user = counts > 0
+        item_counts = np.diff(self._R_items.indptr)
+        item_sums = np.asarray(self._R_items.sum(axis=0)).ravel()
+        self._item_mean = np.divide(item_sums, item_counts,
+                                    out=np.zeros(len(item_counts)), where=item_counts > 0)
+        self._has_item = item_counts > 0
+        self._overall_mean = self._R.data.mean() if self._R.nnz else 0.0
+
+    def _neighbours(self, users, items):
+        """(request, trustee, rating) for every rating of each requested item"""
+        indptr = self._R_items.indptr
+        lengths = indptr[items + 1] - indptr[items]
+        requests = np.repeat(np.arange(len(items)), lengths)
+        starts = np.repeat(indptr[items] - np.cumsum(lengths) + lengths, lengths)
+        positions = np.arange(lengths.sum()) + starts
+        trustees = self._R_items.indices[positions].astype(np.int64)
+        ratings = self._R_items.data[positions]
+        keep = trustees != users[requests]
+        return requests[keep], trustees[keep], ratings[keep]
+
+    def _predict_block(self, users, items):
+        requests, trustees, ratings = self._neighbours(users, items)
+        trusters = users[requests]
+        # Score each distinct (truster, trustee) pair of the block once.
+        keys = trusters * len(self._user_mean) + trustees
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        weights = score_pairs(self._trust_indicators, self._model,
+                              unique_keys % len(self._user_mean),
+                              unique_keys // len(self._user_mean),
+                              self._feature_cols)[inverse]
+        weights[np.abs(weights) <= self._min_weight] = 0
+
+        deviations = ratings - self._user_mean[trustees]
+        numer = np.bincount(requests, weights=weights * deviations, minlength=len(users))
+        denom = np.bincount(requests, weights=np.abs(weights), minlength=len(users))
+
+        base = np.where(self._has_user[users], self._user_mean[users],
+                        np.where(self._has_item[items], self._item_mean[items],
+                                 self._overall_mean))
+        preds = base + np.divide(numer, denom, out=np.zeros(len(users)), where=denom > 0)
+        return np.clip(preds, MIN_STARS, MAX_STARS)
+
+    def predict(self, users, items, block_size=PREDICT_BLOCK_SIZE):
+        """Predicted stars for every (users[k], items[k]) pair.
+
+        users and items are user_idx and item_idx arrays. Requests are
+        scored in blocks holding about block_size neighbour ratings.
+        """
+        users = np.asarray(users, dtype=np.int64)
+        items = np.asarray(items, dtype=np.int64)
+        preds = np.empty(len(users))
+        lengths = np.diff(self._R_items.indptr)[items]
+        start = 0
+        while start < len(users):
+            stop = start + 1
+            total = lengths[start]
+            while stop < len(users) and total + lengths[stop] <= block_size:
+                total += lengths[stop]
+                stop += 1
+            preds[start:stop] = self._predict_block(users[start:stop], items[start:stop])
+            start = stop
+        return preds
+
+
+def split_ratings(yelp_data, test_fraction=0.1, seed=None):
+    """Hold out a random fraction of YelpData.rating_tuples.
+
+    Returns (train_matrix, test_users, test_items, test_stars). The
+    training matrix is the rating matrix with the held out entries removed.
+    """
+    tuples = yelp_data.rating_tuples()
+    rng = np.random.default_rng(seed)
+    test = rng.random(len(tuples)) < test_fraction
+    users = yelp_data.user_ids.indexes([t.user_id for t in tuples])[test].astype(np.int64)
+    items = yelp_data.item_ids.indexes([t.item_id for t in tuples])[test].astype(np.int64)
+    stars = np.array([t.score for t in tuples], dtype=np.float64)[test]
+
+    R = yelp_data.rating_matrix().tocoo()
+    held_out = np.isin(R.row.astype(np.int64) * R.shape[1] + R.col,
+                       users * R.shape[1] + items)
+    R = sparse.csr_matrix((R.data[~held_out], (R.row[~held_out], R.col[~held_out])),
+                          shape=R.shape)
+    return R, users, items, stars
+
+
+def evaluate(trust_indicators, model, yelp_data, test_fraction=0.1, seed=None,
+             feature_cols=None, block_size=PREDICT_BLOCK_SIZE):
+    """RMSE and MAE of TrustRecommender on held out rating_tuples.
+
+    The trust features still come from the full data; only the ratings
+    being averaged exclude the held out ones.
+    """
+    R, users, items, stars = split_ratings(yelp_data, test_fraction, seed)
+    recommender = TrustRecommender(trust_indicators, model, R, feature_cols)
+
+    start_time = time.time()
+    preds = recommender.predict(users, items, block_size)
+    stop_time = time.time()
+    print(f"Predicting {len(users)} ratings took {stop_time-start_time} seconds.")
+
+    errors = preds - stars
+    return {
+        'rmse': float(np.sqrt(np.mean(errors ** 2))),
+        'mae': float(np.mean(np.abs(errors))),
+        'count': len(users),
+    }
@@ -4,8 +4,92 @@ for which coefficients will eventually be learned.
 """
 import numpy as np
 from tqdm import tqdm
+from tools.sparse_similarity import PairSimilarity
+from tools.friend_graph import FriendGraph
+from tools import parallel_pairs
+from tools import instrument
+from data_set import DataSetWriter
+from small_experiments.avg_review_score import AVG_REVIEW_SCORE
 from yelp_interface.fang_trust import FangTrust
 from yelp_interface.mauro_trust import MauroTrust
+from yelp_interface.indicator_store import IndicatorStore, store_key
+from yelp_interface.candidate_pairs import CoRatingIndex
+from yelp_interface.trust_query import TrustQuery
+
+# Number of pairs featurized at once by to_dataset.
+PAIR_BLOCK_SIZE = 500_000
+# Average used to center ratings for benevolence_pcc.
+PAIR_AVG_MODE = 'OVERALL'
+
+
+def triangle_blocks(start, stop, block_size=PAIR_BLOCK_SIZE, row_stop=None):
+    """Yield (trustees, trusters) index arrays covering every i1 < i2 in [start, stop).
+
+    Pairs come out in the same order as the to_dataset loops, grouped
+    into blocks of whole i1 rows holding roughly block_size pairs.
+    row_stop limits i1 to [start, row_stop), for working on one tile.
+    """
+    last_row = min(stop - 1, row_stop or stop)
+    i1 = start
+    while i1 < last_row:
+        ids = [i1]
+        pair_count = stop - 1 - i1
+        while ids[-1] + 1 < last_row and pair_count < block_size:
+            ids.append(ids[-1] + 1)
+            pair_count += stop - 1 - ids[-1]
+        ids = np.array(ids)
+        counts = stop - 1 - ids
+        trustees = np.repeat(ids, counts)
+        row_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        trusters = np.arange(len(trustees)) - row_starts + trustees + 1
+        yield trustees, trusters
+        i1 = ids[-1] + 1
+
+
+def pair_features(inputs, trustees, trusters, num_cols):
+    """YelpTrustIndicators.pair_features over a dict of precomputed inputs"""
+    mauro = inputs['mauro']
+    num_mauro = mauro.shape[1]
+    X = np.empty((len(trustees), num_cols), dtype=np.float32)
+
+    X[:, :num_mauro] = mauro[trusters]
+    X[:, num_mauro:2 * num_mauro] = mauro[trustees]
+    col = 2 * num_mauro
+
+    friends = FriendGraph(inputs['friends'], inputs['friend_keys'])
+    X[:, col] = friends.jaccard(trusters, trustees)
+    X[:, col + 1] = friends.is_friend(trusters, trustees)
+    col += 2
+
+    similarity = PairSimilarity.from_matrices(
+        {name: inputs[f'similarity_{name}'] for name in PairSimilarity.MATRICES})
+    X[:, col] = similarity.pcc(trusters, trustees)
+    X[:, col + 1] = similarity.cos(trusters, trustees)
+    X[:, col + 2] = inputs['integrity_pcc'][trustees]
+    X[:, col + 3] = inputs['integrity_cos'][trustees]
+    X[:, col + 4] = inputs['integrity_pcc'][trusters]
+    X[:, col + 5] = inputs['integrity_cos'][trusters]
+    X[:, col + 6] = inputs['competence'][trustees]
+    X[:, col + 7] = inputs['competence'][trusters]
+    return X
+
+
+def _featurize_tile(tile, stop, block_size, num_cols, out_path=None):
+    """Worker side of to_dataset: write one tile's rows into the shared output.
+
+    out_path: write into this .npy file instead of the shared array 'X'.
+    """
+    arrays = parallel_pairs.worker_arrays()
+    if out_path:
+        X = np.load(out_path, mmap_mode='r+')
+    else:
+        X = arrays['X']
+    row_start, row_stop, row = tile
+    for trustees, trusters in triangle_blocks(row_start, stop, block_size, row_stop):
+        X[row:row + len(trustees)] = pair_features(arrays, trustees, trusters, num_cols)
+        row += len(trustees)
+    if out_path:
+        X.flush()
 
 
 class YelpTrustIndicators:
@@ -14,31 +98,333 @@ class YelpTrustIndicators:
     Also implements methods for calculating local trust indicators
     """
 
-    def __init__(self, yelp_data):
+    def __init__(self, yelp_data, store_dir=None):
+        """store_dir: an IndicatorStore directory. If it holds the indicators
+        of this data and these parameters they are loaded from it, otherwise
+        they are computed and saved there.
+        """
         self._yelp_data = yelp_data
-        self.fang_trust = FangTrust(yelp_data.reviews_by_item)
-        self.mauro_trust = MauroTrust(list(yelp_data.users()))
+        self._fang_trust = None
+        self._mauro_trust = None
+        self._pair_inputs = None
+        # MauroTrust.state() arrays loaded from the store.
+        self._mauro_state = None
+        self._corating_index = None
+        # Bumped by apply_delta so query caches know to start over.
+        self.data_version = 0
+        if store_dir:
+            store = IndicatorStore(store_dir)
+            key = self.store_key()
+            if not (store.has(key) and self._load_indicators(store, key)):
+                self.save_indicators(store, key)
+
+    @property
+    def fang_trust(self):
+        if self._fang_trust is None:
+            self._fang_trust = FangTrust(self._yelp_data.rating_stats(),
+                                         self._yelp_data.reviews)
+            if self._pair_inputs is not None:
+                self._fang_trust.load_cache(self._pair_inputs)
+        return self._fang_trust
+
+    @property
+    def mauro_trust(self):
+        if self._mauro_trust is None:
+            if self._mauro_state is not None:
+                self._mauro_trust = MauroTrust.from_state(*self._mauro_state)
+                self._mauro_state = None
+            else:
+                self._mauro_trust = MauroTrust(self._yelp_data.users())
+        return self._mauro_trust
+
+    @staticmethod
+    def indicator_params():
+        """The parameters the stored indicators depend on."""
+        return {
+            'last_year': MauroTrust.LAST_YEAR,
+            'competence_e': FangTrust.COMPETENCE_E,
+            'avg_review_score': AVG_REVIEW_SCORE,
+            'avg_mode': PAIR_AVG_MODE,
+        }
+
+    def store_key(self):
+        return store_key(self._yelp_data.fingerprint(), self.indicator_params())
+
+    def save_indicators(self, store, key=None):
+        """Compute every per-user input of pair_features and save it in store,
+        along with the MauroTrust state so a warm start can restore it."""
+        arrays = dict(self._get_pair_inputs())
+        raw, has_indicators, maxima = self.mauro_trust.state()
+        user_ids = self._yelp_data.user_ids
+        arrays.update({
+            'user_ids': np.array(user_ids.lookup_many(range(len(user_ids))), dtype=str),
+            'mauro_raw': raw,
+            'mauro_has_indicators': has_indicators,
+            'mauro_maxima': np.array(list(maxima.values())),
+        })
+        labels = {
+            'vector_labels': self.vector_labels(),
+            'mauro': MauroTrust.INDICATORS,
+            'mauro_raw': MauroTrust.RAW_COUNTS,
+            'mauro_maxima': list(maxima),
+        }
+        store.save(key or self.store_key(), arrays, self.indicator_params(), labels)
+
+    def _load_indicators(self, store, key):
+        """Take the pair inputs and the MauroTrust state from store.
+
+        Friends outside the loaded users get their indexes in the order they
+        are first seen, so the saved ones are interned in their saved order
+        for the stored matrices to index the same users. Returns False if the
+        YelpData already gave some of them other indexes.
+        """
+        arrays, meta = store.load(key)
+        user_ids = arrays.pop('user_ids').tolist()
+        idxs = self._yelp_data.user_ids.intern_many(user_ids)
+        if not np.array_equal(idxs, np.arange(len(user_ids))):
+            return False
+        maxima = dict(zip(meta['labels']['mauro_maxima'], arrays.pop('mauro_maxima')))
+        self._mauro_state = (arrays.pop('mauro_raw'), arrays.pop('mauro_has_indicators'),
+                             maxima)
+        self._pair_inputs = arrays
+        return True
+
+    @staticmethod
+    def vector_labels():
+        return (MauroTrust.vector_labels() +
+                FangTrust.vector_labels())
+
+    def _get_pair_inputs(self):
+        """Per-user arrays and matrices used by pair_features, built once.
 
-    def vector_labels(self):
-        return (self.mauro_trust.vector_labels() +
-                self.fang_trust.vector_labels())
+        Everything in here is a numpy array or a CSR matrix so it can be
+        put in shared memory for the parallel path.
+        """
+        if self._pair_inputs is None:
+            yd = self._yelp_data
+            with instrument.timer('pair_inputs.mauro'):
+                mauro = self.mauro_trust.indicator_matrix(yd.num_users)
+            with instrument.timer('pair_inputs.fang'):
+                fang = self.fang_trust.user_indicators(yd.user_idxs())
+            with instrument.timer('pair_inputs.friends'):
+                friends = yd.friend_graph()
+            with instrument.timer('pair_inputs.similarity'):
+                similarity = PairSimilarity(yd.rating_matrix(), PAIR_AVG_MODE)
+            self._pair_inputs = {
+                'mauro': mauro,
+                'integrity_pcc': fang['integrity_pcc'],
+                'integrity_cos': fang['integrity_cos'],
+                'competence': fang['competence'],
+                'friends': friends.adjacency,
+                'friend_keys': friends.edge_keys(),
+            }
+            for name, matrix in similarity.matrices().items():
+                self._pair_inputs[f'similarity_{name}'] = matrix
+        return self._pair_inputs
 
-    def to_dataset(self, start, stop):
-        users = list(self._yelp_data.users())
-        if stop > len(users):
+    @property
+    def num_users(self):
+        return self._yelp_data.num_users
+
+    def friend_graph(self):
+        """The FriendGraph over the pair inputs"""
+        inputs = self._get_pair_inputs()
+        return FriendGraph(inputs['friends'], inputs['friend_keys'])
+
+    def friends(self, user_idx):
+        """Sorted user_idx array of a user's friends"""
+        return self.friend_graph().neighbors(user_idx)
+
+    def corating_index(self):
+        """The CoRatingIndex of the loaded reviews, built on first use."""
+        if self._corating_index is None:
+            yd = self._yelp_data
+            self._corating_index = CoRatingIndex(yd.reviews_by_item, yd.num_users)
+        return self._corating_index
+
+    def trust_query(self, model, **kwargs):
+        """A TrustQuery for top-K trustees under a model fitted on to_dataset rows.
+
+        Keyword arguments are passed on to TrustQuery.
+        """
+        return TrustQuery(self, model, **kwargs)
+
+    def apply_delta(self, users=None, reviews=(), tips=(), businesses=None):
+        """Merge new data into the YelpData and refresh the indicators it touches.
+
+        Takes the same arguments as YelpData.add_data and returns its
+        DataDelta. Mauro indicators are recounted for the changed users
+        only and FangTrust recomputes just the stale users. If the pair
+        inputs are built, only their rows of changed users are replaced.
+        """
+        yd = self._yelp_data
+        mauro_trust, fang_trust = self.mauro_trust, self.fang_trust
+        delta = yd.add_data(users, reviews, tips, businesses)
+        changed = [yd.get_user_at(i) for i in delta.user_idxs]
+        mauro_rows = mauro_trust.update(changed)
+        stale = fang_trust.update(delta.user_idxs, delta.item_idxs, yd.reviews_by_item)
+        if self._pair_inputs is not None:
+            profiles = yd.user_ids.indexes(users or {})
+            self._update_pair_inputs(delta.user_idxs, mauro_rows, stale, profiles)
+        self._corating_index = None
+        self.data_version += 1
+        return delta
+
+    def _update_pair_inputs(self, user_idxs, mauro_rows, stale, profiles):
+        """Bring the pair inputs up to date after apply_delta.
+
+        user_idxs: users whose ratings changed. mauro_rows: rows whose Mauro
+        indicators changed. stale: users whose Fang indicators are stale.
+        profiles: users with a new or replaced profile, i.e. friend list.
+        """
+        yd = self._yelp_data
+        inputs = self._pair_inputs
+        with instrument.timer('pair_inputs.update.mauro'):
+            mauro = inputs['mauro']
+            if len(mauro) < yd.num_users or not mauro.flags.writeable:
+                grown = np.zeros((yd.num_users, mauro.shape[1]))
+                grown[:len(mauro)] = mauro
+                mauro = grown
+            mauro[mauro_rows] = self.mauro_trust.get_indicator_rows(mauro_rows)
+            inputs['mauro'] = mauro
+        with instrument.timer('pair_inputs.update.fang'):
+            fang = self.fang_trust.user_indicators(stale)
+            for title in FangTrust.CACHED_INDICATORS:
+                inputs[title] = fang[title]
+        with instrument.timer('pair_inputs.update.friends'):
+            friends = FriendGraph(inputs['friends'], inputs['friend_keys'])
+            if len(profiles) or friends.num_rows < yd.num_users:
+                friends = friends.with_rows(
+                    {int(i): yd.get_user_at(i)['friends'] for i in profiles},
+                    yd.num_users, len(yd.user_ids))
+                inputs['friends'] = friends.adjacency
+                inputs['friend_keys'] = friends.edge_keys()
+        with instrument.timer('pair_inputs.update.similarity'):
+            similarity = PairSimilarity.from_matrices(
+                {name: inputs[f'similarity_{name}'] for name in PairSimilarity.MATRICES})
+            similarity.update_rows(yd.rating_matrix(), user_idxs, PAIR_AVG_MODE)
+            for name, matrix in similarity.matrices().items():
+                inputs[f'similarity_{name}'] = matrix
+
+    def pair_features(self, trustees, trusters):
+        """Feature rows for pairs of user_idx arrays, laid out as vector_labels.
+
+        Row k is the same as get_vector(trusters[k], trustees[k]) from
+        MauroTrust followed by FangTrust.
+        """
+        inputs = self._get_pair_inputs()
+        instrument.count('pair_features.pairs', len(trustees))
+        with instrument.timer('pair_features'):
+            return pair_features(inputs, trustees, trusters, len(self.vector_labels()))
+
+    def _check_stop(self, stop):
+        num_users = self._yelp_data.num_users
+        if stop > num_users:
             msg = "'size' out of bounds. "
-            msg += f"Only have {len(users)} users in memory."
+            msg += f"Only have {num_users} users in memory."
             raise Exception(msg)
 
+    @instrument.timed('to_dataset')
+    def to_dataset(self, start, stop, block_size=PAIR_BLOCK_SIZE, workers=None):
+        """One feature row for every pair of users i1 < i2 in [start, stop).
+
+        i1 is the trustee and i2 the truster. Pairs are featurized
+        block_size at a time straight into a preallocated array.
+        workers: if set, featurize in that many processes (see to_dataset_parallel).
+        """
+        self._check_stop(stop)
+        if workers:
+            return self.to_dataset_parallel(start, stop, workers, block_size)
+        X = np.empty((parallel_pairs.pair_count(start, stop), len(self.vector_labels())),
+                     dtype=np.dtype('float32'))
+        row = 0
+        for trustees, trusters in tqdm(triangle_blocks(start, stop, block_size)):
+            X[row:row + len(trustees)] = self.pair_features(trustees, trusters)
+            row += len(trustees)
+        return X
+
+    def pairs_to_dataset(self, trustees, trusters, block_size=PAIR_BLOCK_SIZE):
+        """to_dataset for an explicit set of pairs, e.g. from candidate_pairs.
+
+        Row k holds the features of trustee trustees[k] and truster trusters[k].
+        """
+        X = np.empty((len(trustees), len(self.vector_labels())), dtype=np.dtype('float32'))
+        for row in tqdm(range(0, len(trustees), block_size)):
+            block = slice(row, row + block_size)
+            X[block] = self.pair_features(trustees[block], trusters[block])
+        return X
+
+    def iter_dataset(self, start, stop, block_size=PAIR_BLOCK_SIZE):
+        """Stream to_dataset as (trusters, trustees, X) chunks of about block_size rows."""
+        self._check_stop(stop)
+        for trustees, trusters in triangle_blocks(start, stop, block_size):
+            yield trusters, trustees, self.pair_features(trustees, trusters)
+
+    def write_dataset(self, dir_path, start, stop, block_size=PAIR_BLOCK_SIZE,
+                      workers=None):
+        """Write to_dataset(start, stop) to disk without holding it in memory.
+
+        The result can be opened lazily with DataSet.load(dir_path).
+        workers: if set, featurize in that many processes, each writing its
+        tile straight into the memory-mapped file.
+        """
+        self._check_stop(stop)
+        num_rows = parallel_pairs.pair_count(start, stop)
+        with DataSetWriter(dir_path, num_rows, self.vector_labels()) as writer:
+            if not workers:
+                for trusters, trustees, X in tqdm(self.iter_dataset(start, stop, block_size)):
+                    writer.write(trusters, trustees, X)
+                return
+
+            tiles = parallel_pairs.balanced_tiles(
+                start, stop, parallel_pairs.num_tiles(workers))
+            with parallel_pairs.SharedArrays() as shared:
+                for name, value in self._get_pair_inputs().items():
+                    shared.add(name, value)
+                parallel_pairs.run_tiles(
+                    _featurize_tile, shared, tiles, workers,
+                    args=(stop, block_size, len(self.vector_labels()), writer.features_path))
+            for trustees, trusters in triangle_blocks(start, stop, block_size):
+                writer.write_pairs(trusters, trustees)
+
+    @instrument.timed('to_dataset_parallel')
+    def to_dataset_parallel(self, start, stop, workers=None, block_size=PAIR_BLOCK_SIZE):
+        """to_dataset split into balanced tiles over a process pool.
+
+        The per-user inputs and the output live in shared memory; each
+        worker writes its tile's rows in place. Gives the same array as
+        to_dataset.
+        """
+        self._check_stop(stop)
+        num_cols = len(self.vector_labels())
+        tiles = parallel_pairs.balanced_tiles(
+            start, stop, parallel_pairs.num_tiles(workers))
+        with parallel_pairs.SharedArrays() as shared:
+            for name, value in self._get_pair_inputs().items():
+                shared.add(name, value)
+            X = shared.empty('X', (parallel_pairs.pair_count(start, stop), num_cols),
+                             np.float32)
+            parallel_pairs.run_tiles(_featurize_tile, shared, tiles, workers,
+                                     args=(stop, block_size, num_cols))
+            return np.array(X)
+
+    @instrument.timed('to_dataset_pairwise')
+    def to_dataset_pairwise(self, start, stop):
+        """Reference to_dataset that calls get_vector once per pair."""
+        yd = self._yelp_data
+        self._check_stop(stop)
+
         X = []
         for i1 in tqdm(range(start, stop)):
-            trustee = users[i1]
+            trustee = yd.get_user_at(i1)
             for i2 in range(i1 + 1, stop):
                 if i1 == i2:
                     continue
-                truster = users[i2]
+                truster = yd.get_user_at(i2)
                 feats = self.mauro_trust.get_vector(truster, trustee)
                 feats.extend(self.fang_trust.get_vector(truster, trustee))
                 X.append(np.array(feats, dtype=np.dtype('float32')))
+            instrument.count('to_dataset_pairwise.pairs', stop - i1 - 1)
 
-        return np.array(X, dtype=np.dtype('float32'))
+        with instrument.timer('to_dataset_pairwise.stack'):
+            return np.array(X, dtype=np.dtype('float32'))
@@ -0,0 +1,158 @@
+"""
+Multi-hop trust propagated over a weighted trust graph.
+
+MauroTrust and FangTrust only ever look at the two users of a pair.
+trust_graph() scores the edges of the friend graph (and optionally the
+co-rating pairs) with a model fitted on to_dataset rows, giving a CSR
+matrix W where W[u, v] is how much truster u trusts trustee v. Trust is
+then carried to users u has no edge to:
+
+- personalized_pagerank: random walks from each source over the row
+  normalized W, restarting at the source with probability alpha.
+- mole_trust: MoleTrust, a breadth first walk up to a horizon where a
+  user's trust is the trust weighted average of the edges into it from
+  the previous level, following only users trusted at least threshold.
+
+Both take a batch of sources and work on a sources x users matrix with
+sparse products, so no step loops over users in Python.
+"""
+import numpy as np
+from scipy import sparse
+
+from yelp_interface.trust_query import score_pairs
+from yelp_interface.trust_indicators import PAIR_BLOCK_SIZE
+
+PAGERANK_ALPHA = 0.15
+PAGERANK_TOL = 1e-8
+PAGERANK_MAX_ITER = 100
+MOLE_TRUST_HORIZON = 3
+MOLE_TRUST_THRESHOLD = 0.5
+
+
+def trust_graph(trust_indicators, model, feature_cols=None, min_shared=None,
+                block_size=PAIR_BLOCK_SIZE):
+    """The num_users x num_users CSR matrix of model trust along graph edges.
+
+    :param trust_indicators: The YelpTrustIndicators to featurize pairs with.
+    :param model: A fitted classifier with predict_proba or decision_function.
+                  Scores should be non negative, e.g. probabilities.
+    :param feature_cols: The vector_labels columns the model was fitted on.
+    :param min_shared: Also add an edge both ways between users sharing at
+                       least this many items. Only friends when None.
+    :param block_size: Pairs scored at once.
+    :return: W with W[u, v] the trust of truster u in trustee v. Friend
+             lists count both ways, so W has an entry for both directions
+             of every edge.
+    """
+    n = trust_indicators.num_users
+    friends = trust_indicators.friend_graph().adjacency[:, :n].tocoo()
+    trusters, trustees = friends.row.astype(np.int64), friends.col.astype(np.int64)
+    if min_shared is not None:
+        lows, highs, _ = trust_indicators.corating_index().corated_pairs(0, n, min_shared)
+        trusters = np.concatenate([trusters, lows, highs])
+        trustees = np.concatenate([trustees, highs, lows])
+
+    keys = np.unique(np.concatenate([trusters * n + trustees, trustees * n + trusters]))
+    keys = keys[keys // n != keys % n]
+    trusters, trustees = keys // n, keys % n
+
+    weights = np.empty(len(keys))
+    for start in range(0, len(keys), block_size):
+        stop = start + block_size
+        weights[start:stop] = score_pairs(trust_indicators, model, trustees[start:stop],
+                                          trusters[start:stop], feature_cols)
+    return sparse.csr_matrix((weights, (trusters, trustees)), shape=(n, n))
+
+
+def _row_normalize(W):
+    """W with every non empty row scaled to sum to 1, and the empty rows"""
+    W = sparse.csr_matrix(W, dtype=np.float64)
+    sums = np.asarray(W.sum(axis=1)).ravel()
+    scale = np.divide(1.0, sums, out=np.zeros(len(sums)), where=sums > 0)
+    return sparse.diags(scale) @ W, sums <= 0
+
+
+def personalized_pagerank(W, sources, alpha=PAGERANK_ALPHA, tol=PAGERANK_TOL,
+                          max_iter=PAGERANK_MAX_ITER):
+    """Personalized PageRank of every user from each source, by power iteration.
+
+    :param W: A square CSR matrix of non negative trust weights, e.g. from
+              trust_graph.
+    :param sources: user_idx array of the users to propagate from.
+    :param alpha: Probability of restarting at the source at each step.
+    :param tol: A source stops iterating once the L1 change of its row
+                falls below tol.
+    :param max_iter: Iteration limit for sources that do not converge.
+    :return: A dense len(sources) x n array. Each row sums to 1; walks
+             reaching a user without out edges restart at the source.
+             It takes 8 * n bytes per source, so pass sources in chunks
+             for large graphs.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    P, dangling = _row_normalize(W)
+    PT = P.T.tocsr()
+    n = P.shape[0]
+
+    restart = np.zeros((n, len(sources)))
+    restart[sources, np.arange(len(sources))] = 1
+    # One column per source, so each step is one sparse x dense product.
+    X = restart.copy()
+    active = np.arange(len(sources))
+    for _ in range(max_iter):
+        x = X[:, active]
+        lost = x[dangling].sum(axis=0)
+        x_new = (1 - alpha) * (PT @ x) + (alpha + (1 - alpha) * lost) * restart[:, active]
+        delta = np.abs(x_new - x).sum(axis=0)
+        X[:, active] = x_new
+        active = active[delta >= tol]
+        if len(active) == 0:
+            break
+    return X.T
+
+
+def mole_trust(W, sources, horizon=MOLE_TRUST_HORIZON, threshold=MOLE_TRUST_THRESHOLD):
+    """MoleTrust trust of every user within horizon steps of each source.
+
+    Users are reached level by level. A user first reached at level d
+    gets sum_u t(u) W[u, v] / sum_u t(u) over the users u at level d - 1
+    with an edge to it and a trust t(u) of at least threshold. Sources
+    have trust 1.
+
+    :param W: A square CSR matrix of trust weights in [0, 1], e.g. from
+              trust_graph with a predict_proba model.
+    :param sources: user_idx array of the users to propagate from.
+    :param horizon: The number of steps to walk out from a source.
+    :param threshold: Trust a user needs to pass trust on.
+    :return: A len(sources) x n CSR matrix holding the trust of every
+             reached user; the walk stops early once no source reaches
+             anyone new.
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    W = sparse.csr_matrix(W, dtype=np.float64)
+    W.eliminate_zeros()
+    edges = W.copy()
+    edges.data[:] = 1
+    n = W.shape[0]
+    rows = np.arange(len(sources))
+
+    trust = sparse.csr_matrix((np.ones(len(sources)), (rows, sources)), shape=(len(sources), n))
+    frontier = trust
+    for _ in range(horizon):
+        frontier = frontier.copy()
+        frontier.data[frontier.data < threshold] = 0
+        frontier.eliminate_zeros()
+        if frontier.nnz == 0:
+            break
+        numer = frontier @ W
+        denom = frontier @ edges
+        # Only users not reached at an earlier level.
+        reached = trust.copy()
+        reached.data[:] = 1
+        denom = (denom - denom.multiply(reached)).tocsr()
+        denom.eliminate_zeros()
+        if denom.nnz == 0:
+            break
+        denom.data = 1 / denom.data
+        frontier = numer.multiply(denom).tocsr()
+        trust = trust + frontier
+    return trust.tocsr()
@@ -0,0 +1,122 @@
+"""
+Top-K trust neighbor queries: who are the K users a truster trusts most.
+
+A TrustQuery scores a truster against candidate trustees with a model
+fitted on to_dataset features (e.g. regression.learn_logit). Candidates
+are the users sharing at least min_shared items with the truster, from
+the co-rating index, plus the truster's friends. A batch of trusters is
+featurized with one pair_features call and scored with one model call;
+results are kept in an LRU cache so hot users are answered without
+scoring again.
+"""
+import numpy as np
+
+from tools.lru_cache import LRUCache
+
+# Number of trusters whose top-K lists are kept.
+QUERY_CACHE_SIZE = 10_000
+
+
+class TrustQuery:
+    """Top-K trustee queries against one fitted model."""
+
+    def __init__(self, trust_indicators, model, feature_cols=None, min_shared=1,
+                 include_friends=True, cache_size=QUERY_CACHE_SIZE):
+        """
+        :param trust_indicators: The YelpTrustIndicators to featurize pairs with.
+        :param model: A fitted classifier with predict_proba or decision_function.
+        :param feature_cols: The vector_labels columns the model was fitted on,
+                             in order. Defaults to all of them.
+        :param min_shared: Candidates must share at least this many items.
+        :param include_friends: Also score the truster's friends.
+        :param cache_size: Number of trusters to keep results for.
+        """
+        self._trust_indicators = trust_indicators
+        self._model = model
+        self._feature_cols = feature_cols
+        self._min_shared = min_shared
+        self._include_friends = include_friends
+        self._cache = LRUCache(cache_size, name='trust_query.cache')
+        self._data_version = trust_indicators.data_version
+
+    @property
+    def cache(self):
+        return self._cache
+
+    def candidates(self, truster):
+        """Sorted user_idx array of the trustees scored for a truster"""
+        yti = self._trust_indicators
+        cands, _ = yti.corating_index().corated_with(truster, self._min_shared)
+        if self._include_friends:
+            friends = yti.friends(truster)
+            friends = friends[(friends < yti.num_users) & (friends != truster)]
+            cands = np.union1d(cands, friends)
+        return np.asarray(cands, dtype=np.int64)
+
+    def score(self, trustees, trusters):
+        """Model score of every (trustees[k], trusters[k]) pair"""
+        return score_pairs(self._trust_indicators, self._model, trustees, trusters,
+                           self._feature_cols)
+
+    def top_k(self, trusters, k=10):
+        """The k most trusted trustees of every truster.
+
+        Returns a list with one (trustees, scores) tuple per truster, both
+        ordered by decreasing score. Fewer than k come back when there are
+        not enough candidates.
+        """
+        if self._data_version != self._trust_indicators.data_version:
+            self._cache.clear()
+            self._data_version = self._trust_indicators.data_version
+
+        results = {}
+        # A dict rather than a set keeps the batch in request order.
+        missing = {}
+        for truster in trusters:
+            truster = int(truster)
+            cached = self._cache.get(truster)
+            if cached is not None and (cached[0] >= k or cached[0] > len(cached[1])):
+                results[truster] = (cached[1][:k], cached[2][:k])
+            else:
+                missing[truster] = None
+
+        if missing:
+            missing = list(missing)
+            cands = [self.candidates(t) for t in missing]
+            trustees = np.concatenate(cands + [np.array([], dtype=np.int64)])
+            trusters_rep = np.repeat(missing, [len(c) for c in cands])
+            scores = self.score(trustees, trusters_rep)
+            offsets = np.cumsum([0] + [len(c) for c in cands])
+            for i, truster in enumerate(missing):
+                top = _top_k(cands[i], scores[offsets[i]:offsets[i + 1]], k)
+                self._cache.put(truster, (k,) + top)
+                results[truster] = top
+
+        return [results[int(t)] for t in trusters]
+
+
+def score_pairs(trust_indicators, model, trustees, trusters, feature_cols=None):
+    """Trust of trusters[k] in trustees[k] under a model fitted on to_dataset rows.
+
+    Uses predict_proba of the positive class when the model has it and
+    decision_function otherwise.
+    """
+    if len(trustees) == 0:
+        return np.zeros(0)
+    X = trust_indicators.pair_features(trustees, trusters)
+    if feature_cols is not None:
+        X = X[:, feature_cols]
+    if hasattr(model, 'predict_proba'):
+        return model.predict_proba(X)[:, 1]
+    return model.decision_function(X)
+
+
+def _top_k(trustees, scores, k):
+    """(trustees, scores) of the k highest scores, by score then user_idx"""
+    if len(scores) > k:
+        # Keep everything tied with the k-th score so ties resolve by user_idx.
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        keep = scores >= kth
+        trustees, scores = trustees[keep], scores[keep]
+    order = np.lexsort((trustees, -scores))[:k]
+    return trustees[order], scores[order]
@@ -0,0 +1,12 @@
+import sys
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'src'))
+
+try:
+    import settings
+except ImportError:
+    # The modules only need settings for default paths; the tests pass
+    # their own directories.
+    import settings_default
+    sys.modules['settings'] = settings_default
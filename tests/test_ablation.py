@@ -0,0 +1,45 @@
+import numpy as np
+
+import ablation
+from data_set import DataSet
+from tools import parallel_pairs
+
+
+def _write(tmp_path, rows=200):
+    rng = np.random.default_rng(0)
+    data = rng.random((rows, 4))
+    data[:, 3] = data[:, 0] + data[:, 1] > 1
+    np.save(tmp_path / 'features.npy', data)
+    return data, np.load(tmp_path / 'features.npy', mmap_mode='r')
+
+
+def test_whole_memmap_reopened_from_file(tmp_path):
+    data, mapped = _write(tmp_path)
+    with parallel_pairs.SharedArrays() as shared:
+        spec = ablation._data_spec(mapped, shared)
+    assert spec[0] == 'memmap'
+    assert np.array_equal(ablation._open_data(spec)[0], data)
+
+
+def test_sliced_memmap_goes_through_shared_memory(tmp_path):
+    data, mapped = _write(tmp_path)
+    for view in (mapped[20:], mapped[::2], mapped[:, :3]):
+        with parallel_pairs.SharedArrays() as shared:
+            spec = ablation._data_spec(view, shared)
+            opened, blocks = ablation._open_data(spec)
+            assert spec[0] == 'shared'
+            assert np.array_equal(opened, view)
+            del opened
+            for block in blocks:
+                block.close()
+
+
+def test_run_ablation_on_sliced_memmap(tmp_path):
+    data, mapped = _write(tmp_path)
+    labels = ['a', 'b', 'c', 'target']
+    configs = {'all': [], 'without_a': [0]}
+    sliced = ablation.run_ablation(DataSet(mapped[50:], labels), 3, configs, workers=2)
+    expected = ablation.run_ablation(DataSet(np.array(data[50:]), labels), 3, configs,
+                                     workers=2)
+    assert sliced == expected
+    assert sum(map(sum, sliced[0]['confusion'])) == 150
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+from yelp_interface.candidate_pairs import CoRatingIndex, candidate_pairs
+
+
+def _index():
+    reviews_by_item = [[{'user_idx': 0}, {'user_idx': 1}],
+                       [{'user_idx': 2}, {'user_idx': 3}]]
+    return CoRatingIndex(reviews_by_item, 5)
+
+
+@pytest.mark.parametrize('rate', [-0.1, 1.5, 2])
+def test_negative_rate_out_of_range(rate):
+    with pytest.raises(ValueError):
+        candidate_pairs(None, 0, 5, include_friends=False, negative_rate=rate,
+                        index=_index())
+
+
+def test_negative_rate_one_samples_every_pair():
+    trustees, trusters, weights = candidate_pairs(
+        None, 0, 5, include_friends=False, negative_rate=1.0, seed=0, index=_index())
+    expected = [(i, j) for i in range(5) for j in range(i + 1, 5)]
+    assert list(zip(trustees, trusters)) == expected
+    assert np.all(weights == 1)
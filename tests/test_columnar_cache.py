@@ -0,0 +1,41 @@
+import json
+
+from yelp_interface import columnar_cache
+from yelp_interface.mauro_trust import MauroTrust
+
+ELITES = ['', 'None', '20,20', '2009,2010,2011', '2004']
+
+
+def _user(i, elite):
+    user = {'user_id': f'u{i}', 'yelping_since': '2010-01-01 00:00:00',
+            'elite': elite, 'friends': 'None' if i else '', 'average_stars': 4.0}
+    user.update({c: i for c in columnar_cache.USER_INT_COLS})
+    return user
+
+
+def _write(tmp_path, name, rows):
+    file_path = tmp_path / f'{name}.json'
+    file_path.write_text(''.join(json.dumps(r) + '\n' for r in rows))
+    return str(file_path)
+
+
+def test_elite_round_trips_through_cache(tmp_path):
+    users = [_user(i, elite) for i, elite in enumerate(ELITES)]
+    reviews = [{'review_id': f'r{i}', 'user_id': u['user_id'], 'business_id': 'b0',
+                'stars': 4.0, 'date': '2012-01-01 00:00:00', 'useful': 0, 'funny': 0,
+                'cool': 0} for i, u in enumerate(users)]
+    tips = [{'user_id': 'u0', 'business_id': 'b0', 'date': '2012-01-01 00:00:00',
+             'compliment_count': 0}]
+    business = {'business_id': 'b0', 'review_count': len(users), 'is_open': 1,
+                'stars': 4.0, 'latitude': 0.0, 'longitude': 0.0}
+    files = {'users': _write(tmp_path, 'users', users),
+             'reviews': _write(tmp_path, 'reviews', reviews),
+             'tips': _write(tmp_path, 'tips', tips),
+             'businesses': _write(tmp_path, 'businesses', [business])}
+    loaded = columnar_cache.load(files, str(tmp_path / 'cache'), (0, len(users)),
+                                 lambda u: u, lambda r: r, lambda t: t, lambda b: b)[0]
+    for user in users:
+        cached = loaded[user['user_id']]
+        assert cached['elite'] == user['elite']
+        assert (MauroTrust._elite_year_count(None, cached) ==
+                MauroTrust._elite_year_count(None, user))
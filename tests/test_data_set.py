@@ -0,0 +1,57 @@
+import numpy as np
+from sklearn.preprocessing import scale
+
+from data_set import DataSet, DataSplit
+
+
+def _data_set(rows=300, cols=5):
+    rng = np.random.default_rng(0)
+    return DataSet(rng.random((rows, cols)) * np.arange(1, cols + 1), list('abcde'[:cols]))
+
+
+def _masked(data, mask_list):
+    X = np.copy(data)
+    X[:, mask_list] = 0
+    return X
+
+
+def test_x_is_built_once_and_kept_in_step_with_the_mask():
+    ds = _data_set()
+    split = ds.split(4, [1])
+    X = split.X
+    assert split.X is X
+    assert np.array_equal(X, _masked(ds.data, [1, 4]))
+    split.unmask(1).mask(2)
+    assert split.X is X
+    assert np.array_equal(X, _masked(ds.data, [2, 4]))
+    assert split.labels == ['a', 'b', 'H_c', 'd', 'H_e']
+
+
+def test_scale_rebuilds_x_standardized():
+    ds = _data_set()
+    split = ds.split(4, [1])
+    split.X
+    split.scale()
+    assert np.allclose(split.X, scale(_masked(ds.data, [1, 4])))
+    split.unmask(1)
+    assert np.allclose(split.X, scale(_masked(ds.data, [4])))
+
+
+def test_old_constructor_keeps_x_and_y():
+    ds = _data_set()
+    X, Y = _masked(ds.data, [0, 4]), ds.data[:, 4]
+    split = DataSplit(ds.data, ds.labels, X, Y, [0, 4])
+    assert split.X is X and split.Y is Y
+    split.unmask(0)
+    assert np.array_equal(X[:, 0], ds.data[:, 0])
+    assert next(split.chunks())[1] is not None
+
+
+def test_reset_and_unmask_all():
+    ds = _data_set()
+    split = ds.split(4, [0, 1])
+    reset = split.reset()
+    assert type(reset) is DataSet and reset.labels == ds.labels
+    assert split.labels == ['H_a', 'H_b', 'c', 'd', 'H_e']
+    assert split.unmask_all().labels == ['a', 'b', 'c', 'd', 'H_e']
+    assert np.array_equal(split.features(), ds.data[:, :4])
@@ -0,0 +1,42 @@
+import json
+from collections import defaultdict
+from os import path
+
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from yelp_interface.data_interface import YelpData
+from yelp_interface.fang_trust import FangTrust
+
+
+def _read(data_dir, name):
+    with open(path.join(data_dir, f'{name}.json')) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture(scope='module')
+def yelp_data(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    synthetic.generate(data_dir, 60, seed=5)
+    users = {u['user_id']: u for u in _read(data_dir, 'user')}
+    users['no_reviews'] = dict(next(iter(users.values())), user_id='no_reviews', friends='')
+    reviews = defaultdict(list)
+    for review in _read(data_dir, 'review'):
+        reviews[review['user_id']].append(review)
+    return YelpData(users, reviews, defaultdict(list),
+                    {b['business_id']: b for b in _read(data_dir, 'business')})
+
+
+@pytest.mark.parametrize('use_store', [True, False])
+def test_competence_of_user_without_reviews(yelp_data, use_store):
+    fang = FangTrust(yelp_data.rating_stats(), yelp_data.reviews if use_store else None)
+    user = yelp_data.get_user('no_reviews')
+    assert len(user['reviews']) == 0
+    assert fang.competence(user) == 0
+    assert fang.competence(user, e=1.0) == 0
+    users = list(yelp_data.users())
+    values = fang.competence_all(yelp_data.user_idxs() if use_store else users)
+    assert values[user['user_idx']] == 0
+    assert np.allclose([fang.competence(u) for u in users],
+                       values[[u['user_idx'] for u in users]])
@@ -0,0 +1,38 @@
+import json
+from os import path
+
+import numpy as np
+
+from benchmarks import synthetic
+from small_experiments import friend_pcc_corr
+
+
+def _load(tmp_path, monkeypatch):
+    synthetic.generate(str(tmp_path), 200, seed=1)
+    with open(path.join(tmp_path, 'review.json')) as f:
+        business_ids = [json.loads(line)['business_id'] for _, line in zip(range(5), f)]
+    # A last user without friends: interned after every outside friend id,
+    # so its index is past both the user count and the largest friend index.
+    with open(path.join(tmp_path, 'user.json'), 'a') as f:
+        f.write(json.dumps({'user_id': 'last_user', 'friends': ''}) + '\n')
+    with open(path.join(tmp_path, 'review.json'), 'a') as f:
+        for business_id in business_ids:
+            f.write(json.dumps({'user_id': 'last_user', 'business_id': business_id,
+                                'stars': 4.0, 'date': '2015-01-01 00:00:00'}) + '\n')
+    monkeypatch.setattr(friend_pcc_corr, 'USER_PATH', path.join(tmp_path, 'user.json'))
+    monkeypatch.setattr(friend_pcc_corr, 'REVIEW_PATH', path.join(tmp_path, 'review.json'))
+    return friend_pcc_corr.load_data()
+
+
+def test_parallel_matches_serial_on_load_data(tmp_path, monkeypatch):
+    users, reviews_by_business = _load(tmp_path, monkeypatch)
+    last = users['last_user']
+    assert last['user_idx'] >= len(users)
+    assert all(len(u['friends']) == 0 or u['friends'].max() < last['user_idx']
+               for u in users.values())
+
+    serial = friend_pcc_corr.gen_vectors(users, reviews_by_business, PARALLEL=False)
+    parallel = friend_pcc_corr.gen_vectors(users, reviews_by_business, PARALLEL=True,
+                                           workers=2)
+    assert len(serial) > 0
+    assert np.array_equal(np.array(parallel), np.array(serial))
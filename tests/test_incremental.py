@@ -0,0 +1,107 @@
+import json
+from collections import defaultdict
+from os import path
+
+import numpy as np
+import pytest
+
+from benchmarks import synthetic
+from tools import instrument
+from yelp_interface.data_interface import YelpData
+from yelp_interface.trust_indicators import YelpTrustIndicators
+
+NUM_USERS = 400
+BASE_USERS = 350
+
+
+def _read(data_dir, name):
+    with open(path.join(data_dir, f'{name}.json')) as f:
+        return [json.loads(line) for line in f]
+
+
+def _yelp_data(users, reviews, tips, businesses):
+    by_user = defaultdict(list)
+    for review in reviews:
+        by_user[review['user_id']].append(dict(review))
+    tips_by_user = defaultdict(list)
+    for tip in tips:
+        tips_by_user[tip['user_id']].append(dict(tip))
+    return YelpData({u['user_id']: dict(u) for u in users}, by_user, tips_by_user,
+                    {b['business_id']: dict(b) for b in businesses})
+
+
+@pytest.fixture(scope='module')
+def data(tmp_path_factory):
+    data_dir = str(tmp_path_factory.mktemp('data'))
+    synthetic.generate(data_dir, NUM_USERS, seed=3)
+    return {name: _read(data_dir, name) for name in ('user', 'review', 'tip', 'business')}
+
+
+def _split(data):
+    """(base, delta) parts: the delta holds the last users and some held back reviews."""
+    base_ids = {u['user_id'] for u in data['user'][:BASE_USERS]}
+    counts = defaultdict(int)
+    for review in data['review']:
+        counts[review['user_id']] += 1
+    base_reviews, held = [], []
+    for k, review in enumerate(data['review']):
+        user_id = review['user_id']
+        # Hold back some reviews of base users, keeping at least one each.
+        if user_id not in base_ids or (k % 50 == 0 and counts[user_id] > 1):
+            held.append(review)
+            counts[user_id] -= 1
+        else:
+            base_reviews.append(review)
+    base_tips = [t for t in data['tip'] if t['user_id'] in base_ids]
+    new_tips = [t for t in data['tip'] if t['user_id'] not in base_ids]
+    used = {r['business_id'] for r in base_reviews + base_tips}
+    base = (data['user'][:BASE_USERS], base_reviews, base_tips,
+            [b for b in data['business'] if b['business_id'] in used])
+    delta = ({u['user_id']: dict(u) for u in data['user'][BASE_USERS:]},
+             [dict(r) for r in held], [dict(t) for t in new_tips],
+             {b['business_id']: dict(b) for b in data['business'] if b['business_id'] not in used})
+    return base, delta
+
+
+def _pair_rows(yti, ids, trustees, trusters):
+    index = yti._yelp_data.user_ids.index
+    return yti.pair_features(np.array([index(ids[i]) for i in trustees]),
+                             np.array([index(ids[i]) for i in trusters]))
+
+
+def test_apply_delta_matches_full_rebuild(data):
+    base, delta = _split(data)
+    yti = YelpTrustIndicators(_yelp_data(*base))
+    yti.pair_features(np.array([0]), np.array([1]))
+    yti.apply_delta(*delta)
+
+    full = YelpTrustIndicators(_yelp_data(data['user'], data['review'], data['tip'],
+                                          data['business']))
+    ids = [u['user_id'] for u in data['user']]
+    rng = np.random.default_rng(0)
+    trustees, trusters = rng.integers(0, NUM_USERS, size=(2, 5000))
+    assert np.array_equal(_pair_rows(yti, ids, trustees, trusters),
+                          _pair_rows(full, ids, trustees, trusters))
+
+
+def test_apply_delta_work_scales_with_delta(data):
+    base, (users, reviews, tips, businesses) = _split(data)
+    yti = YelpTrustIndicators(_yelp_data(*base))
+    yti.pair_features(np.array([0]), np.array([1]))
+    yd = yti._yelp_data
+    num_reviews = len(yd.reviews)
+
+    small = {user_id: users[user_id] for user_id in list(users)[:2]}
+    small_reviews = [r for r in reviews if r['user_id'] in small]
+    with instrument.session(print_summary=False):
+        delta = yti.apply_delta(small, small_reviews, (), businesses)
+        counters = instrument.report()['counters']
+
+    # Only the new rows are sorted into the user and item groupings.
+    assert counters['review_store.grouping.sorted_rows'] <= 2 * len(small_reviews)
+    assert counters['review_store.grouping.sorted_rows'] < num_reviews
+    # FangTrust recomputes the changed users and the other reviewers of
+    # their items, not everyone.
+    assert counters['fang_trust.user_indicators.users'] < BASE_USERS / 2
+    assert counters['yelp_data.get_user'] <= 3 * len(delta.user_idxs)
+    assert counters.get('mauro_trust.maxima.rescans', 0) == 0
@@ -0,0 +1,85 @@
+import json
+import os
+from os import path
+
+import numpy as np
+import pytest
+
+import settings
+from benchmarks import synthetic
+from tools import instrument
+from yelp_interface.data_interface import read_data
+from yelp_interface.trust_indicators import YelpTrustIndicators
+
+NUM_USERS = 300
+BASE_USERS = 250
+
+
+def _read(data_dir, name):
+    with open(path.join(data_dir, f'{name}.json')) as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    data_dir = str(tmp_path / 'data')
+    synthetic.generate(data_dir, NUM_USERS, seed=4)
+    monkeypatch.setattr(settings, 'DATA_DIR', data_dir)
+    return data_dir
+
+
+def _read_data():
+    return read_data((0, BASE_USERS), read_sample=False, use_cache=False, parallel=False,
+                     hydration_budget=None)
+
+
+def _delta(data_dir):
+    users = {u['user_id']: u for u in _read(data_dir, 'user')[BASE_USERS:]}
+    reviews = [r for r in _read(data_dir, 'review') if r['user_id'] in users]
+    tips = [t for t in _read(data_dir, 'tip') if t['user_id'] in users]
+    businesses = {b['business_id']: b for b in _read(data_dir, 'business')}
+    return users, reviews, tips, businesses
+
+
+def _pair_rows(yti, ids, trustees, trusters):
+    index = yti._yelp_data.user_ids.index
+    return yti.pair_features(np.array([index(ids[i]) for i in trustees]),
+                             np.array([index(ids[i]) for i in trusters]))
+
+
+def test_warm_start_only_loads_arrays(data_dir, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    cold = YelpTrustIndicators(_read_data(), store_dir=store_dir)
+    with instrument.session(print_summary=False):
+        warm = YelpTrustIndicators(_read_data(), store_dir=store_dir)
+        mauro = warm.mauro_trust
+        counters = instrument.report()['counters']
+    # Neither the fingerprint nor MauroTrust went through the users.
+    assert counters.get('yelp_data.get_user', 0) == 0
+    assert warm._yelp_data._friend_graph is None
+    assert mauro.state()[2] == cold.mauro_trust.state()[2]
+    assert np.array_equal(mauro.indicator_matrix(BASE_USERS),
+                          cold.mauro_trust.indicator_matrix(BASE_USERS))
+
+    ids = [u['user_id'] for u in _read(data_dir, 'user')]
+    rng = np.random.default_rng(0)
+    pairs = rng.integers(0, BASE_USERS, size=(2, 2000))
+    assert np.array_equal(_pair_rows(warm, ids, *pairs), _pair_rows(cold, ids, *pairs),
+                          equal_nan=True)
+
+    # Only the changed users are hydrated, so the delta interns friends in
+    # another order than the cold start did.
+    for yti in (warm, cold):
+        yti.apply_delta(*_delta(data_dir))
+    pairs = rng.integers(0, NUM_USERS, size=(2, 2000))
+    assert np.array_equal(_pair_rows(warm, ids, *pairs), _pair_rows(cold, ids, *pairs),
+                          equal_nan=True)
+
+
+def test_store_key_follows_source_files(data_dir):
+    key = YelpTrustIndicators(_read_data()).store_key()
+    assert YelpTrustIndicators(_read_data()).store_key() == key
+    review_path = path.join(data_dir, 'review.json')
+    stat = os.stat(review_path)
+    os.utime(review_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert YelpTrustIndicators(_read_data()).store_key() != key
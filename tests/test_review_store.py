@@ -0,0 +1,38 @@
+import numpy as np
+
+from tools.id_registry import IdRegistry
+from tools.review_store import ReviewStore
+
+
+def _store(reviews):
+    store = ReviewStore(IdRegistry(), IdRegistry())
+    store.extend(reviews)
+    return store
+
+
+def _review(review_id, business_id, stars, date):
+    return {'review_id': review_id, 'user_id': 'u', 'business_id': business_id,
+            'stars': stars, 'useful': 1, 'funny': 0, 'cool': 2, 'date': date}
+
+
+def test_review_views_round_trip_the_dicts():
+    reviews = [_review('r0', 'b0', 4.0, '2011-09-17 15:00:00'),
+               _review('r1', 'b1', 2.5, '2003-02-01 00:00:09')]
+    store = _store(reviews)
+    for review, view in zip(reviews, store.by_user(0)):
+        assert {key: view[key] for key in review} == review
+
+
+def test_dates_without_time_round_trip():
+    store = _store([_review('r0', 'b0', 4.0, '2011-09-17'),
+                    _review('r1', 'b1', 2.0, '2012-01-02')])
+    assert [r['date'] for r in store.by_user(0)] == ['2011-09-17', '2012-01-02']
+    store.extend([_review('r2', 'b2', 3.0, '2013-03-04 05:06:07')])
+    assert [r['date'] for r in store.by_user(0)][2] == '2013-03-04 05:06:07'
+
+
+def test_latest_review_of_a_day_wins():
+    store = _store([_review('r0', 'b0', 5.0, '2011-09-17 18:00:00'),
+                    _review('r1', 'b0', 1.0, '2011-09-17 09:00:00')])
+    indptr, items, stars = store.latest_by_user(np.array([0]))
+    assert list(items) == [0] and list(stars) == [5.0]